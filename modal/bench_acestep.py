@@ -0,0 +1,752 @@
+"""
+ACE-Step Modal endpoint — offline request-overhead benchmark
+
+Runs AceStepInference's endpoints from deploy_acestep.py in-process against
+stand-ins for the Modal SDK and volumes, torch's CUDA init, and the ACE-Step
+handlers. The fake generate_music writes deterministic audio of the requested
+duration, so what is measured is the work deploy_acestep.py adds around it:
+request parsing and input staging, LoRA resolution, output read-back and
+response encoding. Needs only fastapi (no GPU, no network, no Modal account).
+
+For each scenario it reports p50 / p95 / p99 latency, throughput, response
+size, peak RSS, peak Python heap per request (tracemalloc) and the change in
+live allocated blocks across the run, which flags leaks.
+
+Run:
+    pip install "fastapi[standard]"
+    python modal/bench_acestep.py
+    python modal/bench_acestep.py --durations 30 --formats wav --json bench.json
+    python modal/bench_acestep.py --compare bench.json  # exit 1 on regression
+
+generate scenarios cover durations x formats x batch sizes x input sizes x
+transports (json: base64 in/out, binary: multipart in/out, raw: audio body
+in, streamed audio out). job, cascade and loras scenarios run the queued
+job flow, a 3-step lego cascade and the LoRA catalog listing. fanout
+scenarios send batch_size > 1 requests with "fan_out" to a local process pool
+of shard workers (use --dit-ms-per-output to see wall time scale with
+workers). jobs scenarios queue a burst of release_task jobs at once, so
+with --dit-ms and --encode-ms they show encoding overlapping the next job's
+GPU pass. mp3 / opus outputs are opaque bytes sized by their bitrate and flac
+outputs are sized like FLAC_RATIO of the WAV; the stand-ins do not encode
+audio.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import dataclasses
+import gc
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+import uuid
+import wave
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FLAC_RATIO = 0.6  # Stand-in FLAC size relative to 16-bit WAV
+DEFAULT_DURATION = 30.0
+CASCADE_STEPS = 3
+POLL_INTERVAL = 0.005
+
+
+# ---------------------------------------------------------------------------
+# Stand-ins
+# ---------------------------------------------------------------------------
+
+def sine_block() -> bytes:
+    """One second of a 440 Hz stereo 16-bit sine, the unit all fake audio repeats."""
+    import array
+
+    frames = array.array("h")
+    for i in range(SAMPLE_RATE):
+        sample = int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE))
+        frames.extend((sample, sample))
+    return frames.tobytes()
+
+
+_SINE = sine_block()
+_OPAQUE_BLOCK = random.Random(0).randbytes(len(_SINE))
+
+
+def write_audio(path: str, seconds: float):
+    """Write deterministic WAV audio of the given length."""
+    whole, frac = int(seconds), seconds - int(seconds)
+    with wave.open(path, "wb") as w:
+        w.setnchannels(CHANNELS)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        for _ in range(whole):
+            w.writeframes(_SINE)
+        w.writeframes(_SINE[:int(frac * SAMPLE_RATE) * CHANNELS * 2])
+
+
+def wav_bytes(seconds: float) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(CHANNELS)
+        w.setsampwidth(2)
+        w.setframerate(SAMPLE_RATE)
+        for _ in range(int(seconds)):
+            w.writeframes(_SINE)
+    return buffer.getvalue()
+
+
+class FakeImage:
+    """Chainable stand-in for modal.Image; every builder call returns itself."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    @contextlib.contextmanager
+    def imports(self):
+        yield
+
+
+class FakeVolume:
+    def __init__(self):
+        self.reloads = 0
+        self.commits = 0
+
+    def reload(self):
+        self.reloads += 1
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeApp:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def cls(self, **kwargs):
+        return lambda cls: cls
+
+    def function(self, **kwargs):
+        return lambda fn: fn
+
+
+def _passthrough(*args, **kwargs):
+    return lambda fn: fn
+
+
+class FakeDitHandler:
+    """AceStepHandler stand-in: no model, LoRA calls are no-ops."""
+
+    model = None
+
+    def initialize_service(self, **kwargs):
+        return "ok", True
+
+    def load_lora(self, path: str):
+        pass
+
+    def unload_lora(self):
+        pass
+
+
+class FakeLLMHandler:
+    def initialize(self, **kwargs):
+        return "ok", True
+
+
+class GenerationParams:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+@dataclasses.dataclass
+class GenerationConfig:
+    batch_size: int = 1
+    allow_lm_batch: bool = False
+    use_random_seed: bool = True
+    seeds: list = None
+    audio_format: str = "mp3"
+    constrained_decoding_debug: bool = False
+
+
+class GenerationResult:
+    def __init__(self, audios):
+        self.success = True
+        self.error = None
+        self.status_message = "ok"
+        self.audios = audios
+
+
+DIT_SECONDS = 0.0  # Simulated GPU time per call, set from --dit-ms
+DIT_SECONDS_PER_OUTPUT = 0.0  # Simulated GPU time per output, set from --dit-ms-per-output
+ENCODE_SECONDS = 0.0  # Simulated encode time per compressed output, set from --encode-ms
+
+
+def generate_music(dit_handler, llm_handler, params, config, save_dir=None, progress=None):
+    """Write config.batch_size outputs of params.duration seconds."""
+    if DIT_SECONDS or DIT_SECONDS_PER_OUTPUT:
+        time.sleep(DIT_SECONDS + DIT_SECONDS_PER_OUTPUT * config.batch_size)
+    seconds = params.duration if params.duration and params.duration > 0 else DEFAULT_DURATION
+    audios = []
+    for _ in range(config.batch_size):
+        path = os.path.join(save_dir, f"{uuid.uuid4().hex}.{config.audio_format}")
+        write_audio(path, seconds)
+        audios.append({"path": path})
+    return GenerationResult(audios)
+
+
+def encode_audio(wav_path: str, out_path: str, encoding: dict):
+    """Write opaque bytes sized like wav_path encoded as `encoding` (replaces ffmpeg)."""
+    if ENCODE_SECONDS:
+        time.sleep(ENCODE_SECONDS)
+    with wave.open(wav_path, "rb") as w:
+        seconds = w.getnframes() / w.getframerate()
+    if "bitrate_kbps" in encoding:
+        bytes_per_second = encoding["bitrate_kbps"] * 125
+    else:
+        bytes_per_second = int(len(_SINE) * FLAC_RATIO)
+    remaining = int(seconds * bytes_per_second)
+    with open(out_path, "wb") as f:
+        while remaining > 0:
+            f.write(_OPAQUE_BLOCK[:min(remaining, len(_OPAQUE_BLOCK))])
+            remaining -= len(_OPAQUE_BLOCK)
+
+
+class ThreadJobRunner:
+    """
+    ModalJobRunner stand-in: runs generate_job on a thread pool sized like the
+    class's allow_concurrent_inputs, instead of spawning Modal calls.
+    """
+
+    def __init__(self, app, workers: int = 8):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.app = app
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.calls = {}
+
+    def spawn(self, job_id: str, request: dict, inputs: dict) -> str:
+        call_id = f"fc-{uuid.uuid4().hex}"
+        self.calls[call_id] = self.pool.submit(self.app.generate_job, job_id, request, inputs)
+        return call_id
+
+    def poll(self, call_id: str):
+        future = self.calls[call_id]
+        if not future.done():
+            return None
+        if future.cancelled():
+            return "Cancelled"
+        error = future.exception()
+        return str(error) if error else ""
+
+    def cancel(self, call_id: str):
+        self.calls[call_id].cancel()
+
+
+def install_stand_ins():
+    """Register the stand-in modules before deploy_acestep is imported."""
+    modal = types.ModuleType("modal")
+    modal.App = FakeApp
+    modal.Image = types.SimpleNamespace(debian_slim=lambda **kwargs: FakeImage())
+    modal.Volume = types.SimpleNamespace(from_name=lambda *args, **kwargs: FakeVolume())
+    modal.Dict = types.SimpleNamespace(from_name=lambda *args, **kwargs: {})
+    modal.Retries = lambda **kwargs: None
+    modal.FunctionCall = None
+    modal.enter = modal.method = modal.fastapi_endpoint = _passthrough
+
+    torch = types.ModuleType("torch")
+    torch.cuda = types.SimpleNamespace(init=lambda: None, synchronize=lambda: None, is_available=lambda: False)
+
+    acestep = types.ModuleType("acestep")
+    acestep.__path__ = []
+    handler = types.ModuleType("acestep.handler")
+    handler.AceStepHandler = FakeDitHandler
+    llm_inference = types.ModuleType("acestep.llm_inference")
+    llm_inference.LLMHandler = FakeLLMHandler
+    inference = types.ModuleType("acestep.inference")
+    inference.GenerationParams = GenerationParams
+    inference.GenerationConfig = GenerationConfig
+    inference.generate_music = generate_music
+    constants = types.ModuleType("acestep.constants")
+    constants.DEFAULT_DIT_INSTRUCTION = "Generate audio."
+    constants.TASK_INSTRUCTIONS = {}
+
+    sys.modules.update({
+        "modal": modal,
+        "torch": torch,
+        "acestep": acestep,
+        "acestep.handler": handler,
+        "acestep.llm_inference": llm_inference,
+        "acestep.inference": inference,
+        "acestep.constants": constants,
+    })
+
+
+def load_deployment(root: str, num_loras: int):
+    """Import deploy_acestep with its volumes redirected under `root`, and start it."""
+    install_stand_ins()
+    spec = importlib.util.spec_from_file_location(
+        "deploy_acestep", os.path.join(os.path.dirname(os.path.abspath(__file__)), "deploy_acestep.py"),
+    )
+    deploy = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(deploy)
+
+    deploy.LORA_DIR = os.path.join(root, "loras")
+    deploy.CACHE_DIR = os.path.join(root, "cache")
+    deploy.LORA_CATALOG_PATH = os.path.join(deploy.LORA_DIR, ".catalog.json")
+    deploy.TRAIN_JOBS_DIR = os.path.join(deploy.LORA_DIR, ".jobs")
+    deploy.TRAIN_DATA_DIR = os.path.join(deploy.LORA_DIR, ".data")
+    deploy.encode_audio = encode_audio
+    for i in range(num_loras):
+        lora_dir = os.path.join(deploy.LORA_DIR, f"bench-lora-{i}")
+        os.makedirs(lora_dir, exist_ok=True)
+        with open(os.path.join(lora_dir, "adapter_model.safetensors"), "wb") as f:
+            f.write(random.Random(i).randbytes(64 * 1024))
+        with open(os.path.join(lora_dir, "meta.json"), "w") as f:
+            json.dump({"name": f"bench-lora-{i}", "epochs": 1, "rank": 8}, f)
+    os.makedirs(deploy.CACHE_DIR, exist_ok=True)
+
+    app = deploy.AceStepInference()
+    app.load_model()
+    app.job_runner = ThreadJobRunner(app)
+    return deploy, app
+
+
+_shard_app = None  # Per-process deployment in fan-out pool workers
+
+
+def init_shard_worker(root: str, dit_seconds: float, dit_seconds_per_output: float, encode_seconds: float):
+    """Process pool initializer: start a private deployment for this worker under `root`."""
+    global _shard_app, DIT_SECONDS, DIT_SECONDS_PER_OUTPUT, ENCODE_SECONDS
+
+    DIT_SECONDS, DIT_SECONDS_PER_OUTPUT, ENCODE_SECONDS = dit_seconds, dit_seconds_per_output, encode_seconds
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, _shard_app = load_deployment(tempfile.mkdtemp(prefix="shard_", dir=root), 0)
+
+
+def run_shard(request: dict, inputs: dict) -> dict:
+    with contextlib.redirect_stdout(io.StringIO()):
+        return _shard_app.generate_shard(request, inputs)
+
+
+# ---------------------------------------------------------------------------
+# Requests
+# ---------------------------------------------------------------------------
+
+class BenchError(Exception):
+    pass
+
+
+def make_request(method: str, headers: dict, body: bytes = b"", query: dict = None):
+    """A real Starlette Request over an in-memory ASGI body."""
+    from urllib.parse import urlencode
+    from starlette.requests import Request
+
+    chunks = [body[i:i + 64 * 1024] for i in range(0, len(body), 64 * 1024)] or [b""]
+    pending = iter(enumerate(chunks))
+
+    async def receive():
+        try:
+            i, chunk = next(pending)
+        except StopIteration:
+            return {"type": "http.disconnect"}
+        return {"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1}
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": "/",
+        "query_string": urlencode(query or {}).encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+    }
+    return Request(scope, receive)
+
+
+def multipart_body(params: dict, files: dict):
+    boundary = uuid.uuid4().hex
+    parts = [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="params"\r\n\r\n{json.dumps(params)}\r\n'.encode()
+    ]
+    for name, data in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.wav"\r\n'
+            f"Content-Type: audio/wav\r\n\r\n".encode()
+        )
+        parts.append(data)
+        parts.append(b"\r\n")
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+def build_generate_request(transport: str, params: dict, src: bytes):
+    """Return a factory for fresh requests in the given transport (bodies are built once)."""
+    if transport == "json":
+        body = dict(params)
+        if src:
+            import base64
+            body["src_audio_base64"] = base64.b64encode(src).decode("utf-8")
+        payload = json.dumps(body).encode()
+        headers = {"content-type": "application/json", "accept": "application/json"}
+        return lambda: make_request("POST", headers, payload)
+    if transport == "binary":
+        payload, content_type = multipart_body(params, {"src_audio": src} if src else {})
+        headers = {"content-type": content_type, "accept": "multipart/form-data"}
+        return lambda: make_request("POST", headers, payload)
+    if transport == "raw":
+        headers = {"content-type": "audio/wav", "accept": "audio/*"}
+        return lambda: make_request("POST", headers, src, {"params": json.dumps(params)})
+    raise ValueError(f"Unknown transport: {transport}")
+
+
+async def drain(response) -> int:
+    """Consume a response the way the ASGI server would; returns the body size."""
+    from fastapi.responses import JSONResponse
+
+    if isinstance(response, dict):
+        status = response.get("status")
+        if status not in (None, "succeeded") or response.get("code", 200) != 200:
+            raise BenchError(response.get("error") or status)
+        return len(JSONResponse(response).body)
+    if hasattr(response, "body_iterator"):
+        size = 0
+        async for chunk in response.body_iterator:
+            size += len(chunk)
+        return size
+    if getattr(response, "status_code", 200) != 200:
+        raise BenchError(f"HTTP {response.status_code}: {response.body[:200]!r}")
+    return len(response.body)
+
+
+async def run_job(app, params: dict, src: bytes) -> int:
+    factory = build_generate_request("binary", params, src)
+    submitted = await app.api_release_task(factory())
+    if submitted["code"] != 200:
+        raise BenchError(submitted["error"])
+    task_id = submitted["data"]["task_id"]
+    while True:
+        entry = app.api_query_result({"task_id_list": [task_id]})["data"][0]
+        if entry["status"] == 2:
+            raise BenchError(entry["result"])
+        if entry["status"] == 1:
+            break
+        await asyncio.sleep(POLL_INTERVAL)
+    size = 0
+    for i, _ in enumerate(json.loads(entry["result"])):
+        size += await drain(app.api_task_audio(task_id, i))
+    return size
+
+
+async def run_jobs(app, params: dict, src: bytes, count: int) -> int:
+    """Queue `count` jobs at once and wait for all of them."""
+    sizes = await asyncio.gather(*(run_job(app, params, src) for _ in range(count)))
+    return sum(sizes)
+
+
+async def run_cascade(app, params: dict, src: bytes) -> int:
+    steps = [{"clip_id": f"clip-{i}", "track_name": f"track-{i}"} for i in range(CASCADE_STEPS)]
+    payload, content_type = multipart_body({**params, "steps": steps}, {"src_audio": src} if src else {})
+    response = await app.api_cascade(make_request("POST", {"content-type": content_type}, payload))
+    if isinstance(response, dict):
+        raise BenchError(response.get("error"))
+    size = 0
+    async for chunk in response.body_iterator:
+        chunk = chunk.encode() if isinstance(chunk, str) else chunk
+        size += len(chunk)
+        for line in chunk.splitlines():
+            if b'"status": "failed"' in line:
+                raise BenchError(line[:200].decode())
+    return size
+
+
+async def run_list_loras(app) -> int:
+    return await drain(app.api_list_loras(make_request("GET", {}, query={"limit": "50"})))
+
+
+# ---------------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------------
+
+class RssSampler:
+    """Peak resident set size over a window, sampled from /proc (ru_maxrss elsewhere)."""
+
+    def __init__(self, interval=0.002):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def current() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except OSError:
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __enter__(self):
+        self.peak = self.current()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.current())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.current())
+
+
+def percentile(values, p: float) -> float:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+async def measure(run, iterations: int, warmup: int, concurrency: int, alloc_iterations: int) -> dict:
+    for _ in range(warmup):
+        await run()
+
+    latencies = []
+    sizes = []
+    remaining = iterations
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            sizes.append(await run())
+            latencies.append(time.perf_counter() - started)
+
+    gc.collect()
+    blocks_before = sys.getallocatedblocks()
+    with RssSampler() as rss:
+        wall_started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        wall = time.perf_counter() - wall_started
+    gc.collect()
+    blocks_delta = sys.getallocatedblocks() - blocks_before
+
+    # Traced separately: tracemalloc slows allocation-heavy code too much to time it
+    heap_peak = 0
+    if alloc_iterations:
+        tracemalloc.start()
+        try:
+            for _ in range(alloc_iterations):
+                tracemalloc.reset_peak()
+                baseline, _ = tracemalloc.get_traced_memory()
+                await run()
+                heap_peak = max(heap_peak, tracemalloc.get_traced_memory()[1] - baseline)
+        finally:
+            tracemalloc.stop()
+
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        "iterations": len(ms),
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "throughput_rps": round(len(ms) / wall, 2),
+        "response_bytes": int(sum(sizes) / len(sizes)),
+        "peak_rss_bytes": rss.peak,
+        "heap_peak_bytes": heap_peak,
+        "blocks_delta": blocks_delta,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Scenarios
+# ---------------------------------------------------------------------------
+
+def csv(kind):
+    return lambda text: [kind(item) for item in text.split(",") if item]
+
+
+def scenarios(args, deploy, app, root: str, pools: list):
+    """
+    Yield (name, coroutine factory) pairs for the configured matrix. Process
+    pools started for fan-out scenarios are appended to `pools`.
+    """
+    for duration in args.durations:
+        for audio_format in args.formats:
+            for batch_size in args.batch_sizes:
+                for input_seconds in args.input_sizes:
+                    src = wav_bytes(input_seconds) if input_seconds else b""
+                    for transport in args.transports:
+                        if transport == "raw" and not src:
+                            continue
+                        params = {
+                            "task_type": "lego" if src else "text2music",
+                            "prompt": "benchmark",
+                            "audio_duration": duration,
+                            "audio_format": audio_format,
+                            "batch_size": batch_size,
+                            "repainting_start": 0.0,
+                            "repainting_end": duration,
+                        }
+                        factory = build_generate_request(transport, params, src)
+                        name = f"generate/{transport}/{duration:g}s/{audio_format}/b{batch_size}/in{input_seconds:g}s"
+
+                        async def run(factory=factory):
+                            return await drain(await app.api_generate(factory()))
+
+                        yield name, run
+
+    for duration in args.durations:
+        params = {"task_type": "lego", "prompt": "benchmark", "audio_duration": duration, "audio_format": "wav"}
+        src = wav_bytes(duration)
+        yield f"job/binary/{duration:g}s/wav", lambda params=params, src=src: run_job(app, params, src)
+        yield (
+            f"cascade/{CASCADE_STEPS}steps/{duration:g}s/wav",
+            lambda params=params, src=src: run_cascade(app, params, src),
+        )
+    yield "loras/list", lambda: run_list_loras(app)
+
+    if args.job_burst > 1:
+        for audio_format in args.formats:
+            params = {"prompt": "benchmark", "audio_duration": args.durations[0], "audio_format": audio_format}
+            yield (
+                f"jobs/{args.job_burst}x/{args.durations[0]:g}s/{audio_format}",
+                lambda params=params: run_jobs(app, params, b"", args.job_burst),
+            )
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    for workers in args.fanout_workers:
+        pool = None
+        for batch_size in args.batch_sizes:
+            if batch_size < 2:
+                continue
+            if pool is None:
+                pool = ProcessPoolExecutor(
+                    workers, initializer=init_shard_worker, initargs=(root, DIT_SECONDS, DIT_SECONDS_PER_OUTPUT, ENCODE_SECONDS),
+                )
+                pools.append(pool)
+            params = {
+                "prompt": "benchmark",
+                "audio_duration": args.durations[0],
+                "audio_format": "wav",
+                "batch_size": batch_size,
+                "fan_out": True,
+            }
+            factory = build_generate_request("binary", params, b"")
+            executor = deploy.PoolShardExecutor(pool, run_shard)
+
+            async def run(factory=factory, executor=executor):
+                app.shard_executor = executor
+                return await drain(await app.api_generate(factory()))
+
+            yield f"fanout/binary/{args.durations[0]:g}s/wav/b{batch_size}/{workers}w", run
+
+
+def print_table(results: dict, out):
+    header = (
+        f"{'scenario':<44} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} "
+        f"{'resp MB':>8} {'RSS MB':>8} {'heap MB':>8} {'blocks':>8}"
+    )
+    print(header, file=out)
+    print("-" * len(header), file=out)
+    for name, r in results.items():
+        print(
+            f"{name:<44} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['p99_ms']:>9.2f} "
+            f"{r['throughput_rps']:>8.1f} {r['response_bytes'] / 1e6:>8.2f} "
+            f"{r['peak_rss_bytes'] / 1e6:>8.1f} {r['heap_peak_bytes'] / 1e6:>8.2f} {r['blocks_delta']:>8}",
+            file=out,
+        )
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Scenarios whose p50 latency or heap peak grew past `tolerance` times the baseline."""
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for metric in ("p50_ms", "heap_peak_bytes"):
+            if base[metric] and r[metric] > base[metric] * tolerance:
+                regressions.append(f"{name}: {metric} {base[metric]} -> {r[metric]}")
+    return regressions
+
+
+def main():
+    global DIT_SECONDS, DIT_SECONDS_PER_OUTPUT, ENCODE_SECONDS
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1], formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10, help="timed requests per scenario")
+    parser.add_argument("--warmup", type=int, default=2, help="untimed requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=1, help="requests in flight at once")
+    parser.add_argument("--alloc-iterations", type=int, default=2, help="extra tracemalloc-traced requests")
+    parser.add_argument("--durations", type=csv(float), default=[10.0, 60.0], help="output seconds")
+    parser.add_argument("--formats", type=csv(str), default=["wav", "mp3"])
+    parser.add_argument("--batch-sizes", type=csv(int), default=[1, 4])
+    parser.add_argument("--input-sizes", type=csv(float), default=[0.0, 60.0], help="src_audio seconds (0 = none)")
+    parser.add_argument("--transports", type=csv(str), default=["json", "binary"], help="json, binary, raw")
+    parser.add_argument("--loras", type=int, default=20, help="fake adapters on the LoRA volume")
+    parser.add_argument("--dit-ms", type=float, default=0.0, help="simulated GPU time per generate_music call")
+    parser.add_argument("--dit-ms-per-output", type=float, default=0.0, help="simulated GPU time per output")
+    parser.add_argument("--encode-ms", type=float, default=0.0, help="simulated encode time per mp3/flac/opus output")
+    parser.add_argument("--job-burst", type=int, default=4, help="jobs queued at once in jobs scenarios (1 = off)")
+    parser.add_argument("--fanout-workers", type=csv(int), default=[1, 4], help="shard worker processes")
+    parser.add_argument("--filter", default="", help="only run scenarios containing this substring")
+    parser.add_argument("--json", dest="json_path", help="write results to this file")
+    parser.add_argument("--compare", help="baseline results file; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed ratio over the baseline")
+    parser.add_argument("--verbose", action="store_true", help="keep the deployment's [Modal] logs")
+    args = parser.parse_args()
+    DIT_SECONDS = args.dit_ms / 1000
+    DIT_SECONDS_PER_OUTPUT = args.dit_ms_per_output / 1000
+    ENCODE_SECONDS = args.encode_ms / 1000
+
+    out = sys.stdout
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    root = tempfile.mkdtemp(prefix="acestep_bench_")
+    results = {}
+    pools = []
+    try:
+        with quiet:
+            deploy, app = load_deployment(root, args.loras)
+
+        async def run_all():
+            for name, run in scenarios(args, deploy, app, root, pools):
+                if args.filter not in name:
+                    continue
+                try:
+                    with contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO()):
+                        results[name] = await measure(
+                            run, args.iterations, args.warmup, args.concurrency, args.alloc_iterations,
+                        )
+                except BenchError as e:
+                    print(f"{name}: FAILED ({e})", file=out)
+
+        asyncio.run(run_all())
+    finally:
+        for pool in pools:
+            pool.shutdown()
+        shutil.rmtree(root, ignore_errors=True)
+
+    print_table(results, out)
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"created_at": time.time(), "args": vars(args), "scenarios": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)["scenarios"], args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=out)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,343 +9,4170 @@ Deploy:
 
 Endpoint URL:
     https://marcf--acestep-acestepinference-api-generate.modal.run
+
+Long generations can instead be queued through api_release_task and polled with
+api_query_result, mirroring the ACE-Step 1.5 API server's release_task /
+query_result contract so the DAW uses one client path for both backends. Each
+job runs as its own spawned generate_job call, and any container can report on
+it and serve its audio.
+
+Audio can travel as base64 JSON (the original format) or as binary:
+multipart/form-data or raw audio uploads, and multipart or streamed audio
+responses selected via the Accept header. Uploads may be compressed (FLAC,
+Opus), and a silent context is requested by duration instead of uploaded.
+
+Multi-track lego projects can run as one api_cascade call that keeps each
+intermediate cumulative mix on the server and streams per-track results.
+Lego requests may set "postprocess" to get back the isolated, trimmed stem and
+its waveform peaks instead of (or alongside) the full mix, and may set "window"
+to generate only the repaint region plus context margins, spliced back into
+the full-length source with crossfades.
+
+Multi-output requests may set "fan_out" to run one seed per output across a
+pool of single-input inference containers (generate_shard.map) instead of one
+batched pass.
+
+Outputs are generated as WAV and encoded to MP3, FLAC or Opus in a bounded
+thread pool after the GPU is released, so encoding overlaps the next pass.
+
+Every request gets a request id (X-Request-ID, or generated) that prefixes its
+log lines; per-phase timings can be returned with ?timings=1, and api_metrics
+exposes per-container counters and latency histograms in Prometheus format.
+
+LoRA training runs in a separate AceStepTrainer worker: api_train queues a
+job and returns its id, and api_train_status / api_train_cancel report on it.
+Training files are uploaded once, in resumable chunks, through api_train_upload
+and stored by hash on the LoRA volume; jobs name a dataset manifest of those
+hashes, and the resampled audio and VAE latents are cached per file.
 """
 
-import modal
+import collections
+import contextlib
+import contextvars
+import hashlib
+import json
+import math
+import os
+import shutil
+import threading
+import time
+import uuid
+import weakref
+
+import modal
+
+# ---------------------------------------------------------------------------
+# Modal App & Image
+# ---------------------------------------------------------------------------
+
+app = modal.App("acestep")
+
+CHECKPOINT_DIR = "/opt/ACE-Step/checkpoints"
+LORA_VOLUME = modal.Volume.from_name("acestep-loras", create_if_missing=True)
+LORA_DIR = "/loras"
+CACHE_VOLUME = modal.Volume.from_name("acestep-cache", create_if_missing=True)
+CACHE_DIR = "/cache"
+# Status of release_task jobs, readable by every inference container
+JOB_DICT = modal.Dict.from_name("acestep-jobs", create_if_missing=True)
+
+# Build the container image with all dependencies + pre-downloaded models
+acestep_image = (
+    modal.Image.debian_slim(python_version="3.11")
+    .apt_install("git", "ffmpeg", "libsndfile1")
+    .pip_install(
+        "torch>=2.1.0",
+        "torchaudio>=2.1.0",
+        "transformers>=4.51.0,<4.58.0",
+        "accelerate>=1.12.0",
+        "diffusers>=0.33.0",
+        "safetensors>=0.4.0",
+        "soundfile>=0.12.0",
+        "librosa>=0.10.0",
+        "numpy>=1.24.0",
+        "scipy>=1.11.0",
+        "huggingface_hub>=0.20.0",
+        "pydantic>=2.0.0",
+        "einops>=0.7.0",
+        "rotary-embedding-torch>=0.5.0",
+        "fastapi[standard]",
+        # ACE-Step runtime deps (installed with --no-deps to avoid torch conflicts)
+        "loguru>=0.7.3",
+        "matplotlib>=3.7.5",
+        "diskcache",
+        "numba>=0.63.1",
+        "vector-quantize-pytorch>=1.27.15",
+        "torchcodec>=0.9.1",
+        "peft>=0.18.0",
+        "lightning>=2.0.0",
+        "tensorboard>=2.0.0",
+        "toml",
+        "pypinyin",
+        "modelscope",
+    )
+    .run_commands(
+        # Clone ACE-Step 1.5 repo
+        "git clone --depth 1 https://github.com/ACE-Step/ACE-Step-1.5.git /opt/ACE-Step",
+        # Install nano-vllm (local third-party dependency)
+        "cd /opt/ACE-Step/acestep/third_parts/nano-vllm && pip install .",
+        # Install hatchling build backend + the package itself
+        "pip install hatchling",
+        "cd /opt/ACE-Step && pip install --no-deps .",
+    )
+    # Download model weights at IMAGE BUILD TIME (not at cold start)
+    .run_commands(
+        f"python -c \""
+        f"from huggingface_hub import snapshot_download; "
+        f"snapshot_download(repo_id='ACE-Step/Ace-Step1.5', local_dir='{CHECKPOINT_DIR}'); "
+        f"snapshot_download(repo_id='ACE-Step/acestep-5Hz-lm-4B', local_dir='{CHECKPOINT_DIR}/acestep-5Hz-lm-4B')"
+        f"\"",
+    )
+)
+
+with acestep_image.imports():
+    from fastapi import Request
+
+
+# ---------------------------------------------------------------------------
+# Job Queue
+# ---------------------------------------------------------------------------
+
+JOB_RESULT_TTL = 15 * 60  # Seconds a finished job's result is kept for polling
+JOB_MAX_AGE = 6 * 60 * 60  # Seconds after which an unfinished job's record is dropped too
+
+# query_result status codes used by the ACE-Step 1.5 API server
+TASK_PROCESSING = 0
+TASK_SUCCEEDED = 1
+TASK_FAILED = 2
+
+
+class SharedJobStore:
+    """
+    Status and outputs of release_task jobs, readable from every inference container.
+
+    Each job runs as its own generate_job call, so Modal keeps the container
+    running it alive until it is done, while polls may reach any container.
+    The call publishes the job's status and result metadata to `records` (a
+    modal.Dict) and, before a job is reported succeeded, its outputs to
+    `<root>/<job_id>/` on the cache volume. "<job_id>:call" holds the call
+    id, so a poll can tell a job whose container died from one still running,
+    and "<job_id>:cancel" is set when the job is cancelled before it starts.
+    """
+
+    PROGRESS_INTERVAL = 2.0  # Seconds between progress_text writes per job
+
+    def __init__(self, records, root: str, ttl=JOB_RESULT_TTL):
+        self.records = records
+        self.root = root
+        self.ttl = ttl
+        self._progress_written = {}  # job_id -> monotonic time of the last progress write
+        os.makedirs(root, exist_ok=True)
+
+    def publish(self, job: dict, progress: bool = False) -> dict:
+        """Write the job's record and return it; progress-only updates are throttled."""
+        now = time.monotonic()
+        if progress and now - self._progress_written.get(job["id"], 0.0) < self.PROGRESS_INTERVAL:
+            return None
+        self._progress_written[job["id"]] = now
+        result = job["result"] or {}
+        record = {
+            "status": job["status"],
+            "progress_text": job["progress_text"],
+            "created_at": job["created_at"],
+            "finished_at": job["finished_at"],
+            "result": {k: v for k, v in result.items() if k not in ("outputs", "mix_outputs", "traceback")},
+        }
+        record["result"]["output_count"] = len(result.get("outputs", []))
+        record["result"]["mix_count"] = len(result.get("mix_outputs", []))
+        if job["finished_at"] is not None:
+            self._progress_written.pop(job["id"], None)
+        try:
+            self.records[job["id"]] = record
+        except Exception as e:
+            log(f"WARNING: Could not publish job {job['id']}: {e}")
+        return record
+
+    def get(self, job_id: str):
+        try:
+            record = self.records.get(job_id)
+        except Exception:
+            return None
+        return None if record is None or self._expired(record, time.time()) else record
+
+    def set_call(self, job_id: str, call_id: str):
+        self.records[f"{job_id}:call"] = call_id
+
+    def call_id(self, job_id: str):
+        try:
+            return self.records.get(f"{job_id}:call")
+        except Exception:
+            return None
+
+    def counts(self) -> dict:
+        """Queued and running jobs across all containers."""
+        counts = {"queued": 0, "running": 0}
+        try:
+            for key, record in list(self.records.items()):
+                if ":" not in key and record["status"] in counts:
+                    counts[record["status"]] += 1
+        except Exception as e:
+            log(f"WARNING: Could not count jobs: {e}")
+        return counts
+
+    def store_outputs(self, job_id: str, result: dict):
+        """Write a finished job's outputs to the cache volume and commit them."""
+        job_dir = os.path.join(self.root, job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        for kind, key in (("output", "outputs"), ("mix", "mix_outputs")):
+            for i, data in enumerate(result.get(key, [])):
+                with open(os.path.join(job_dir, f"{kind}_{i}"), "wb") as f:
+                    f.write(data)
+        CACHE_VOLUME.commit()
+
+    def read_output(self, job_id: str, kind: str, index: int):
+        """Bytes of a stored output, or None if it is not (yet) visible here."""
+        path = os.path.join(self.root, job_id, f"{kind}_{index}")
+        if not os.path.exists(path):
+            try:
+                CACHE_VOLUME.reload()
+            except Exception:
+                pass  # Files held open in this container; the output may appear on a later poll
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def request_cancel(self, job_id: str):
+        self.records[f"{job_id}:cancel"] = True
+
+    def cancel_requested(self, job_id: str) -> bool:
+        try:
+            return bool(self.records.get(f"{job_id}:cancel"))
+        except Exception:
+            return False
+
+    def sweep(self):
+        """
+        Forget jobs finished more than `ttl` seconds ago (or started more than
+        JOB_MAX_AGE ago): their records, call ids, cancel flags and stored outputs.
+        """
+        now = time.time()
+        try:
+            expired = [
+                key for key, record in list(self.records.items())
+                if ":" not in key and self._expired(record, now)
+            ]
+        except Exception as e:
+            log(f"WARNING: Could not list jobs to sweep: {e}")
+            expired = []
+        for job_id in expired:
+            for key in (job_id, f"{job_id}:call", f"{job_id}:cancel"):
+                try:
+                    self.records.pop(key)
+                except Exception:
+                    pass  # Never set, or already swept by another container
+
+        removed = False
+        for name in os.listdir(self.root):
+            job_dir = os.path.join(self.root, name)
+            try:
+                if os.path.getmtime(job_dir) < now - self.ttl:
+                    shutil.rmtree(job_dir, ignore_errors=True)
+                    removed = True
+            except OSError:
+                pass
+        if removed:
+            CACHE_VOLUME.commit()
+
+    def _expired(self, record: dict, now: float) -> bool:
+        if record["finished_at"] is not None:
+            return now - record["finished_at"] > self.ttl
+        return now - record["created_at"] > JOB_MAX_AGE
+
+
+class ModalJobRunner:
+    """Runs release_task jobs as spawned AceStepInference.generate_job calls."""
+
+    def spawn(self, job_id: str, request: dict, inputs: dict) -> str:
+        """Start a job; returns the id of its call."""
+        return AceStepInference().generate_job.spawn(job_id, request, inputs).object_id
+
+    def poll(self, call_id: str):
+        """None while the call is queued or running, else the error it ended with ("" for none)."""
+        import modal.exception
+
+        try:
+            modal.FunctionCall.from_id(call_id).get(timeout=0)
+        except modal.exception.FunctionTimeoutError as e:
+            return f"Job timed out: {e}"
+        except (TimeoutError, modal.exception.TimeoutError):
+            return None
+        except Exception as e:
+            return str(e) or type(e).__name__
+        return ""
+
+    def cancel(self, call_id: str):
+        modal.FunctionCall.from_id(call_id).cancel()
+
+
+def api_envelope(data, code: int = 200, error: str = None) -> dict:
+    """Wrap a payload in the ACE-Step 1.5 API server's response envelope."""
+    return {
+        "data": data,
+        "code": code,
+        "error": error,
+        "timestamp": int(time.time() * 1000),
+        "extra": None,
+    }
+
+
+def query_int(query, name: str, default: int = None, minimum: int = 0) -> int:
+    """Read an integer query parameter; ValueError names the parameter if it is malformed."""
+    value = query.get(name)
+    if value in (None, ""):
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer") from None
+    if number < minimum:
+        raise ValueError(f"{name} must be at least {minimum}")
+    return number
+
+
+# ---------------------------------------------------------------------------
+# Audio Transport
+# ---------------------------------------------------------------------------
+
+AUDIO_INPUTS = ("src_audio", "reference_audio")
+AUDIO_MEDIA_TYPES = {"wav": "audio/wav", "mp3": "audio/mpeg", "flac": "audio/flac", "opus": "audio/ogg"}
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Silent context synthesized for "<input>_silence" requests: 16-bit stereo at
+# the model's output sample rate, as the DAW would otherwise upload it
+SILENCE_SAMPLE_RATE = 48000
+SILENCE_CHANNELS = 2
+SILENCE_MAX_SECONDS = 600.0
+
+
+def new_temp_path(temp_dir: str, prefix: str, ext: str = "wav") -> str:
+    return os.path.join(temp_dir, f"{prefix}_{uuid.uuid4().hex}.{ext}")
+
+
+def remove_files(paths):
+    for path in paths:
+        try:
+            forget_file_sha256(path)
+            os.remove(path)
+        except Exception:
+            pass
+
+
+async def read_generate_request(request, store: "InputStore"):
+    """
+    Parse a generate request into (params, inputs, transport).
+
+    Accepted bodies:
+      - application/json: params with optional src_audio_base64 / reference_audio_base64
+      - multipart/form-data: a "params" JSON field plus src_audio / reference_audio files
+      - raw audio (audio/* or application/octet-stream): the body is src_audio and
+        params come from the "params" query parameter as JSON
+
+    Uploads may be WAV, FLAC, Ogg/Opus or MP3. Instead of uploading silence,
+    params may set "src_audio_silence" / "reference_audio_silence" to a
+    duration in seconds and the server synthesizes it.
+
+    Audio inputs are staged through the content-addressed InputStore, so
+    content it already holds is not written again; `inputs` maps each input
+    name to its own path and the caller must remove them.
+    """
+    import base64
+    import json
+
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    inputs = {}
+    try:
+        if content_type == "multipart/form-data":
+            transport = "multipart"
+            form = await request.form()
+            params = json.loads(form.get("params") or "{}")
+            for name in AUDIO_INPUTS:
+                upload = form.get(name)
+                if upload is None or isinstance(upload, str):
+                    continue
+                inputs[name] = store.put_file(name, upload.file)
+            await form.close()
+        elif content_type.startswith("audio/") or content_type == "application/octet-stream":
+            transport = "raw"
+            params = json.loads(request.query_params.get("params") or "{}")
+            spooled = new_temp_path(store.temp_dir, "upload")
+            try:
+                with open(spooled, "wb") as f:
+                    async for chunk in request.stream():
+                        f.write(chunk)
+                inputs["src_audio"] = store.adopt("src_audio", spooled)
+            finally:
+                remove_files([spooled])
+        else:
+            transport = "json"
+            params = await request.json()
+            for name in AUDIO_INPUTS:
+                data = params.pop(f"{name}_base64", None)
+                if not data:
+                    continue
+                inputs[name] = store.put_bytes(name, base64.b64decode(data))
+        for name in AUDIO_INPUTS:
+            seconds = params.pop(f"{name}_silence", None)
+            if seconds and name not in inputs:
+                inputs[name] = store.put_silence(name, silence_seconds(seconds))
+    except Exception:
+        remove_files(inputs.values())
+        raise
+
+    for name, path in inputs.items():
+        log(f"Staged {name} via {transport} ({os.path.getsize(path)} bytes)")
+    return params, inputs, transport
+
+
+def sniff_audio_ext(head: bytes) -> str:
+    """File extension for uploaded audio, from its leading bytes (wav if unknown)."""
+    if head.startswith(b"fLaC"):
+        return "flac"
+    if head.startswith(b"OggS"):
+        return "opus" if b"OpusHead" in head else "ogg"
+    if head.startswith(b"ID3") or head[:2] in (b"\xff\xfb", b"\xff\xf3", b"\xff\xf2"):
+        return "mp3"
+    return "wav"
+
+
+def wav_header(frames: int, sample_rate: int, channels: int, sample_width: int = 2) -> bytes:
+    """Canonical 44-byte PCM WAV header for `frames` frames of audio."""
+    import struct
+
+    block_align = channels * sample_width
+    data_size = frames * block_align
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", 36 + data_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, sample_width * 8,
+        b"data", data_size,
+    )
+
+
+def silence_seconds(value) -> float:
+    seconds = float(value)
+    if not 0 < seconds <= SILENCE_MAX_SECONDS:
+        raise ValueError(f"silence must be between 0 and {SILENCE_MAX_SECONDS:g} seconds")
+    return seconds
+
+
+def response_mode(request) -> str:
+    """Pick the response encoding from the Accept header: json, multipart, audio or events."""
+    accept = request.headers.get("accept", "").lower()
+    if "text/event-stream" in accept:
+        return "events"
+    if "multipart/form-data" in accept:
+        return "multipart"
+    if "audio/" in accept or "application/octet-stream" in accept:
+        return "audio"
+    return "json"
+
+
+def iter_file(path: str):
+    with open(path, "rb") as f:
+        while chunk := f.read(STREAM_CHUNK_SIZE):
+            yield chunk
+
+
+def read_outputs(paths) -> list:
+    """Read output files into memory and remove them."""
+    outputs = []
+    for path in paths:
+        with open(path, "rb") as f:
+            outputs.append(f.read())
+    remove_files(paths)
+    return outputs
+
+
+class MemoryProbe:
+    """
+    Measures the peak Python heap allocation of one request with tracemalloc.
+
+    tracemalloc is process-wide, so only one request is measured at a time;
+    probes started while another is active report nothing.
+    """
+
+    _active = threading.Lock()
+
+    def __init__(self):
+        self.transport = None
+        self._tracing = False
+
+    def start(self):
+        import tracemalloc
+
+        if self._active.acquire(blocking=False):
+            tracemalloc.start()
+            self._tracing = True
+        return self
+
+    def stop(self):
+        """Stop tracing and return {"transport", "peak_bytes"}, or None."""
+        import tracemalloc
+
+        if not self._tracing:
+            return None
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self._tracing = False
+        self._active.release()
+        log(f"Peak request memory ({self.transport}): {peak / 1e6:.1f} MB")
+        return {"transport": self.transport, "peak_bytes": peak}
+
+
+def render_generate_response(result: dict, mode: str, probe: MemoryProbe = None,
+                             trace: "RequestTrace" = None, timings: bool = False):
+    """
+    Turn a _generate result into the response for the requested mode.
+
+    Output files are removed once sent. In multipart mode the "meta" JSON part
+    comes last so it can carry the memory measurement and timings taken after
+    streaming; single-body audio responses carry only the X-Request-ID header.
+    Post-processed results send their full mixes as "mixes" (JSON) or mix_<i>
+    parts (multipart); single-body audio mode sends the first stem only.
+    The trace, if given, is finished once the response has been produced.
+    """
+    from fastapi.responses import StreamingResponse
+
+    trace = trace or RequestTrace()
+
+    def annotate(meta: dict):
+        meta["request_id"] = trace.id
+        if timings:
+            meta["timings"] = trace.snapshot()
+
+    if result.get("status") != "succeeded":
+        memory = probe.stop() if probe else None
+        if memory:
+            result["memory"] = memory
+        annotate(result)
+        trace.finish(result.get("status", "failed"), result.get("error_type"))
+        return result
+
+    paths = result.pop("paths")
+    mix_paths = result.pop("mix_paths", [])
+    audio_format = result.get("format", "mp3")
+    media_type = AUDIO_MEDIA_TYPES.get(audio_format, "application/octet-stream")
+    meta = {**result, "count": len(paths)}
+
+    if mode == "json":
+        import base64
+        with trace.span("encode"):
+            meta["outputs"] = [base64.b64encode(data).decode("utf-8") for data in read_outputs(paths)]
+            if mix_paths:
+                meta["mixes"] = [base64.b64encode(data).decode("utf-8") for data in read_outputs(mix_paths)]
+        trace.attrs["bytes_out"] += sum(len(data) for data in meta["outputs"] + meta.get("mixes", []))
+        if probe:
+            meta["memory"] = probe.stop()
+        annotate(meta)
+        trace.finish("succeeded")
+        return meta
+
+    def count_sent(path: str):
+        trace.attrs["bytes_out"] += os.path.getsize(path)
+
+    def stream_audio():
+        completed = False
+        try:
+            with trace.span("stream"):
+                count_sent(paths[0])
+                yield from iter_file(paths[0])
+            completed = True
+        finally:
+            remove_files(paths + mix_paths)
+            if probe:
+                probe.stop()
+            trace.finish("succeeded" if completed else "aborted")
+
+    def stream_multipart(boundary: str):
+        import json
+        mix_format = result.get("mix_format", audio_format)
+        parts = [(f"output_{i}", path, audio_format) for i, path in enumerate(paths)]
+        parts += [(f"mix_{i}", path, mix_format) for i, path in enumerate(mix_paths)]
+        completed = False
+        try:
+            with trace.span("stream"):
+                for name, path, part_format in parts:
+                    yield (
+                        f"--{boundary}\r\n"
+                        f'Content-Disposition: form-data; name="{name}"; filename="{name}.{part_format}"\r\n'
+                        f"Content-Type: {AUDIO_MEDIA_TYPES.get(part_format, 'application/octet-stream')}\r\n\r\n"
+                    ).encode()
+                    count_sent(path)
+                    yield from iter_file(path)
+                    yield b"\r\n"
+            if probe:
+                meta["memory"] = probe.stop()
+            annotate(meta)
+            yield (
+                f"--{boundary}\r\n"
+                f'Content-Disposition: form-data; name="meta"\r\n'
+                f"Content-Type: application/json\r\n\r\n"
+                f"{json.dumps(meta)}\r\n"
+                f"--{boundary}--\r\n"
+            ).encode()
+            completed = True
+        finally:
+            remove_files(paths + mix_paths)
+            if probe:
+                probe.stop()
+            trace.finish("succeeded" if completed else "aborted")
+
+    if mode == "audio":
+        # Single-body mode carries the first output only; batches need multipart
+        if not paths:
+            remove_files(mix_paths)
+            meta.update(status="failed", error="No outputs produced")
+            annotate(meta)
+            trace.finish("failed", "NoOutputs")
+            return meta
+        return StreamingResponse(
+            stream_audio(),
+            media_type=media_type,
+            headers={
+                "X-Output-Count": str(len(paths)),
+                "X-Audio-Format": audio_format,
+                "X-Request-ID": trace.id,
+            },
+        )
+
+    boundary = uuid.uuid4().hex
+    return StreamingResponse(
+        stream_multipart(boundary),
+        media_type=f"multipart/form-data; boundary={boundary}",
+        headers={"X-Request-ID": trace.id},
+    )
+
+
+# ---------------------------------------------------------------------------
+# Progress Events
+# ---------------------------------------------------------------------------
+
+SSE_KEEPALIVE_INTERVAL = 15  # Seconds between keepalive comments on a quiet event stream
+
+
+class ProgressReporter:
+    """
+    Structured progress events for one request.
+
+    emit() runs on worker threads, including once per DiT step, so it only
+    stamps the event and hands it to `sink`; formatting and I/O happen on the
+    consuming side. Events stop once the reporter is closed.
+    """
+
+    def __init__(self, sink):
+        self._sink = sink
+        self.started = time.perf_counter()
+        self.closed = False
+
+    def emit(self, event: str, **data):
+        if self.closed:
+            return
+        data["t_ms"] = round((time.perf_counter() - self.started) * 1000, 1)
+        self._sink(event, data)
+
+
+def emit_all(reporters, event: str, **data):
+    for reporter in reporters:
+        reporter.emit(event, **data)
+
+
+class PipelineProgress:
+    """
+    Progress callable for generate_music, shaped like the gradio Progress it
+    expects: progress(value, desc=...) plus a pass-through tqdm().
+    """
+
+    def __init__(self, reporters):
+        self.reporters = reporters
+
+    def __call__(self, value=None, desc=None, *args, **kwargs):
+        fraction = value if isinstance(value, (int, float)) else None
+        emit_all(self.reporters, "progress", value=fraction, desc=desc)
+
+    def tqdm(self, iterable, *args, **kwargs):
+        return iterable
+
+
+@contextlib.contextmanager
+def watch_dit_steps(handler, on_pass):
+    """
+    Call on_pass(n) after the DiT decoder's n-th forward pass, if it can be
+    hooked. DitStepCounter turns passes into scheduler steps.
+    """
+    import itertools
+
+    decoder = getattr(getattr(handler, "model", None), "decoder", None)
+    if decoder is None or not hasattr(decoder, "register_forward_hook"):
+        yield
+        return
+    # The hook runs as the forward is queued, so it adds no GPU sync
+    count = itertools.count(1)
+    hook = decoder.register_forward_hook(lambda *_: on_pass(next(count)))
+    try:
+        yield
+    finally:
+        hook.remove()
+
+
+class DitStepCounter:
+    """
+    Maps DiT decoder forward passes to diffusion steps.
+
+    With CFG or ADG a step runs more than one pass (and fewer outside the cfg
+    interval), so the passes per step of each guidance setup are learned from
+    its last finished run. Until then a guided setup assumes two passes per
+    step and an unguided one a single pass.
+    """
+
+    def __init__(self):
+        self._passes_per_step = {}  # guidance setup -> passes / steps of its last run
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def setup(params) -> tuple:
+        return (
+            params.inference_steps, params.guidance_scale, params.use_adg,
+            params.cfg_interval_start, params.cfg_interval_end, params.infer_method,
+        )
+
+    def passes_per_step(self, params) -> float:
+        with self._lock:
+            learned = self._passes_per_step.get(self.setup(params))
+        if learned:
+            return learned
+        return 2.0 if params.guidance_scale > 1 or params.use_adg else 1.0
+
+    def record(self, params, passes: int):
+        if passes and params.inference_steps:
+            with self._lock:
+                self._passes_per_step[self.setup(params)] = passes / params.inference_steps
+
+
+def describe_progress(event: str, data: dict) -> str:
+    """One-line progress_text for query_result."""
+    if event == "dit_step":
+        return f"Diffusion step {data['step']}/{data['total']}"
+    if event == "progress":
+        return data.get("desc") or "Generating..."
+    return {
+        "lm_load": "Loading language model...",
+        "lora": "Applying LoRA...",
+        "generate": "Generating...",
+        "window": "Generating edited region...",
+        "postprocess": "Isolating stem...",
+        "transcode": "Compressing outputs...",
+        "encode": "Encoding outputs...",
+    }.get(event, "Generating...")
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# ---------------------------------------------------------------------------
+# Observability
+# ---------------------------------------------------------------------------
+
+# Upper bounds (seconds) of the latency histogram buckets
+METRIC_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+
+def log(message: str):
+    """Print a [Modal] log line tagged with the current request id, if any."""
+    request_id = _request_id.get()
+    print(f"[Modal] [{request_id}] {message}" if request_id else f"[Modal] {message}")
+
+
+class RequestTrace:
+    """
+    Timing spans (ms) and counters for one request, identified by its request id.
+
+    Spans with the same name add up, so a phase that runs several times (e.g.
+    per cascade step) reports its total. finish() runs `on_finish` once, when
+    the response has been fully produced.
+    """
+
+    def __init__(self, request_id: str = None):
+        self.id = request_id or uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.spans = {}
+        self.attrs = {"bytes_in": 0, "bytes_out": 0}
+        self.on_finish = None
+        self._finished = False
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.spans[name] = round(self.spans.get(name, 0.0) + seconds * 1000, 2)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.spans, "total": round((time.perf_counter() - self.started) * 1000, 2)}
+
+    def finish(self, status: str, error_type: str = None):
+        with self._lock:
+            if self._finished:
+                return
+            self._finished = True
+        self.attrs.update(status=status, error_type=error_type)
+        if self.on_finish:
+            self.on_finish(self)
+
+
+def metric_value(value) -> str:
+    """A sample value in full: integral values without a fraction, others as repr(float)."""
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def metric_label(value) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text format.
+
+    Values are per container; Prometheus sums them across containers.
+    """
+
+    def __init__(self, buckets=METRIC_BUCKETS):
+        self.buckets = buckets
+        self._counters = collections.defaultdict(float)  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [per-bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def record(self, trace: RequestTrace, endpoint: str):
+        """Fold a finished request's trace into the aggregates."""
+        status = trace.attrs.get("status") or "unknown"
+        self.inc("acestep_requests_total", endpoint=endpoint, status=status)
+        if status != "succeeded" and trace.attrs.get("error_type"):
+            self.inc("acestep_request_failures_total", endpoint=endpoint, error_type=trace.attrs["error_type"])
+        if trace.attrs.get("cache"):
+            self.inc("acestep_result_cache_requests_total", result=trace.attrs["cache"])
+        if trace.attrs.get("lm_cache"):
+            self.inc("acestep_lm_cache_requests_total", result=trace.attrs["lm_cache"])
+        if trace.attrs.get("encoding"):
+            for encoding in filter(None, (trace.attrs["encoding"], trace.attrs["encoding"].get("mix"))):
+                self.inc("acestep_encoded_bytes_total", encoding["bytes"], format=encoding["format"])
+                for output in encoding["outputs"]:
+                    self.observe("acestep_encode_seconds", output["encode_ms"] / 1000, format=encoding["format"])
+        self.inc("acestep_input_bytes_total", trace.attrs["bytes_in"], endpoint=endpoint)
+        self.inc("acestep_output_bytes_total", trace.attrs["bytes_out"], endpoint=endpoint)
+        spans = trace.snapshot()
+        self.observe("acestep_request_seconds", spans.pop("total") / 1000, endpoint=endpoint)
+        for phase, ms in spans.items():
+            self.observe("acestep_phase_seconds", ms / 1000, phase=phase)
+
+    def render(self, gauges: dict = None) -> str:
+        def series(name, labels, value, extra=()):
+            pairs = list(labels) + list(extra)
+            label_text = "{" + ",".join(f'{k}="{metric_label(v)}"' for k, v in pairs) + "}" if pairs else ""
+            return f"{name}{label_text} {metric_value(value)}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(values)) for key, values in self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            lines.append(series(name, labels, value))
+        for (name, labels), values in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} histogram")
+            for bound, count in zip(self.buckets, values):
+                lines.append(series(f"{name}_bucket", labels, count, [("le", metric_value(bound))]))
+            lines.append(series(f"{name}_bucket", labels, values[-1], [("le", "+Inf")]))
+            lines.append(series(f"{name}_sum", labels, values[-2]))
+            lines.append(series(f"{name}_count", labels, values[-1]))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {metric_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+# ---------------------------------------------------------------------------
+# Output Encoding
+# ---------------------------------------------------------------------------
+
+ENCODE_FORMATS = ("wav", "mp3", "flac", "opus")
+ENCODE_WORKERS = int(os.environ.get("ACESTEP_ENCODE_WORKERS", "4"))  # Concurrent ffmpeg encodes per container
+ENCODE_DEFAULT_BITRATES = {"mp3": 192, "opus": 96}  # kb/s
+ENCODE_BITRATE_RANGES = {"mp3": (32, 320), "opus": (6, 510)}
+FLAC_DEFAULT_COMPRESSION = 5
+FLAC_MAX_COMPRESSION = 12
+
+
+def encoding_options(request: dict) -> dict:
+    """
+    Normalize "audio_format" and the optional "encoding" request field.
+
+    "encoding" is {"bitrate_kbps"} for mp3 / opus or {"compression_level"}
+    (0-12) for flac; out-of-range values are clamped. Raises ValueError for
+    formats that cannot be produced.
+    """
+    audio_format = str(request.get("audio_format") or "mp3").lower()
+    if audio_format not in ENCODE_FORMATS:
+        raise ValueError(f"audio_format must be one of {', '.join(ENCODE_FORMATS)}")
+    options = request.get("encoding")
+    if not isinstance(options, dict):
+        options = {}
+    encoding = {"format": audio_format}
+    if audio_format in ENCODE_BITRATE_RANGES:
+        low, high = ENCODE_BITRATE_RANGES[audio_format]
+        bitrate = int(options.get("bitrate_kbps") or ENCODE_DEFAULT_BITRATES[audio_format])
+        encoding["bitrate_kbps"] = max(low, min(bitrate, high))
+    elif audio_format == "flac":
+        level = int(options.get("compression_level", FLAC_DEFAULT_COMPRESSION))
+        encoding["compression_level"] = max(0, min(level, FLAC_MAX_COMPRESSION))
+    return encoding
+
+
+def encode_audio(wav_path: str, out_path: str, encoding: dict):
+    """Encode a WAV to encoding["format"] with ffmpeg."""
+    import subprocess
+
+    codec = {
+        "mp3": ["-c:a", "libmp3lame", "-b:a", f"{encoding.get('bitrate_kbps')}k"],
+        "opus": ["-c:a", "libopus", "-b:a", f"{encoding.get('bitrate_kbps')}k"],
+        "flac": ["-c:a", "flac", "-compression_level", str(encoding.get("compression_level"))],
+    }[encoding["format"]]
+    proc = subprocess.run(
+        ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", wav_path, *codec, out_path],
+        capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg {encoding['format']} encode failed: {proc.stderr.strip()[-500:]}")
+
+
+class OutputEncoder:
+    """
+    Bounded pool that encodes generated WAVs into the requested format.
+
+    generate_music only writes WAV, which is cheap, while it holds the GPU;
+    MP3 / FLAC / Opus encoding and removal of the WAVs happen here once the
+    GPU is free, so the next request's pass overlaps this one's encoding.
+    ffmpeg runs as a child process, so worker threads spread the encodes over
+    the container's cores.
+    """
+
+    def __init__(self, workers=ENCODE_WORKERS):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode")
+        self._lock = threading.Lock()
+        self.stats = {fmt: {"outputs": 0, "bytes": 0, "encode_seconds": 0.0} for fmt in ENCODE_FORMATS}
+
+    def encode(self, paths: list, encoding: dict, temp_dir: str) -> tuple:
+        """
+        Encode outputs concurrently and remove the WAVs. Returns the new paths
+        and a report of the format with per-output size and encode time.
+        """
+        audio_format = encoding["format"]
+        started = time.perf_counter()
+        if audio_format == "wav":
+            outputs = [(path, 0.0) for path in paths]
+        else:
+            futures = [
+                self._pool.submit(self._encode_one, path, new_temp_path(temp_dir, "encoded", audio_format), encoding)
+                for path in paths
+            ]
+            outputs, error = [], None
+            for future in futures:
+                try:
+                    outputs.append(future.result())
+                except Exception as e:
+                    error = error or e
+            if error:
+                remove_files([path for path, _ in outputs])
+                raise error
+
+        report = {
+            **encoding,
+            "encode_ms": round((time.perf_counter() - started) * 1000, 1),
+            "outputs": [
+                {"bytes": os.path.getsize(path), "encode_ms": round(seconds * 1000, 1)} for path, seconds in outputs
+            ],
+        }
+        report["bytes"] = sum(output["bytes"] for output in report["outputs"])
+        with self._lock:
+            totals = self.stats[audio_format]
+            totals["outputs"] += len(outputs)
+            totals["bytes"] += report["bytes"]
+            totals["encode_seconds"] += sum(seconds for _, seconds in outputs)
+        return [path for path, _ in outputs], report
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                fmt: {**totals, "encode_seconds": round(totals["encode_seconds"], 3)}
+                for fmt, totals in self.stats.items() if totals["outputs"]
+            }
+
+    def _encode_one(self, wav_path: str, out_path: str, encoding: dict) -> tuple:
+        started = time.perf_counter()
+        try:
+            encode_audio(wav_path, out_path, encoding)
+        except Exception:
+            remove_files([out_path])
+            raise
+        finally:
+            remove_files([wav_path])
+        return out_path, time.perf_counter() - started
+
+
+# ---------------------------------------------------------------------------
+# Result Cache
+# ---------------------------------------------------------------------------
+
+RESULT_CACHE_MAX_BYTES = 20 * 1024 ** 3  # Encoded outputs kept on the cache volume
+RESULT_CACHE_HOT_BYTES = 512 * 1024 ** 2  # Encoded outputs kept in container memory
+
+FILE_HASH_MEMO_MAX_ENTRIES = 4096  # file_sha256 results kept, least recently used dropped first
+
+_file_hashes = collections.OrderedDict()  # (dev, inode, size, mtime) -> sha256
+_file_hashes_lock = threading.Lock()
+
+
+def _file_memo_key(path: str):
+    # Keyed on the inode, so hard links to one file share a memo entry
+    stat = os.stat(path)
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+def _memoize_file_sha256(memo_key: tuple, sha256: str):
+    with _file_hashes_lock:
+        _file_hashes[memo_key] = sha256
+        _file_hashes.move_to_end(memo_key)
+        while len(_file_hashes) > FILE_HASH_MEMO_MAX_ENTRIES:
+            _file_hashes.popitem(last=False)
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file, memoized on (inode, size, mtime) for large, stable files."""
+    memo_key = _file_memo_key(path)
+    with _file_hashes_lock:
+        if memo_key in _file_hashes:
+            _file_hashes.move_to_end(memo_key)
+            return _file_hashes[memo_key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(STREAM_CHUNK_SIZE):
+            digest.update(chunk)
+    _memoize_file_sha256(memo_key, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def remember_file_sha256(path: str, sha256: str):
+    """Seed the file_sha256 memo for a file whose hash is already known."""
+    _memoize_file_sha256(_file_memo_key(path), sha256)
+
+
+def forget_file_sha256(path: str):
+    """
+    Drop a file's memo entry before its last link is removed, since the
+    filesystem may hand the freed inode to a new file.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    if stat.st_nlink <= 1:
+        with _file_hashes_lock:
+            _file_hashes.pop((stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns), None)
+
+
+def canonical_hash(fields: dict) -> str:
+    """Stable hash of a JSON-serializable dict, independent of key order."""
+    blob = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of finished generation results.
+
+    An entry holds what the request got back: its outputs, plus the stem info
+    and full mixes of post-processed requests. Entries live on the cache
+    volume as `<root>/<key>/output_<i>.<format>` (and `mix_<i>.<format>`) with
+    a meta.json. Recently used entries are also kept in memory up to
+    `hot_bytes`. Every hit touches the entry's directory, and evict() rebuilds
+    the size index from a listing of the volume with those mtimes, so the
+    `max_bytes` bound and least-recently-used order hold for the volume as a
+    whole rather than per container.
+    """
+
+    def __init__(self, root: str, max_bytes=RESULT_CACHE_MAX_BYTES, hot_bytes=RESULT_CACHE_HOT_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hot_bytes = hot_bytes
+        self.stats = {"hot_hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "evictions": 0}
+        self._hot = collections.OrderedDict()  # key -> (meta, [bytes, ...])
+        self._hot_size = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._index = self._scan()  # key -> (size, last_used), as of the last scan or put
+
+    def get(self, key: str, temp_dir: str):
+        """
+        Copy a cached entry's outputs to fresh temp files. Returns the result
+        fields it was stored with ("paths", "format" and, if present, "stems",
+        "mix_paths", "mix_format"), or None.
+        """
+        with self._lock:
+            hot = self._hot.get(key)
+            if hot is not None:
+                self._hot.move_to_end(key)
+                self.stats["hot_hits"] += 1
+        if hot is not None:
+            self._touch(key)
+            meta, outputs = hot
+            result = self._result(meta)
+            for (field, name), data in zip(self._entry_files(meta), outputs):
+                result[field].append(new_temp_path(temp_dir, "cached", name.rsplit(".", 1)[1]))
+                with open(result[field][-1], "wb") as f:
+                    f.write(data)
+            return result
+
+        entry_dir = os.path.join(self.root, key)
+        copied = []
+        try:
+            with open(os.path.join(entry_dir, "meta.json")) as f:
+                meta = json.load(f)
+            result = self._result(meta)
+            for field, name in self._entry_files(meta):
+                copied.append(new_temp_path(temp_dir, "cached", name.rsplit(".", 1)[1]))
+                shutil.copyfile(os.path.join(entry_dir, name), copied[-1])
+                result[field].append(copied[-1])
+        except (OSError, KeyError, ValueError):
+            remove_files(copied)
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+
+        self._touch(key)
+        with self._lock:
+            self.stats["disk_hits"] += 1
+        self._remember(key, meta, copied)
+        return result
+
+    def put(self, key: str, result: dict):
+        """Store copies of a finished result's outputs and stem info under `key`."""
+        meta = {"format": result["format"], "count": len(result["paths"]), "created_at": time.time()}
+        if result.get("mix_paths"):
+            meta.update(mix_format=result["mix_format"], mix_count=len(result["mix_paths"]))
+        if "stems" in result:
+            meta["stems"] = result["stems"]
+        paths = result["paths"] + result.get("mix_paths", [])
+
+        staging_dir = os.path.join(self.root, f".tmp_{uuid.uuid4().hex}")
+        os.makedirs(staging_dir)
+        for (_, name), path in zip(self._entry_files(meta), paths):
+            shutil.copyfile(path, os.path.join(staging_dir, name))
+        with open(os.path.join(staging_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        entry_dir = os.path.join(self.root, key)
+        try:
+            os.rename(staging_dir, entry_dir)
+        except OSError:
+            # Another request stored the same key first
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            return
+        size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+        with self._lock:
+            self._index[key] = (size, time.time())
+        self._remember(key, meta, paths)
+
+    def bypass(self):
+        with self._lock:
+            self.stats["bypassed"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "entries": len(self._index),
+                "bytes": sum(size for size, _ in self._index.values()),
+                "hot_entries": len(self._hot),
+                "hot_bytes": self._hot_size,
+            }
+
+    @staticmethod
+    def _entry_files(meta: dict) -> list:
+        """(result field, file name) of each file of an entry, in storage order."""
+        files = [("paths", f"output_{i}.{meta['format']}") for i in range(meta["count"])]
+        files += [("mix_paths", f"mix_{i}.{meta['mix_format']}") for i in range(meta.get("mix_count", 0))]
+        return files
+
+    @staticmethod
+    def _result(meta: dict) -> dict:
+        result = {"format": meta["format"], "paths": []}
+        if meta.get("mix_count"):
+            result.update(mix_format=meta["mix_format"], mix_paths=[])
+        if "stems" in meta:
+            result["stems"] = meta["stems"]
+        return result
+
+    def _remember(self, key: str, meta: dict, paths: list):
+        """Add an entry to the in-memory tier, evicting older hot entries."""
+        size = sum(os.path.getsize(p) for p in paths)
+        if size > self.hot_bytes:
+            return
+        outputs = []
+        for path in paths:
+            with open(path, "rb") as f:
+                outputs.append(f.read())
+        with self._lock:
+            if key in self._hot:
+                return
+            self._hot[key] = (meta, outputs)
+            self._hot_size += size
+            while self._hot_size > self.hot_bytes:
+                _, (_, evicted) = self._hot.popitem(last=False)
+                self._hot_size -= sum(len(data) for data in evicted)
+
+    def evict(self) -> bool:
+        """
+        Bring the volume's entries, stored by any container, within max_bytes.
+        Call after committing this container's puts; returns whether entries
+        were removed, which then need committing too.
+        """
+        try:
+            CACHE_VOLUME.reload()
+        except Exception:
+            pass  # Files held open in this container; entries stored elsewhere wait for a later scan
+        index = self._scan()
+        total = sum(size for size, _ in index.values())
+        victims = []
+        for key, (size, _) in sorted(index.items(), key=lambda item: item[1][1]):
+            if total <= self.max_bytes:
+                break
+            victims.append(key)
+            total -= size
+            del index[key]
+        for key in victims:
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+        with self._lock:
+            self._index = index
+            self.stats["evictions"] += len(victims)
+            for key in victims:
+                if key in self._hot:
+                    self._hot_size -= sum(len(data) for data in self._hot.pop(key)[1])
+        return bool(victims)
+
+    def _scan(self) -> dict:
+        """Size and last use (directory mtime) of every entry on the volume."""
+        index = {}
+        for key in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, key)
+            if key.startswith(".") or not os.path.isdir(entry_dir):
+                continue
+            try:
+                with os.scandir(entry_dir) as files:
+                    size = sum(f.stat().st_size for f in files)
+                index[key] = (size, os.path.getmtime(entry_dir))
+            except OSError:
+                continue  # Evicted by another container meanwhile
+        return index
+
+    def _touch(self, key: str):
+        """Mark an entry used, for the least-recently-used order of every container."""
+        try:
+            os.utime(os.path.join(self.root, key))
+        except OSError:
+            return
+        with self._lock:
+            if key in self._index:
+                self._index[key] = (self._index[key][0], time.time())
+
+
+# ---------------------------------------------------------------------------
+# LM Output Cache
+# ---------------------------------------------------------------------------
+
+LM_CACHE_MAX_ENTRIES = 512  # LM outputs kept in container memory
+LM_CACHE_MAX_BYTES = 1024 ** 3  # LM outputs kept on the cache volume
+LM_CACHE_PERSIST = os.environ.get("ACESTEP_LM_CACHE_PERSIST", "0") == "1"  # Also keep them on the cache volume
+# LLMHandler methods whose results (CoT metas, caption rewrites, audio codes) are memoized
+LM_CACHED_METHODS = tuple(os.environ.get("ACESTEP_LM_CACHED_METHODS", "generate_with_stop_condition").split(","))
+# GenerationParams fields the LM stage reads; the DiT-only ones (seed,
+# guidance, shift, steps, repainting range) are left out of the key
+LM_KEY_FIELDS = (
+    "task_type", "instruction", "caption", "lyrics", "instrumental", "vocal_language",
+    "bpm", "keyscale", "timesignature", "duration", "thinking",
+    "lm_temperature", "lm_cfg_scale", "lm_top_k", "lm_top_p", "lm_negative_prompt",
+    "use_cot_metas", "use_cot_caption", "use_cot_language", "use_constrained_decoding",
+)
+
+
+class LMOutputCache:
+    """
+    Memoizes the 5Hz LM stage, so DiT-only re-rolls skip the 4B LM.
+
+    Wraps the LM handler's generation methods. Calls are served from the cache
+    only inside a scope() opened with an explicit LM seed and a key() built
+    from the LM fields of the request's GenerationParams, the output count and
+    that seed, so a request that changes only the DiT seed, guidance, shift or
+    steps reuses the LM output. The n-th call of a method within a scope is
+    stored under the scope key and n. Misses run with the LM seed, passed to
+    the method if it takes a `seed` and set on torch's RNG (which the PyTorch
+    and nano-vllm samplers draw from) for the call.
+
+    With `root` on the cache volume, outputs are shared with other containers
+    and evicted least-recently-used once the directory exceeds `max_bytes`.
+
+    generate_music calls are serialized by the GPU lock, so at most one scope
+    is open at a time.
+    """
+
+    def __init__(self, root: str = None, max_entries=LM_CACHE_MAX_ENTRIES, max_bytes=LM_CACHE_MAX_BYTES):
+        self.root = root
+        if root:
+            os.makedirs(root, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # key -> output
+        self._lock = threading.Lock()
+        self._scope = None
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "bypassed": 0, "evictions": 0}
+
+    def wrap(self, llm_handler, methods=LM_CACHED_METHODS):
+        """Replace the named LM handler methods with caching versions."""
+        wrapped = []
+        for name in methods:
+            method = getattr(llm_handler, name, None)
+            if callable(method):
+                setattr(llm_handler, name, self._cached(name, method))
+                wrapped.append(name)
+        if wrapped:
+            print(f"[Modal] LM output cache on: {', '.join(wrapped)}")
+        else:
+            print(f"[Modal] WARNING: LM output cache off: LM handler has none of {', '.join(methods)}")
+
+    @staticmethod
+    def key(params, batch_size: int, seed) -> str:
+        """Scope key of a request's LM stage: its LM fields, output count and seed."""
+        fields = {name: getattr(params, name, None) for name in LM_KEY_FIELDS}
+        src_audio = getattr(params, "src_audio", None)
+        fields["src_audio"] = file_sha256(src_audio) if src_audio else None
+        return canonical_hash({"lm": fields, "batch_size": batch_size, "lm_seed": seed})
+
+    @contextlib.contextmanager
+    def scope(self, key, seed):
+        """
+        Cache LM calls made inside the block under `key`, sampling them with
+        `seed` (a None key bypasses the cache). Yields a dict whose "status"
+        ends up "hit", "miss", "bypass", or None if the LM was not called.
+        """
+        record = {"status": None, "stored": False, "calls": collections.Counter()}
+        self._scope = (key, seed, record)
+        try:
+            yield record
+        finally:
+            self._scope = None
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries)}
+
+    def _cached(self, name: str, method):
+        import copy
+        import functools
+        import inspect
+
+        try:
+            takes_seed = "seed" in inspect.signature(method).parameters
+        except (TypeError, ValueError):
+            takes_seed = False
+
+        @functools.wraps(method)
+        def cached(*args, **kwargs):
+            scope = self._scope
+            if scope is None:
+                return method(*args, **kwargs)
+            scope_key, seed, record = scope
+            if scope_key is None:
+                with self._lock:
+                    self.stats["bypassed"] += 1
+                record["status"] = record["status"] or "bypass"
+                return method(*args, **kwargs)
+
+            key = canonical_hash({"method": name, "call": record["calls"][name], "scope": scope_key})
+            record["calls"][name] += 1
+            value = self._get(key)
+            if value is not None:
+                record["status"] = record["status"] or "hit"
+                return copy.deepcopy(value)
+
+            if takes_seed:
+                kwargs = {**kwargs, "seed": int(seed)}
+            value = self._seeded(method, int(seed), args, kwargs)
+            with self._lock:
+                self.stats["misses"] += 1
+            record["status"] = "miss"
+            self._put(key, copy.deepcopy(value))
+            record["stored"] = bool(self.root)
+            return value
+
+        return cached
+
+    @staticmethod
+    def _seeded(method, seed: int, args, kwargs):
+        """Run an LM call with torch's RNGs seeded, restoring them afterwards for the DiT."""
+        import torch
+
+        devices = list(range(torch.cuda.device_count())) if torch.cuda.is_available() else []
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(seed)
+            return method(*args, **kwargs)
+
+    def _get(self, key: str):
+        import pickle
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._entries[key]
+        if not self.root:
+            return None
+        path = os.path.join(self.root, f"{key}.pkl")
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        with self._lock:
+            self.stats["disk_hits"] += 1
+        self._remember(key, value)
+        return value
+
+    def _put(self, key: str, value):
+        import pickle
+
+        self._remember(key, value)
+        if not self.root:
+            return
+        tmp_path = os.path.join(self.root, f".tmp_{uuid.uuid4().hex}")
+        try:
+            with open(tmp_path, "wb") as f:
+                pickle.dump(value, f)
+            os.replace(tmp_path, os.path.join(self.root, f"{key}.pkl"))
+        except Exception as e:
+            remove_files([tmp_path])
+            log(f"WARNING: LM cache store failed: {e}")
+            return
+        self._evict()
+
+    def _remember(self, key: str, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _evict(self):
+        """Drop the least recently used files once the directory, shared by all containers, is over max_bytes."""
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".pkl"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        victims = []
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            victims.append(name)
+            total -= size
+        remove_files([os.path.join(self.root, name) for name in victims])
+        with self._lock:
+            self.stats["evictions"] += len(victims)
+
+
+# ---------------------------------------------------------------------------
+# Input Audio Store
+# ---------------------------------------------------------------------------
+
+INPUT_STORE_MAX_BYTES = 2 * 1024 ** 3  # Staged input audio kept on local disk for reuse
+DECODED_AUDIO_MAX_BYTES = 1024 ** 3  # Decoded input waveforms kept in host memory
+# AceStepHandler methods that read and resample an input file into a waveform
+# tensor. The image clones ACE-Step's default branch, so check api_health's
+# decoded_audio.loaders after upgrading and adjust this if it is empty
+DECODED_AUDIO_LOADERS = tuple(
+    os.environ.get("ACESTEP_DECODED_AUDIO_LOADERS", "process_src_audio,process_reference_audio").split(",")
+)
+SILENT_LATENT_MAX_ENTRIES = 16  # VAE encodings of all-zero audio, one per input shape
+
+
+class InputStore:
+    """
+    Content-addressed staging area for src / reference audio.
+
+    Each distinct input is written once as `<root>/<sha256>.<ext>` and every
+    request gets its own hard link to it, so callers still remove their inputs
+    when done while repeated context audio (a mix resent for the next lego
+    step, or src_audio doubling as reference_audio) skips the disk write and
+    rehashing. The extension follows the uploaded format, so loaders can tell
+    FLAC / Opus / MP3 from WAV. Least recently used content is evicted past
+    `max_bytes`; links held by in-flight requests stay valid.
+    """
+
+    def __init__(self, temp_dir: str, max_bytes=INPUT_STORE_MAX_BYTES):
+        self.temp_dir = temp_dir
+        self.root = os.path.join(temp_dir, "inputs")
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._index = collections.OrderedDict()  # sha256 -> (size, ext), least recent first
+        self._silence = {}  # frames -> sha256 of the synthesized WAV
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def put_bytes(self, name: str, data: bytes) -> str:
+        """Stage in-memory audio; returns a new path for the caller to remove."""
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        def write(target):
+            with open(target, "wb") as f:
+                f.write(data)
+
+        return self._link(name, sha256, sniff_audio_ext(data[:64]), write)
+
+    def put_file(self, name: str, fileobj) -> str:
+        """Stage audio from a seekable file object, copying it only if new."""
+        digest = hashlib.sha256()
+        head = b""
+        while chunk := fileobj.read(STREAM_CHUNK_SIZE):
+            head = head or chunk[:64]
+            digest.update(chunk)
+        fileobj.seek(0)
+
+        def write(target):
+            with open(target, "wb") as f:
+                shutil.copyfileobj(fileobj, f, STREAM_CHUNK_SIZE)
+
+        return self._link(name, digest.hexdigest(), sniff_audio_ext(head), write)
+
+    def adopt(self, name: str, path: str) -> str:
+        """Move an already-written temp file into the store."""
+        with open(path, "rb") as f:
+            ext = sniff_audio_ext(f.read(64))
+        link = self._link(name, file_sha256(path), ext, lambda target: os.replace(path, target))
+        remove_files([path])
+        return link
+
+    def put_silence(self, name: str, seconds: float) -> str:
+        """
+        Stage `seconds` of silence as a WAV at SILENCE_SAMPLE_RATE.
+
+        The file is written sparse, and its hash is computed once per length,
+        so every later request for the same duration is a hard link.
+        """
+        frames = round(seconds * SILENCE_SAMPLE_RATE)
+        header = wav_header(frames, SILENCE_SAMPLE_RATE, SILENCE_CHANNELS)
+        size = len(header) + frames * SILENCE_CHANNELS * 2
+        with self._lock:
+            sha256 = self._silence.get(frames)
+        if sha256 is None:
+            digest = hashlib.sha256(header)
+            zeros = memoryview(bytes(STREAM_CHUNK_SIZE))
+            for offset in range(len(header), size, STREAM_CHUNK_SIZE):
+                digest.update(zeros[:min(STREAM_CHUNK_SIZE, size - offset)])
+            sha256 = digest.hexdigest()
+            with self._lock:
+                self._silence[frames] = sha256
+
+        def write(target):
+            with open(target, "wb") as f:
+                f.write(header)
+                f.truncate(size)
+
+        return self._link(name, sha256, "wav", write)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                **self.stats,
+                "entries": len(self._index),
+                "bytes": sum(size for size, _ in self._index.values()),
+            }
+
+    def _link(self, name: str, sha256: str, ext: str, write) -> str:
+        path = new_temp_path(self.temp_dir, name, ext)
+        with self._lock:
+            if sha256 in self._index:
+                self._index.move_to_end(sha256)
+                self.stats["hits"] += 1
+                os.link(os.path.join(self.root, f"{sha256}.{self._index[sha256][1]}"), path)
+                return path
+            self.stats["misses"] += 1
+
+        canonical = os.path.join(self.root, f"{sha256}.{ext}")
+
+        partial = new_temp_path(self.root, "partial")
+        try:
+            write(partial)
+            os.replace(partial, canonical)
+        except Exception:
+            remove_files([partial])
+            raise
+        remember_file_sha256(canonical, sha256)
+        with self._lock:
+            self._index[sha256] = (os.path.getsize(canonical), ext)
+            os.link(canonical, path)
+            self._evict()
+        return path
+
+    def _evict(self):
+        # Caller holds self._lock
+        total = sum(size for size, _ in self._index.values())
+        while total > self.max_bytes and len(self._index) > 1:
+            sha256, (size, ext) = self._index.popitem(last=False)
+            remove_files([os.path.join(self.root, f"{sha256}.{ext}")])
+            total -= size
+            self.stats["evictions"] += 1
+
+
+class DecodedAudioCache:
+    """
+    LRU of decoded input waveforms, keyed by loader, input content hash and
+    the loader's scalar options.
+
+    Wraps the handler's audio loaders so generate_music skips decoding and
+    resampling context audio it has seen recently. Tensors are held on the
+    CPU and handed out as copies, since the pipeline may modify them.
+    """
+
+    def __init__(self, max_bytes=DECODED_AUDIO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()  # (loader, sha256) -> (tensor, device, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.loaders = []
+        self.stats = {"hits": 0, "misses": 0, "uncached_calls": 0}
+
+    def wrap(self, handler, loaders=DECODED_AUDIO_LOADERS):
+        """Replace the named handler methods with caching versions."""
+        for name in loaders:
+            loader = getattr(handler, name, None)
+            if callable(loader):
+                setattr(handler, name, self._cached(name, loader))
+                self.loaders.append(name)
+        if self.loaders:
+            print(f"[Modal] Decoded audio cache on: {', '.join(self.loaders)}")
+            return
+        audio_methods = sorted(
+            name for name in dir(handler) if "audio" in name and not name.startswith("__")
+            and callable(getattr(handler, name, None))
+        )
+        print(
+            f"[Modal] WARNING: Decoded audio cache off: handler has none of {', '.join(loaders)}. "
+            f"Its audio methods are: {', '.join(audio_methods) or 'none'}; set ACESTEP_DECODED_AUDIO_LOADERS "
+            f"to the ones that load an input file"
+        )
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries), "bytes": self._bytes, "loaders": list(self.loaders)}
+
+    def _cached(self, name: str, loader):
+        import functools
+        import torch
+
+        scalars = (int, float, str, bool, type(None))
+
+        @functools.wraps(loader)
+        def load(audio_file, *args, **kwargs):
+            # Options like a target sample rate are part of the key; tensors
+            # and other objects cannot be compared cheaply, so skip the cache
+            if (not isinstance(audio_file, str) or not os.path.isfile(audio_file)
+                    or not all(isinstance(v, scalars) for v in (*args, *kwargs.values()))):
+                with self._lock:
+                    self.stats["uncached_calls"] += 1
+                return loader(audio_file, *args, **kwargs)
+            key = (name, file_sha256(audio_file), args, tuple(sorted(kwargs.items())))
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+            if entry is not None:
+                tensor, device, _ = entry
+                return tensor.to(device, copy=True)
+
+            value = loader(audio_file, *args, **kwargs)
+            with self._lock:
+                self.stats["misses"] += 1
+            if not isinstance(value, torch.Tensor):
+                return value
+            size = value.element_size() * value.nelement()
+            if size > self.max_bytes:
+                return value
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = (value.detach().to("cpu", copy=True), value.device, size)
+                    self._bytes += size
+                while self._bytes > self.max_bytes:
+                    _, (_, _, evicted) = self._entries.popitem(last=False)
+                    self._bytes -= evicted
+            return value
+
+        return load
+
+
+class SilentLatentCache:
+    """
+    Memoizes the VAE encoding of all-zero audio, keyed by input shape.
+
+    The first track of a project is generated against silence, so its context
+    encodes to the same latents for a given duration (or tile size, when the
+    handler encodes in tiles). Checking a waveform for silence costs far less
+    than a VAE pass; non-silent input goes to the encoder as before.
+    """
+
+    def __init__(self, max_entries=SILENT_LATENT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()  # (shape, dtype, device, args) -> encoder output
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def wrap(self, handler):
+        """Replace handler.vae.encode with a caching version."""
+        vae = getattr(handler, "vae", None)
+        encode = getattr(vae, "encode", None)
+        if not callable(encode):
+            print("[Modal] Silent latent cache off: handler has no vae.encode")
+            return
+        vae.encode = self._cached(encode)
+        print("[Modal] Silent latent cache on: vae.encode")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {**self.stats, "entries": len(self._entries)}
+
+    def _cached(self, encode):
+        import functools
+        import torch
+
+        def fresh(value):
+            # Plain tensor results may be modified in place by the caller
+            return value.clone() if isinstance(value, torch.Tensor) else value
+
+        @functools.wraps(encode)
+        def cached_encode(audio, *args, **kwargs):
+            if not isinstance(audio, torch.Tensor) or bool(audio.any()):
+                return encode(audio, *args, **kwargs)
+            key = (tuple(audio.shape), str(audio.dtype), str(audio.device), args, tuple(sorted(kwargs.items())))
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return fresh(self._entries[key])
+                self.stats["misses"] += 1
+            value = encode(audio, *args, **kwargs)
+            with self._lock:
+                self._entries[key] = fresh(value)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            return value
+
+        return cached_encode
+
+
+# ---------------------------------------------------------------------------
+# Stem Post-processing
+# ---------------------------------------------------------------------------
+
+POSTPROCESS_DEFAULT_PEAKS = 200
+POSTPROCESS_MAX_PEAKS = 8192
+
+
+def postprocess_options(request: dict):
+    """
+    Normalize the optional "postprocess" request field.
+
+    Accepts true or {"isolate", "trim", "peaks", "include_mix"}; returns None
+    when post-processing was not asked for.
+    """
+    options = request.get("postprocess")
+    if not options:
+        return None
+    if not isinstance(options, dict):
+        options = {}
+    return {
+        "isolate": bool(options.get("isolate", True)),
+        "trim": bool(options.get("trim", True)),
+        "peaks": max(0, min(int(options.get("peaks", POSTPROCESS_DEFAULT_PEAKS)), POSTPROCESS_MAX_PEAKS)),
+        "include_mix": bool(options.get("include_mix", False)),
+    }
+
+
+def isolate_stem(mix_path: str, src_path, start: float, end, num_peaks: int, stem_path: str) -> dict:
+    """
+    Write the track a lego step added to a 16-bit WAV at `stem_path`.
+
+    Matches the DAW's client-side processing: the src mix (if any) is
+    subtracted from the generated mix, with missing channels and samples
+    treated as silence, then the result is cut to [start, end) seconds.
+    Peaks are the min / max of channel 0 over `num_peaks` equal windows.
+    """
+    import numpy as np
+    import soundfile as sf
+
+    mix, sample_rate = sf.read(mix_path, dtype="float32", always_2d=True)
+    if src_path:
+        src, src_rate = sf.read(src_path, dtype="float32", always_2d=True)
+        if src_rate != sample_rate:
+            import librosa
+            src = librosa.resample(src.T, orig_sr=src_rate, target_sr=sample_rate).T
+        frames = min(len(mix), len(src))
+        channels = min(mix.shape[1], src.shape[1])
+        mix[:frames, :channels] -= src[:frames, :channels]
+
+    first = min(int(start * sample_rate), len(mix)) if start else 0
+    last = len(mix) if end is None or end < 0 else min(int(end * sample_rate), len(mix))
+    stem = mix[first:max(last, first + 1)]
+    if len(stem) == 0:
+        stem = np.zeros((1, mix.shape[1]), dtype=np.float32)
+    sf.write(stem_path, stem, sample_rate, subtype="PCM_16")
+
+    peaks = {"min": [], "max": []}
+    window = len(stem) // num_peaks if num_peaks else 0
+    if window > 0:
+        windows = stem[:window * num_peaks, 0].reshape(num_peaks, window)
+        peaks = {
+            "min": np.round(windows.min(axis=1), 4).tolist(),
+            "max": np.round(windows.max(axis=1), 4).tolist(),
+        }
+    elif num_peaks:
+        peaks = {"min": [0.0] * num_peaks, "max": [0.0] * num_peaks}
+    return {
+        "start": first / sample_rate,
+        "end": (first + len(stem)) / sample_rate,
+        "sample_rate": sample_rate,
+        "frames": len(stem),
+        "peaks": peaks,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Windowed Generation
+# ---------------------------------------------------------------------------
+
+WINDOW_TASKS = ("lego", "repaint")
+WINDOW_DEFAULT_MARGIN = 10.0  # Seconds of context kept either side of the repaint region
+WINDOW_DEFAULT_CROSSFADE = 1.0  # Seconds blended at each splice, inside the margin
+WINDOW_MIN_SECONDS = 10.0  # Shortest span the DiT is asked to generate
+
+
+def window_options(request: dict):
+    """
+    Normalize the optional "window" request field.
+
+    Accepts true or {"margin", "crossfade"} in seconds; returns None when
+    windowed generation was not asked for or the task has no repaint region.
+    """
+    options = request.get("window")
+    if not options or request.get("task_type") not in WINDOW_TASKS:
+        return None
+    if not isinstance(options, dict):
+        options = {}
+    margin = max(0.0, float(options.get("margin", WINDOW_DEFAULT_MARGIN)))
+    crossfade = max(0.0, float(options.get("crossfade", WINDOW_DEFAULT_CROSSFADE)))
+    return {"margin": margin, "crossfade": min(crossfade, margin)}
+
+
+def plan_window(src_path: str, duration, start: float, end, options: dict):
+    """
+    Pick the span of the source to generate: the repaint region plus margins,
+    widened to WINDOW_MIN_SECONDS and clamped to the output duration.
+
+    Returns {"start", "end", "crossfade", "full_duration"} in seconds, or None
+    when the window would cover the whole output anyway.
+    """
+    import soundfile as sf
+
+    full = duration if duration and duration > 0 else sf.info(src_path).duration
+    region_end = full if end is None or end < 0 else min(end, full)
+    window_start = max(0.0, (start or 0.0) - options["margin"])
+    window_end = min(full, region_end + options["margin"])
+    shortfall = WINDOW_MIN_SECONDS - (window_end - window_start)
+    if shortfall > 0:
+        window_end = min(full, window_end + shortfall / 2)
+        window_start = max(0.0, window_end - WINDOW_MIN_SECONDS)
+        window_end = min(full, window_start + WINDOW_MIN_SECONDS)
+    if window_start <= 0 and window_end >= full:
+        return None
+    return {"start": window_start, "end": window_end, "crossfade": options["crossfade"], "full_duration": full}
+
+
+def crop_audio(src_path: str, start: float, end: float, out_path: str):
+    """Write [start, end) seconds of `src_path` to a 24-bit WAV at `out_path`."""
+    import soundfile as sf
+
+    with sf.SoundFile(src_path) as f:
+        sample_rate = f.samplerate
+        first = min(int(start * sample_rate), f.frames)
+        f.seek(first)
+        audio = f.read(int((end - start) * sample_rate), dtype="float32", always_2d=True)
+    # 24-bit keeps 16-bit sources lossless; float WAVs carry a timestamped
+    # PEAK chunk, which would defeat content hashing of the crop
+    sf.write(out_path, audio, sample_rate, subtype="PCM_24")
+
+
+def splice_window(src_path: str, window_path: str, window: dict, out_path: str):
+    """
+    Write a full-length output as 16-bit WAV: the source audio with the
+    generated window pasted in at window["start"], blended over
+    window["crossfade"] seconds at each edge that falls inside the song.
+
+    The margins regenerate context that matches the source closely, so a
+    linear crossfade is enough to hide the seams.
+    """
+    import numpy as np
+    import soundfile as sf
+
+    part, sample_rate = sf.read(window_path, dtype="float32", always_2d=True)
+    full, src_rate = sf.read(src_path, dtype="float32", always_2d=True)
+    if src_rate != sample_rate:
+        import librosa
+        full = librosa.resample(full.T, orig_sr=src_rate, target_sr=sample_rate).T
+    channels = part.shape[1]
+    if full.shape[1] != channels:
+        full = np.repeat(full[:, :1], channels, axis=1)
+
+    frames = int(round(window["full_duration"] * sample_rate))
+    out = np.zeros((frames, channels), dtype=np.float32)
+    out[:min(frames, len(full))] = full[:frames]
+
+    first = min(int(round(window["start"] * sample_rate)), frames)
+    last = min(first + len(part), int(round(window["end"] * sample_rate)), frames)
+    part = part[:last - first]
+    weights = np.ones(len(part), dtype=np.float32)
+    fade = min(int(window["crossfade"] * sample_rate), len(part) // 2)
+    if fade:
+        ramp = np.linspace(0.0, 1.0, fade, endpoint=False, dtype=np.float32)
+        if first > 0:
+            weights[:fade] = ramp
+        if last < frames:
+            weights[-fade:] = ramp[::-1]
+    region = out[first:last]
+    out[first:last] = region + (part - region) * weights[:, None]
+
+    sf.write(out_path, out, sample_rate, subtype="PCM_16")
+
+
+# ---------------------------------------------------------------------------
+# LoRA Catalog
+# ---------------------------------------------------------------------------
+
+LORA_CATALOG_PATH = os.path.join(LORA_DIR, ".catalog.json")
+LORA_CATALOG_RELOAD_INTERVAL = 10  # Seconds between volume reloads for list requests
+LORA_LIST_MAX_LIMIT = 500  # Largest page api_list_loras returns for an explicit limit
+
+_catalog_lock = threading.Lock()
+
+
+def lora_catalog_entry(name: str) -> dict:
+    """Scan one LoRA directory into its catalog entry."""
+    lora_path = os.path.join(LORA_DIR, name)
+    # Read metadata if exists
+    meta_path = os.path.join(lora_path, "meta.json")
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    # Check for safetensors weights
+    has_weights = any(
+        f.endswith(".safetensors") or f.endswith(".bin")
+        for f in os.listdir(lora_path)
+    )
+    return {
+        "name": name,
+        "has_weights": has_weights,
+        "created_at": meta.get("created_at"),
+        "epochs": meta.get("epochs"),
+        "rank": meta.get("rank"),
+        "num_files": meta.get("num_files"),
+        "dir_mtime": os.path.getmtime(lora_path),
+    }
+
+
+def lora_dir_mtimes() -> dict:
+    """Adapter directory names mapped to their mtimes; skips .jobs and other hidden entries."""
+    if not os.path.isdir(LORA_DIR):
+        return {}
+    mtimes = {}
+    for name in os.listdir(LORA_DIR):
+        lora_path = os.path.join(LORA_DIR, name)
+        if not name.startswith(".") and os.path.isdir(lora_path):
+            mtimes[name] = os.path.getmtime(lora_path)
+    return mtimes
+
+
+def write_lora_catalog(loras: dict, version: int) -> dict:
+    """Atomically replace the catalog manifest. Caller holds _catalog_lock."""
+    catalog = {
+        "version": version,
+        "updated_at": time.time(),
+        "etag": canonical_hash(loras)[:16],
+        "loras": loras,
+    }
+    tmp_path = f"{LORA_CATALOG_PATH}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(catalog, f)
+    os.replace(tmp_path, LORA_CATALOG_PATH)
+    return catalog
+
+
+def read_lora_catalog() -> dict:
+    """
+    Load the catalog manifest, rebuilding it from a full scan if it is missing,
+    unreadable, or out of step with the adapter directories on the volume.
+    """
+    with _catalog_lock:
+        try:
+            with open(LORA_CATALOG_PATH) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = None
+
+        mtimes = lora_dir_mtimes()
+        if catalog is not None and {
+            name: entry["dir_mtime"] for name, entry in catalog["loras"].items()
+        } == mtimes:
+            return catalog
+
+        print("[Modal] LoRA catalog missing or stale; rebuilding from scan")
+        loras = {name: lora_catalog_entry(name) for name in mtimes}
+        catalog = write_lora_catalog(loras, (catalog or {}).get("version", 0) + 1)
+    try:
+        LORA_VOLUME.commit()
+    except Exception as commit_err:
+        print(f"[Modal] WARNING: Could not commit rebuilt LoRA catalog: {commit_err}")
+    return catalog
+
+
+def update_lora_catalog(name: str):
+    """Refresh one adapter's catalog entry, e.g. after training commits it."""
+    with _catalog_lock:
+        try:
+            with open(LORA_CATALOG_PATH) as f:
+                catalog = json.load(f)
+        except (OSError, ValueError):
+            catalog = {"version": 0, "loras": {}}
+        loras = {n: e for n, e in catalog["loras"].items() if os.path.isdir(os.path.join(LORA_DIR, n))}
+        loras[name] = lora_catalog_entry(name)
+        write_lora_catalog(loras, catalog["version"] + 1)
+
+
+# ---------------------------------------------------------------------------
+# LoRA Residency
+# ---------------------------------------------------------------------------
+
+LORA_PINNED_ADAPTERS = 4  # Adapter state dicts kept in pinned host memory
+LORA_RELOAD_INTERVAL = 30  # Seconds between volume reloads while an adapter stays active
+
+
+class LoraManager:
+    """
+    Tracks which LoRA adapter is applied to the DiT and swaps adapters cheaply.
+
+    An adapter is identified by its weight file's SHA-256, so retraining under
+    the same name is detected as stale and reloaded. Recently used adapters'
+    state dicts are pinned in host memory; switching between adapters with the
+    same PEFT config copies those tensors into the resident adapter instead of
+    calling load_lora again. Requests without a LoRA revert to base weights.
+    Callers must hold the GPU lock around apply().
+    """
+
+    def __init__(self, handler, max_pinned=LORA_PINNED_ADAPTERS):
+        self.handler = handler
+        self.max_pinned = max_pinned
+        self.active = None  # {"name", "path", "sha256", "config", "enabled"}
+        self._pinned = collections.OrderedDict()  # sha256 -> (config, state_dict)
+        self._last_reload = 0.0
+        self._lock = threading.Lock()
+
+    def resolve(self, lora_name: str):
+        """Return the adapter's weight file on the persistent volume, or None."""
+        active = self.active
+        if not (active and active["name"] == lora_name
+                and time.time() - self._last_reload < LORA_RELOAD_INTERVAL):
+            LORA_VOLUME.reload()
+            self._last_reload = time.time()
+
+        lora_path = os.path.join(LORA_DIR, lora_name)
+        if not os.path.isdir(lora_path):
+            log(f"WARNING: LoRA not found: {lora_name}")
+            return None
+        # Find the safetensors or bin file
+        lora_files = [f for f in os.listdir(lora_path) if f.endswith(".safetensors") or f.endswith(".bin")]
+        if not lora_files:
+            log(f"WARNING: No weight files found in LoRA dir: {lora_path}")
+            return None
+        return os.path.join(lora_path, sorted(lora_files)[0])
+
+    def apply(self, lora_name: str, weight_path: str) -> dict:
+        """
+        Make `lora_name` (or base weights, if weight_path is None) the active
+        adapter. Returns {"name", "action", "swap_ms"} for the response.
+        """
+        start = time.perf_counter()
+        with self._lock:
+            if weight_path is None:
+                action = self._unload()
+            else:
+                sha256 = file_sha256(weight_path)
+                if self.active and self.active["sha256"] == sha256:
+                    self._enable()
+                    action = "reused"
+                else:
+                    action = self._swap(lora_name, weight_path, sha256)
+        info = {
+            "name": self.active["name"] if self.active and self.active["enabled"] else None,
+            "action": action,
+            "swap_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+        if action not in ("none", "reused"):
+            log(f"LoRA {action}: {info['name']} in {info['swap_ms']} ms")
+        return info
+
+    def _unload(self) -> str:
+        """
+        Revert to base weights with the handler's unload_lora, or else by
+        disabling the PEFT adapter layers, which keeps the adapter resident as
+        `active` with "enabled" False. If reverting raises, `active` still names
+        the adapter left on the model, so the next request tries again.
+        """
+        if self.active is None or not self.active["enabled"]:
+            return "none"
+        if callable(getattr(self.handler, "unload_lora", None)):
+            self.handler.unload_lora()
+            self.active = None
+            return "unloaded"
+        model = getattr(self.handler, "model", None)
+        if not callable(getattr(model, "disable_adapter_layers", None)):
+            raise RuntimeError("Cannot revert LoRA: handler has no unload_lora and the model no adapter layers")
+        model.disable_adapter_layers()
+        self.active["enabled"] = False
+        return "disabled"
+
+    def _enable(self):
+        """Switch a disabled resident adapter's layers back on."""
+        if not self.active["enabled"]:
+            self.handler.model.enable_adapter_layers()
+            self.active["enabled"] = True
+
+    def _swap(self, lora_name: str, weight_path: str, sha256: str) -> str:
+        config = self._read_config(weight_path)
+        pinned = self._pinned.get(sha256)
+        if pinned is not None and self.active and config and config == self.active["config"]:
+            try:
+                from peft import set_peft_model_state_dict
+                set_peft_model_state_dict(self.handler.model, pinned[1])
+                self._enable()
+                self._pinned.move_to_end(sha256)
+                self.active = {"name": lora_name, "path": weight_path, "sha256": sha256, "config": config,
+                               "enabled": True}
+                return "swapped"
+            except Exception as swap_err:
+                log(f"WARNING: LoRA hot-swap failed: {swap_err}. Reloading from disk.")
+
+        resident = self.active
+        if resident is not None:
+            self._unload()
+        try:
+            self.handler.load_lora(weight_path)
+        except Exception as lora_err:
+            log(f"WARNING: LoRA load failed: {lora_err}. Continuing without LoRA.")
+            return "failed"
+        self.active = {"name": lora_name, "path": weight_path, "sha256": sha256, "config": config, "enabled": True}
+        if resident is not None and not resident["enabled"]:
+            # Adapter layers switched off by _unload stay off for the new adapter
+            self.handler.model.enable_adapter_layers()
+        self._pin(sha256, config, weight_path)
+        return "loaded"
+
+    def _pin(self, sha256: str, config, weight_path: str):
+        """Keep the adapter's tensors in pinned host memory for later hot-swaps."""
+        if not config or sha256 in self._pinned:
+            return
+        try:
+            import torch
+            if weight_path.endswith(".safetensors"):
+                from safetensors.torch import load_file
+                state_dict = load_file(weight_path, device="cpu")
+            else:
+                state_dict = torch.load(weight_path, map_location="cpu")
+            if torch.cuda.is_available():
+                state_dict = {k: v.pin_memory() for k, v in state_dict.items()}
+        except Exception as pin_err:
+            log(f"WARNING: Could not pin LoRA weights: {pin_err}")
+            return
+        self._pinned[sha256] = (config, state_dict)
+        while len(self._pinned) > self.max_pinned:
+            self._pinned.popitem(last=False)
+
+    @staticmethod
+    def _read_config(weight_path: str):
+        """The adapter's PEFT config, used to decide whether a hot-swap is safe."""
+        config_path = os.path.join(os.path.dirname(weight_path), "adapter_config.json")
+        try:
+            with open(config_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+# ---------------------------------------------------------------------------
+# Micro-batching
+# ---------------------------------------------------------------------------
+
+# Opt-in: set ACESTEP_BATCH_MAX_SIZE > 1 (e.g. via acestep_image.env) to enable
+BATCH_MAX_SIZE = int(os.environ.get("ACESTEP_BATCH_MAX_SIZE", "1"))  # Max outputs per DiT pass
+BATCH_MAX_WAIT = float(os.environ.get("ACESTEP_BATCH_MAX_WAIT_MS", "50")) / 1000
+
+
+class BatchScheduler:
+    """
+    Coalesces compatible requests that arrive within a short window.
+
+    The first request for a group key becomes the group's leader: it waits up
+    to `max_wait` seconds (or until `max_size` outputs are collected), runs the
+    whole group through `run_batch` and hands each follower its own result.
+    `run_batch(items)` must return one result dict per item, in order.
+    """
+
+    def __init__(self, run_batch, max_size=BATCH_MAX_SIZE, max_wait=BATCH_MAX_WAIT):
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._groups = {}  # key -> group still accepting requests
+        self._cond = threading.Condition()
+
+    def submit(self, key: str, item: dict, size: int = 1) -> dict:
+        """Run `item` (producing `size` outputs) as part of a batch and wait for its result."""
+        entry = {"item": item, "submitted": time.perf_counter(), "done": threading.Event(), "result": None}
+        with self._cond:
+            group = self._groups.get(key)
+            if group is not None and group["size"] + size <= self.max_size:
+                group["entries"].append(entry)
+                group["size"] += size
+                self._cond.notify_all()
+                leader = False
+            else:
+                group = {"entries": [entry], "size": size}
+                self._groups[key] = group
+                leader = True
+
+        if not leader:
+            entry["done"].wait()
+            return entry["result"]
+
+        deadline = time.monotonic() + self.max_wait
+        with self._cond:
+            while group["size"] < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            if self._groups.get(key) is group:
+                del self._groups[key]
+
+        started = time.perf_counter()
+        try:
+            results = self.run_batch([e["item"] for e in group["entries"]])
+        except Exception as e:
+            results = [{"status": "failed", "error": str(e)} for _ in group["entries"]]
+        for e, result in zip(group["entries"], results):
+            result.setdefault("batch", {})["wait_ms"] = round((started - e["submitted"]) * 1000, 1)
+            e["result"] = result
+            e["done"].set()
+        return entry["result"]
+
+
+class PassStats:
+    """Throughput and GPU latency of single-request vs. multi-request DiT passes."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals = {
+            kind: {"passes": 0, "requests": 0, "outputs": 0, "gpu_seconds": 0.0}
+            for kind in ("single", "batched")
+        }
+
+    def record(self, requests: int, outputs: int, gpu_seconds: float):
+        with self._lock:
+            totals = self._totals["batched" if requests > 1 else "single"]
+            totals["passes"] += 1
+            totals["requests"] += requests
+            totals["outputs"] += outputs
+            totals["gpu_seconds"] += gpu_seconds
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            report = {}
+            for kind, totals in self._totals.items():
+                gpu = totals["gpu_seconds"]
+                report[kind] = {
+                    **totals,
+                    "gpu_ms_per_request": round(gpu * 1000 / totals["requests"], 1) if totals["requests"] else None,
+                    "outputs_per_gpu_second": round(totals["outputs"] / gpu, 3) if gpu else None,
+                }
+            return report
+
+
+# ---------------------------------------------------------------------------
+# Seed Fan-out
+# ---------------------------------------------------------------------------
+
+FAN_OUT_MAX_SHARDS = 16  # Outputs (one seed each) a fan-out request may ask for
+# Shard workers each cold-start unless already warm, so a request only sends
+# shards to idle warm workers, plus up to this many new ones
+FAN_OUT_COLD_SHARDS = int(os.environ.get("ACESTEP_FAN_OUT_COLD_SHARDS", "0"))
+
+
+def fan_out_seeds(params: dict, count: int) -> list:
+    """
+    One seed per output: consecutive from an explicit seed, else drawn here so
+    the response can report which seed produced which output.
+    """
+    import random
+
+    seed = params.get("seed", -1)
+    if not params.get("use_random_seed", True) and seed not in (None, -1):
+        return [int(seed) + i for i in range(count)]
+    rng = random.SystemRandom()
+    return [rng.randrange(2 ** 31) for _ in range(count)]
+
+
+class ModalShardExecutor:
+    """
+    Runs fan-out shards through generate_shard.map on a separate pool of
+    AceStepInference containers that take one input at a time. The serving
+    containers accept several inputs but run one GPU pass at a time, so shards
+    mapped onto them would mostly queue behind each other on one GPU.
+
+    A worker that is not already warm pays a full cold start first: the
+    container boots and loads the DiT and the 4B LM (api_health's startup
+    phases), which takes longer than generating one output on a warm GPU.
+    Workers therefore mark themselves idle in `records` after each shard, and
+    capacity() offers only the workers idle within their scaledown window plus
+    FAN_OUT_COLD_SHARDS cold ones. Concurrent fan-outs may count the same idle
+    worker; the extra shard then waits for it or starts a new worker.
+    """
+
+    def __init__(self, records):
+        self.records = records  # "shard-worker:<id>" -> time the worker went idle
+
+    def capacity(self, count: int) -> int:
+        """How many of `count` shards to send to workers; the rest run in this container."""
+        now = time.time()
+        idle = 0
+        try:
+            for key, idle_since in list(self.records.items()):
+                if not key.startswith("shard-worker:"):
+                    continue
+                if now - idle_since < SCALEDOWN_WINDOW:
+                    idle += 1
+                    continue
+                try:
+                    self.records.pop(key)  # Scaled down by now
+                except Exception:
+                    pass  # Already dropped by another container
+        except Exception as e:
+            log(f"WARNING: Could not count idle shard workers: {e}")
+        return min(count, idle + FAN_OUT_COLD_SHARDS)
+
+    def mark_busy(self, worker_id: str):
+        try:
+            self.records.pop(f"shard-worker:{worker_id}")
+        except Exception:
+            pass  # Not marked idle yet
+
+    def mark_idle(self, worker_id: str):
+        try:
+            self.records[f"shard-worker:{worker_id}"] = time.time()
+        except Exception as e:
+            log(f"WARNING: Could not mark shard worker idle: {e}")
+
+    def map(self, requests: list, inputs: list) -> list:
+        """Results in request order; a failed shard's entry is its exception."""
+        worker = AceStepInference.with_options(allow_concurrent_inputs=1)()
+        return list(worker.generate_shard.map(requests, inputs, order_outputs=True, return_exceptions=True))
+
+
+class PoolShardExecutor:
+    """
+    Runs fan-out shards on a concurrent.futures executor, e.g. a local process
+    pool whose workers each hold their own AceStepInference.
+    """
+
+    def __init__(self, pool, run_shard):
+        self.pool = pool
+        self.run_shard = run_shard
+
+    def capacity(self, count: int) -> int:
+        return count
+
+    def mark_busy(self, worker_id: str):
+        pass
+
+    def mark_idle(self, worker_id: str):
+        pass
+
+    def map(self, requests: list, inputs: list) -> list:
+        futures = [self.pool.submit(self.run_shard, request, data) for request, data in zip(requests, inputs)]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+
+# ---------------------------------------------------------------------------
+# LoRA Training Jobs
+# ---------------------------------------------------------------------------
+
+TRAIN_JOBS_DIR = os.path.join(LORA_DIR, ".jobs")
+TRAIN_PROGRESS_INTERVAL = 15  # Seconds between progress writes to the volume
+TRAIN_TERMINAL_STATES = ("completed", "failed", "cancelled")
+
+
+class TrainingCancelled(Exception):
+    pass
+
+
+class TrainingJob:
+    """
+    State of one LoRA training job, kept on the LoRA volume under
+    TRAIN_JOBS_DIR/<job_id>/ so any container can report on or cancel it.
+
+    job.json is written by api_train until the worker picks the job up and by
+    the worker afterwards. Cancellation only drops a separate `cancel` flag
+    file, so the two writers never race on the same file.
+    """
+
+    def __init__(self, job_id: str):
+        self.id = job_id
+        self.dir = os.path.join(TRAIN_JOBS_DIR, job_id)
+        self.data_dir = os.path.join(self.dir, "data")
+        self.state_path = os.path.join(self.dir, "job.json")
+        self.cancel_path = os.path.join(self.dir, "cancel")
+        self.call_id_path = os.path.join(self.dir, "call_id")
+
+    def load(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, state: dict):
+        """Atomically replace job.json and commit it to the volume."""
+        state["updated_at"] = time.time()
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+        LORA_VOLUME.commit()
+
+    def cancel_requested(self, reload: bool = False) -> bool:
+        if reload:
+            try:
+                LORA_VOLUME.reload()
+            except Exception:
+                pass  # Files held open by the trainer; check again next time
+        return os.path.exists(self.cancel_path)
+
+
+def checkpoint_marks(output_dir: str) -> dict:
+    """{name: mtime_ns} of the checkpoint/epoch/step files or directories in a LoRA dir."""
+    import re
+
+    marks = {}
+    for name in os.listdir(output_dir) if os.path.isdir(output_dir) else []:
+        if re.search(r"(?:checkpoint|epoch|step)[-_]?(\d+)", name):
+            marks[name] = os.stat(os.path.join(output_dir, name)).st_mtime_ns
+    return marks
+
+
+def latest_checkpoint(output_dir: str, ignore: dict = None):
+    """
+    Most advanced checkpoint/epoch/step file or directory in a LoRA dir, if
+    any. Entries whose checkpoint_marks match `ignore` (left by an earlier run
+    under the same name) are skipped.
+    """
+    import re
+
+    ignore = ignore or {}
+    best, best_step = None, -1
+    for name, mtime_ns in checkpoint_marks(output_dir).items():
+        if ignore.get(name) == mtime_ns:
+            continue
+        step = int(re.search(r"(?:checkpoint|epoch|step)[-_]?(\d+)", name).group(1))
+        if step > best_step:
+            best, best_step = os.path.join(output_dir, name), step
+    return best
+
+
+def load_dit_handler():
+    """Initialize the acestep-v15-turbo DiT on the GPU (weights already in image)."""
+    import sys
+    sys.path.insert(0, "/opt/ACE-Step")
+
+    from acestep.handler import AceStepHandler
+    handler = AceStepHandler()
+
+    status_msg, ok = handler.initialize_service(
+        project_root="/opt/ACE-Step",
+        config_path="acestep-v15-turbo",
+        device="cuda",
+        use_flash_attention=True,
+        compile_model=False,
+        offload_to_cpu=False,
+        offload_dit_to_cpu=False,
+    )
+    if not ok:
+        raise RuntimeError(f"Model init failed: {status_msg}")
+    print("[Modal] DiT loaded: acestep-v15-turbo")
+    return handler
+
+
+# ---------------------------------------------------------------------------
+# Training Data
+# ---------------------------------------------------------------------------
+
+# Training audio lives on the LoRA volume, content-addressed and shared by
+# every LoRA trained from it:
+#   blobs/<sha256>             uploaded files, stored once
+#   uploads/<sha256>/<offset>  chunks of uploads still in progress
+#   datasets/<id>.json         manifests listing the files of one training set
+#   preprocessed/<sha256>.wav  a blob decoded and resampled for training
+#   latents/<key>.pt           VAE encodings of whole preprocessed files
+TRAIN_DATA_DIR = os.path.join(LORA_DIR, ".data")
+TRAIN_UPLOAD_MAX_BYTES = 1024 ** 3  # Largest single training file
+TRAIN_CHUNK_MAX_BYTES = 16 * 1024 ** 2  # Largest chunk per api_train_upload request
+TRAIN_SAMPLE_RATE = 48000  # Training audio is resampled to this once per file
+TRAIN_PCM_SUBTYPE = "PCM_16"  # Sample format of preprocessed training audio
+TRAIN_LATENT_CACHE_MAX_BYTES = 8 * 1024 ** 3  # VAE encodings kept on the LoRA volume
+TRAIN_LATENT_PROBES = 256  # Samples compared to match an encoded waveform to a dataset file
+
+
+def train_data_path(kind: str, name: str = "") -> str:
+    return os.path.join(TRAIN_DATA_DIR, kind, name)
+
+
+def valid_sha256(value) -> bool:
+    return isinstance(value, str) and len(value) == 64 and all(c in "0123456789abcdef" for c in value)
+
+
+class TrainingUpload:
+    """
+    Resumable upload of one training file, addressed by its SHA-256.
+
+    Every chunk is its own file under uploads/<sha256>/, named by its byte
+    offset, so retried chunks and requests landing on different containers
+    never write to the same file. `received()` is the contiguous prefix held
+    on the volume, which is where an interrupted client resumes. Once every
+    byte is there the chunks are joined, checked against the hash and moved to
+    blobs/<sha256>. A blob that already exists, from any LoRA's dataset,
+    completes the upload before a byte is sent.
+    """
+
+    def __init__(self, sha256: str, size: int):
+        self.sha256 = sha256
+        self.size = size
+        self.blob_path = train_data_path("blobs", sha256)
+        self.dir = train_data_path("uploads", sha256)
+
+    def exists(self) -> bool:
+        return os.path.exists(self.blob_path)
+
+    def chunks(self) -> list:
+        """(offset, path) of the stored chunks, in offset order."""
+        names = os.listdir(self.dir) if os.path.isdir(self.dir) else []
+        return sorted((int(name), os.path.join(self.dir, name)) for name in names if name.isdigit())
+
+    def received(self) -> int:
+        if self.exists():
+            return self.size
+        end = 0
+        for offset, path in self.chunks():
+            if offset > end:
+                break
+            end = max(end, offset + os.path.getsize(path))
+        return min(end, self.size)
+
+    def write(self, offset: int, data: bytes):
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError(f"Chunk at {offset} (+{len(data)} bytes) is outside a {self.size}-byte file")
+        os.makedirs(self.dir, exist_ok=True)
+        tmp_path = os.path.join(self.dir, f".tmp_{uuid.uuid4().hex}")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(self.dir, f"{offset:012d}"))
+
+    def complete(self) -> bool:
+        """Join the chunks into the blob once all bytes are present; True when the blob exists."""
+        if self.exists():
+            return True
+        if self.received() < self.size:
+            return False
+
+        os.makedirs(os.path.dirname(self.blob_path), exist_ok=True)
+        tmp_path = f"{self.blob_path}.tmp_{uuid.uuid4().hex}"
+        digest = hashlib.sha256()
+        position = 0
+        with open(tmp_path, "wb") as out:
+            for offset, path in self.chunks():
+                if position >= self.size:
+                    break
+                if offset + os.path.getsize(path) <= position:
+                    continue  # Covered by an earlier, overlapping chunk
+                with open(path, "rb") as f:
+                    f.seek(position - offset)
+                    while position < self.size and (chunk := f.read(min(STREAM_CHUNK_SIZE, self.size - position))):
+                        out.write(chunk)
+                        digest.update(chunk)
+                        position += len(chunk)
+        shutil.rmtree(self.dir, ignore_errors=True)
+        if digest.hexdigest() != self.sha256:
+            remove_files([tmp_path])
+            raise ValueError("Uploaded bytes do not match sha256; upload the file again")
+        os.replace(tmp_path, self.blob_path)
+        return True
+
+    def status(self) -> dict:
+        return {
+            "status": "complete" if self.exists() else "partial",
+            "sha256": self.sha256,
+            "size": self.size,
+            "received": self.received(),
+        }
+
+
+def put_training_blob(data: bytes) -> str:
+    """Store an in-memory training file (e.g. a base64 upload) as a blob; returns its sha256."""
+    upload = TrainingUpload(hashlib.sha256(data).hexdigest(), len(data))
+    if not upload.exists():
+        upload.write(0, data)
+        upload.complete()
+    return upload.sha256
+
+
+def save_training_dataset(files: list) -> dict:
+    """
+    Write the manifest for uploaded files given as [{"name", "sha256"}, ...].
+
+    The dataset id is a hash of the manifest's files, so sending the same set
+    again (to retrain at another rank or learning rate) names the same dataset.
+    Raises ValueError when a file was never uploaded.
+    """
+    entries, missing, names = [], [], set()
+    for i, entry in enumerate(files):
+        sha256 = str(entry.get("sha256", "")).lower()
+        name = os.path.basename(str(entry.get("name", ""))) or f"audio_{i}.wav"
+        if not valid_sha256(sha256) or not os.path.exists(train_data_path("blobs", sha256)):
+            missing.append(name)
+            continue
+        if name in names:
+            stem, ext = os.path.splitext(name)
+            name = f"{stem}_{i}{ext}"
+        names.add(name)
+        entries.append({"name": name, "sha256": sha256, "size": os.path.getsize(train_data_path("blobs", sha256))})
+    if missing:
+        raise ValueError(f"Training files not uploaded: {', '.join(missing)}")
+    if not entries:
+        raise ValueError("No audio files provided")
+
+    dataset_id = canonical_hash({"files": entries})[:32]
+    existing = load_training_dataset(dataset_id)
+    if existing:
+        return existing
+    manifest = {
+        "dataset_id": dataset_id,
+        "files": entries,
+        "total_bytes": sum(e["size"] for e in entries),
+        "created_at": time.time(),
+    }
+    path = train_data_path("datasets", f"{dataset_id}.json")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp_{uuid.uuid4().hex}"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+def load_training_dataset(dataset_id: str):
+    if not dataset_id or not all(c in "0123456789abcdef" for c in dataset_id):
+        return None
+    try:
+        with open(train_data_path("datasets", f"{dataset_id}.json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def preprocessed_training_audio(sha256: str) -> tuple:
+    """
+    (path, created) of a blob decoded and resampled to TRAIN_SAMPLE_RATE as
+    16-bit WAV. It is made on first use and shared by every dataset holding
+    the file, so retraining skips decoding and resampling.
+    """
+    path = train_data_path("preprocessed", f"{sha256}.wav")
+    if os.path.exists(path):
+        return path, False
+
+    import librosa
+    import soundfile as sf
+
+    audio, _ = librosa.load(train_data_path("blobs", sha256), sr=TRAIN_SAMPLE_RATE, mono=False)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp_{uuid.uuid4().hex}.wav"
+    sf.write(tmp_path, audio.T, TRAIN_SAMPLE_RATE, subtype=TRAIN_PCM_SUBTYPE)
+    os.replace(tmp_path, path)
+    return path, True
+
+
+def stage_training_dataset(manifest: dict, data_dir: str) -> dict:
+    """Lay a dataset out in data_dir as preprocessed WAVs under the uploaded names."""
+    os.makedirs(data_dir, exist_ok=True)
+    created = 0
+    for entry in manifest["files"]:
+        path, new = preprocessed_training_audio(entry["sha256"])
+        created += new
+        stem = os.path.splitext(entry["name"])[0]
+        shutil.copyfile(path, os.path.join(data_dir, f"{stem}.wav"))
+    return {"files": len(manifest["files"]), "preprocessed": created}
+
+
+class TrainingLatentCache:
+    """
+    Keeps VAE encodings of whole training files on the LoRA volume.
+
+    Entries are keyed on the file's blob SHA-256, the preprocessing params and
+    the crop, so a retrain of the same files, or an epoch that encodes them
+    again, skips the VAE. register() lists the dataset being trained: a
+    waveform passed to vae.encode is matched to a file by its length and a few
+    hundred probe samples gathered on its device, instead of copying and
+    hashing all of it. Crops, augmented or batched inputs and calls with
+    non-scalar arguments cannot be keyed that way and are encoded without
+    being stored. The directory is evicted least-recently-used past
+    `max_bytes`.
+    """
+
+    def __init__(self, root: str, max_bytes=TRAIN_LATENT_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._files = {}  # (channels, frames) -> [(blob sha256, probe values), ...]
+        self.stats = {"hits": 0, "misses": 0, "skipped": 0, "evictions": 0}
+
+    def wrap(self, handler):
+        """Replace handler.vae.encode with a caching version."""
+        vae = getattr(handler, "vae", None)
+        encode = getattr(vae, "encode", None)
+        if not callable(encode):
+            print("[Modal] Training latent cache off: handler has no vae.encode")
+            return
+        vae.encode = self._cached(encode)
+        print("[Modal] Training latent cache on: vae.encode")
+
+    def register(self, manifest):
+        """Match later encodes against the preprocessed files of `manifest` (None: store nothing)."""
+        import numpy as np
+        import soundfile as sf
+
+        files = {}
+        for entry in (manifest or {}).get("files", []):
+            audio, _ = sf.read(train_data_path("preprocessed", f"{entry['sha256']}.wav"), dtype="float32", always_2d=True)
+            frames, channels = audio.shape
+            probe = audio[self._probe_indices(frames)].T
+            files.setdefault((channels, frames), []).append((entry["sha256"], np.ascontiguousarray(probe)))
+        with self._lock:
+            self._files = files
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats)
+
+    @staticmethod
+    def _probe_indices(frames: int):
+        import numpy as np
+
+        return np.sort(np.random.default_rng(frames).integers(0, frames, size=min(frames, TRAIN_LATENT_PROBES)))
+
+    def _key(self, audio, args, kwargs):
+        """Entry key of an encode call, or None if it is not a whole registered file."""
+        import numpy as np
+        import torch
+
+        scalars = (int, float, str, bool, type(None))
+        if not all(isinstance(v, scalars) for v in (*args, *kwargs.values())):
+            return None
+        wave = audio
+        while wave.dim() > 2 and wave.shape[0] == 1:
+            wave = wave[0]
+        if wave.dim() == 1:
+            wave = wave[None]
+        if wave.dim() != 2:
+            return None
+        with self._lock:
+            candidates = self._files.get(tuple(wave.shape), [])
+        if not candidates:
+            return None
+
+        indices = torch.as_tensor(self._probe_indices(wave.shape[1]), device=wave.device)
+        probe = wave.detach().index_select(1, indices).float().cpu().numpy()
+        atol = 1e-4 if wave.element_size() >= 4 else 1e-2
+        matches = [sha256 for sha256, expected in candidates if np.allclose(probe, expected, atol=atol)]
+        if len(matches) != 1:
+            return None
+        return canonical_hash({
+            "blob": matches[0],
+            "preprocess": {"sample_rate": TRAIN_SAMPLE_RATE, "subtype": TRAIN_PCM_SUBTYPE},
+            "crop": None,
+            "shape": list(audio.shape),
+            "dtype": str(audio.dtype),
+            "args": list(args),
+            "kwargs": kwargs,
+        })
+
+    def _cached(self, encode):
+        import functools
+        import torch
+
+        @functools.wraps(encode)
+        def cached_encode(audio, *args, **kwargs):
+            key = self._key(audio, args, kwargs) if isinstance(audio, torch.Tensor) else None
+            if key is None:
+                with self._lock:
+                    self.stats["skipped"] += 1
+                return encode(audio, *args, **kwargs)
+            path = os.path.join(self.root, f"{key}.pt")
+            if os.path.exists(path):
+                try:
+                    value = torch.load(path, map_location=audio.device, weights_only=False)
+                    os.utime(path)
+                    with self._lock:
+                        self.stats["hits"] += 1
+                    return value
+                except Exception as e:
+                    print(f"[Modal] WARNING: Unreadable cached latents {path}: {e}")
+            with self._lock:
+                self.stats["misses"] += 1
+
+            value = encode(audio, *args, **kwargs)
+            tmp_path = f"{path}.tmp_{uuid.uuid4().hex}"
+            try:
+                torch.save(value, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:
+                remove_files([tmp_path])
+                print(f"[Modal] WARNING: Could not cache training latents: {e}")
+                return value
+            self._evict()
+            return value
+
+        return cached_encode
+
+    def _evict(self):
+        """Drop the least recently used encodings once the directory is over max_bytes."""
+        entries = []
+        for name in os.listdir(self.root):
+            if not name.endswith(".pt"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        victims = []
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            victims.append(name)
+            total -= size
+        remove_files([os.path.join(self.root, name) for name in victims])
+        with self._lock:
+            self.stats["evictions"] += len(victims)
+
+
+# ---------------------------------------------------------------------------
+# Startup
+# ---------------------------------------------------------------------------
+
+# "parallel" loads the LM alongside the DiT at startup; "lazy" defers it to the
+# first request that asks for thinking / CoT (CoT is on unless turned off)
+LM_LOAD_MODE = os.environ.get("ACESTEP_LM_LOAD_MODE", "parallel")
+# Run one short generation at startup so the first real request skips kernel warmup
+STARTUP_WARMUP = os.environ.get("ACESTEP_STARTUP_WARMUP", "0") == "1"
+
+
+class StartupReport:
+    """Wall-clock duration of each container startup phase."""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.ready_after = None
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.phases[name] = round(elapsed, 3)
+            print(f"[Modal] Startup phase {name}: {elapsed:.2f}s")
+
+    def mark_ready(self):
+        self.ready_after = round(time.time() - self.started_at, 3)
+        print(f"[Modal] Ready after {self.ready_after:.2f}s")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"phases": dict(self.phases), "ready_after": self.ready_after}
+
+
+class LanguageModelSlot:
+    """
+    Holds the 5Hz LM, loaded once by whichever caller needs it first.
+
+    handler is None until loading has finished (or if it failed), so requests
+    that do not need the LM never wait on it. A loader that raises leaves the
+    slot "failed" and the error goes to the caller that triggered the load.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._lock = threading.Lock()
+        self.handler = None
+        self.state = "deferred"
+
+    def load(self):
+        with self._lock:
+            if self.state == "deferred":
+                self.state = "loading"
+                try:
+                    self.handler = self._loader()
+                except Exception:
+                    self.state = "failed"
+                    raise
+                self.state = "loaded" if self.handler is not None else "failed"
+        return self.handler
+
+
+# ---------------------------------------------------------------------------
+# Inference Class
+# ---------------------------------------------------------------------------
+
+INFERENCE_TIMEOUT = 600  # Seconds Modal allows one input, a whole cascade stream included
+SCALEDOWN_WINDOW = 120  # Seconds an idle container stays warm
+# A cascade starts no new step after this many seconds; the client chains
+# the remaining steps onto the returned mix in a new call
+CASCADE_BUDGET = float(os.environ.get("ACESTEP_CASCADE_BUDGET_S", "420"))
+
+
+@app.cls(
+    image=acestep_image,
+    gpu="A10G",  # 24GB VRAM
+    timeout=INFERENCE_TIMEOUT,
+    scaledown_window=SCALEDOWN_WINDOW,
+    # Status polls must be served while a job is generating; GPU work is
+    # serialized by _gpu_lock so only one generate_music call runs at a time.
+    allow_concurrent_inputs=8,
+    volumes={LORA_DIR: LORA_VOLUME, CACHE_DIR: CACHE_VOLUME},
+)
+class AceStepInference:
+    """ACE-Step music generation inference endpoint."""
+
+    @modal.enter()
+    def load_model(self):
+        """
+        Load models into GPU on container startup (weights already in image).
+
+        The DiT and the 5Hz LM initialize concurrently, or the LM is deferred
+        to its first use when ACESTEP_LM_LOAD_MODE=lazy. Phase timings are
+        served by api_health.
+        """
+        import sys
+        from concurrent.futures import ThreadPoolExecutor
+        sys.path.insert(0, "/opt/ACE-Step")
+
+        self.startup = StartupReport()
+        with self.startup.phase("imports"):
+            import torch
+            import acestep.handler  # noqa: F401
+            import acestep.llm_inference  # noqa: F401
+        with self.startup.phase("cuda_init"):
+            torch.cuda.init()
+            torch.cuda.synchronize()
+
+        self.lm_cache = LMOutputCache(os.path.join(CACHE_DIR, "lm") if LM_CACHE_PERSIST else None)
+        self.lm = LanguageModelSlot(self._load_lm)
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            lm_future = pool.submit(self.lm.load) if LM_LOAD_MODE != "lazy" else None
+            with self.startup.phase("dit_init"):
+                self.handler = load_dit_handler()
+            if lm_future is not None:
+                lm_future.result()
+
+        self.temp_dir = "/tmp/acestep_audio"
+        os.makedirs(self.temp_dir, exist_ok=True)
+        self.inputs = InputStore(self.temp_dir)
+        self.decoded_audio = DecodedAudioCache()
+        self.decoded_audio.wrap(self.handler)
+        self.silent_latents = SilentLatentCache()
+        self.silent_latents.wrap(self.handler)
+
+        self._gpu_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.shared_jobs = SharedJobStore(JOB_DICT, os.path.join(CACHE_DIR, "jobs"))
+        self.job_runner = ModalJobRunner()
+        self.running_jobs = set()  # Ids of generate_job calls running in this container
+        self.result_cache = ResultCache(os.path.join(CACHE_DIR, "results"))
+        self.encoder = OutputEncoder()
+        self.loras = LoraManager(self.handler)
+        self._catalog_reloaded_at = 0.0
+        self.pass_stats = PassStats()
+        self.dit_steps = DitStepCounter()
+        self.batcher = BatchScheduler(self._run_batch) if BATCH_MAX_SIZE > 1 else None
+        self.shard_executor = ModalShardExecutor(JOB_DICT)
+        self.worker_id = os.environ.get("MODAL_TASK_ID") or uuid.uuid4().hex
+
+        if STARTUP_WARMUP:
+            with self.startup.phase("warmup"):
+                warmup = self._generate(
+                    {"prompt": "warmup", "audio_duration": 10, "inference_steps": 1,
+                     "audio_format": "wav", "use_cache": False, "allow_batching": False},
+                    {},
+                )
+                remove_files(warmup.get("paths", []))
+        self.startup.mark_ready()
+
+    def _load_lm(self):
+        """Initialize the 5Hz LM (4B) with the vllm backend. Returns None on failure."""
+        from acestep.llm_inference import LLMHandler
+
+        with self.startup.phase("lm_init"):
+            llm_handler = LLMHandler()
+            lm_status, lm_ok = llm_handler.initialize(
+                checkpoint_dir=os.path.join("/opt/ACE-Step", "checkpoints"),
+                lm_model_path="acestep-5Hz-lm-4B",
+                backend="vllm",
+                device="cuda",
+            )
+        if not lm_ok:
+            print(f"[Modal] WARNING: LM init failed: {lm_status}. Continuing without LM.")
+            return None
+        print("[Modal] LM loaded: acestep-5Hz-lm-4B (vllm)")
+        self.lm_cache.wrap(llm_handler)
+        return llm_handler
+
+    @modal.method()
+    def generate_job(self, job_id: str, request: dict, inputs: dict) -> str:
+        """
+        Run one release_task job as its own Modal input, so the container is
+        kept alive until the job is done. `inputs` maps input names to audio
+        bytes; the outcome is published through self.shared_jobs. Returns the
+        job's final status.
+        """
+        job = {
+            "id": job_id,
+            "status": "running",
+            "result": None,
+            "created_at": request["created_at"],
+            "finished_at": None,
+            "progress_text": "",
+        }
+        self.running_jobs.add(job_id)
+        try:
+            self._run_job(job, request, inputs)
+        except Exception as e:
+            # Reported as failed instead of leaving the record "running"
+            log(f"Job {job_id} crashed: {e}")
+            job.update(status="failed", finished_at=time.time(), result={
+                "status": "failed",
+                "error": str(e),
+                "error_type": type(e).__name__,
+            })
+            self.shared_jobs.publish(job)
+        finally:
+            self.running_jobs.discard(job_id)
+            _request_id.set(None)
+        try:
+            self.shared_jobs.sweep()
+        except Exception as e:
+            print(f"[Modal] WARNING: Could not sweep expired jobs: {e}")
+        return job["status"]
+
+    def _run_job(self, job: dict, request: dict, inputs: dict):
+        """Stage a job's inputs, generate, and publish its result and outputs."""
+        import traceback
+
+        if self.shared_jobs.cancel_requested(job["id"]):
+            job.update(status="cancelled", finished_at=time.time(),
+                       result={"status": "cancelled", "error": "Cancelled before start"})
+            self.shared_jobs.publish(job)
+            return
+        self.shared_jobs.publish(job)
+        _request_id.set(job["id"])
+        trace = RequestTrace(job["id"])
+        trace.add("queue_wait", time.time() - job["created_at"])
+        trace.attrs["bytes_in"] = request.get("bytes_in", 0)
+        trace.on_finish = lambda finished: self.metrics.record(finished, "release_task")
+        log(f"Job {job['id']} started")
+        staged = {name: self.inputs.put_bytes(name, data) for name, data in inputs.items()}
+
+        def track(event, data):
+            job["progress_text"] = describe_progress(event, data)
+            self.shared_jobs.publish(job, progress=True)
+
+        result = self._generate(request["params"], staged, ProgressReporter(track), trace)
+        if result.get("status") == "succeeded":
+            paths, mix_paths = result.pop("paths"), result.pop("mix_paths", [])
+            try:
+                with trace.span("read_outputs"):
+                    result["outputs"] = read_outputs(paths)
+                    result["mix_outputs"] = read_outputs(mix_paths)
+                # Polls may reach any container, which serves the audio from the volume
+                with trace.span("store_outputs"):
+                    self.shared_jobs.store_outputs(job["id"], result)
+            except Exception as e:
+                remove_files(paths + mix_paths)
+                result = {
+                    "status": "failed",
+                    "error": f"Could not store outputs: {e}",
+                    "error_type": type(e).__name__,
+                    "traceback": traceback.format_exc(),
+                }
+        result["timings"] = trace.snapshot()
+        trace.finish(result.get("status", "failed"), result.get("error_type"))
+        job.update(status=result.get("status", "failed"), result=result, finished_at=time.time())
+        self.shared_jobs.publish(job)
+        log(f"Job {job['id']} {job['status']}")
+
+    def _check_job(self, job_id: str, record: dict) -> dict:
+        """
+        Fail a queued or running job whose generate_job call ended without
+        publishing a result, e.g. because its container was stopped.
+        """
+        call_id = self.shared_jobs.call_id(job_id)
+        if not call_id:
+            return record  # Still being released
+        try:
+            error = self.job_runner.poll(call_id)
+        except Exception as e:
+            log(f"WARNING: Could not poll job {job_id}: {e}")
+            return record
+        if error is None:
+            return record
+        # The call may have published its result after the record was read
+        latest = self.shared_jobs.get(job_id) or record
+        if latest["status"] not in ("queued", "running"):
+            return latest
+        return self.shared_jobs.publish({
+            "id": job_id,
+            "status": "failed",
+            "progress_text": latest["progress_text"],
+            "created_at": latest["created_at"],
+            "finished_at": time.time(),
+            "result": {
+                "status": "failed",
+                "error": error or "Job ended without a result",
+                "error_type": "JobLost",
+            },
+        })
+
+    @modal.fastapi_endpoint(method="GET", docs=True)
+    def api_list_loras(self, request: "Request"):
+        """
+        List trained LoRA adapters from the catalog manifest on the persistent volume.
+
+        Query parameters: q (name substring), has_weights (true/false), offset
+        and limit (capped at LORA_LIST_MAX_LIMIT; without it, every match).
+        Malformed or negative offset / limit values get a 400. Responses carry
+        an ETag; send it back as If-None-Match to get a 304 when the catalog has
+        not changed.
+        """
+        from fastapi.responses import JSONResponse, Response
+
+        if time.time() - self._catalog_reloaded_at > LORA_CATALOG_RELOAD_INTERVAL:
+            LORA_VOLUME.reload()
+            self._catalog_reloaded_at = time.time()
+        catalog = read_lora_catalog()
+
+        etag = f'"{catalog["etag"]}"'
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+
+        query = request.query_params
+        try:
+            offset = query_int(query, "offset", 0)
+            limit = query_int(query, "limit", minimum=1)
+        except ValueError as e:
+            return JSONResponse({"error": str(e)}, status_code=400)
+
+        loras = sorted(catalog["loras"].values(), key=lambda entry: entry["name"])
+        if query.get("q"):
+            loras = [entry for entry in loras if query["q"].lower() in entry["name"].lower()]
+        if query.get("has_weights") in ("true", "false"):
+            loras = [entry for entry in loras if entry["has_weights"] == (query["has_weights"] == "true")]
+
+        limit = min(limit, LORA_LIST_MAX_LIMIT) if limit is not None else len(loras)
+        page = [
+            {k: v for k, v in entry.items() if k != "dir_mtime"}
+            for entry in loras[offset:offset + limit]
+        ]
+        return JSONResponse(
+            {"loras": page, "total": len(loras), "offset": offset, "version": catalog["version"]},
+            headers={"ETag": etag},
+        )
+
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    def api_train(self, request: dict):
+        """
+        Queue a LoRA training job on a dataset of uploaded audio files.
+
+        The dataset is a "dataset_id" from an earlier job, or "files":
+        [{"name", "sha256"}] uploaded through api_train_upload. Base64
+        "audio_files" are still accepted and stored the same way. Training runs
+        in the AceStepTrainer worker; poll api_train_status with the returned
+        job_id.
+        """
+        import base64
+        import traceback
+
+        try:
+            lora_name = request.get("lora_name", "").strip()
+            if not lora_name or lora_name.startswith(".") or "/" in lora_name:
+                return {"status": "failed", "error": "A valid lora_name is required"}
+
+            LORA_VOLUME.reload()
+            if request.get("dataset_id"):
+                manifest = load_training_dataset(request["dataset_id"])
+                if manifest is None:
+                    return {"status": "failed", "error": f"Unknown dataset: {request['dataset_id']}"}
+            else:
+                files = list(request.get("files") or [])
+                for i, af in enumerate(request.get("audio_files") or []):
+                    if af.get("data"):
+                        files.append({
+                            "name": af.get("name") or f"audio_{i}.wav",
+                            "sha256": put_training_blob(base64.b64decode(af["data"])),
+                        })
+                try:
+                    manifest = save_training_dataset(files)
+                except ValueError as e:
+                    return {"status": "failed", "error": str(e)}
+
+            job = TrainingJob(uuid.uuid4().hex)
+            os.makedirs(job.dir, exist_ok=True)
+            job.save({
+                "job_id": job.id,
+                "lora_name": lora_name,
+                "status": "queued",
+                "config": {
+                    "epochs": request.get("epochs", 100),
+                    "learning_rate": request.get("learning_rate", 0.0001),
+                    "lora_rank": request.get("lora_rank", 16),
+                    "batch_size": request.get("batch_size", 1),
+                    "save_every": request.get("save_every", 50),
+                },
+                "dataset_id": manifest["dataset_id"],
+                "num_files": len(manifest["files"]),
+                "created_at": time.time(),
+                "attempts": 0,
+                "progress": {},
+            })
+
+            call = AceStepTrainer().train.spawn(job.id)
+            with open(job.call_id_path, "w") as f:
+                f.write(call.object_id)
+            LORA_VOLUME.commit()
+
+            return {
+                "status": "queued",
+                "job_id": job.id,
+                "lora_name": lora_name,
+                "dataset_id": manifest["dataset_id"],
+                "message": f"LoRA '{lora_name}' training queued with {len(manifest['files'])} files.",
+            }
+
+        except Exception as e:
+            return {
+                "status": "failed",
+                "error": str(e),
+                "traceback": traceback.format_exc(),
+            }
+
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    async def api_train_upload(self, request: "Request"):
+        """
+        Chunked, resumable upload of one training file, addressed by its SHA-256.
+
+        POST JSON {"sha256", "size"} to start or resume: "received" is the
+        offset to continue from, and "status" is "complete" at once when the
+        volume already holds the file (e.g. from another LoRA's dataset). Then
+        POST each chunk as raw bytes with ?sha256=&size=&offset=. Once complete,
+        pass the hash to api_train in "files".
+        """
+        import asyncio
+
+        try:
+            if request.headers.get("content-type", "").startswith("application/json"):
+                body = await request.json()
+                sha256, size, offset, data = body.get("sha256"), body.get("size"), None, None
+            else:
+                query = request.query_params
+                sha256, size, offset = query.get("sha256"), query.get("size"), query_int(query, "offset", 0)
+                data = await request.body()
+                if len(data) > TRAIN_CHUNK_MAX_BYTES:
+                    return {"status": "failed", "error": f"Chunks are limited to {TRAIN_CHUNK_MAX_BYTES} bytes"}
+            sha256, size = str(sha256 or "").lower(), int(size or 0)
+        except Exception as e:
+            return {"status": "failed", "error": f"Invalid request: {e}"}
+        if not valid_sha256(sha256):
+            return {"status": "failed", "error": "sha256 must be a hex SHA-256 digest"}
+        if not 0 < size <= TRAIN_UPLOAD_MAX_BYTES:
+            return {"status": "failed", "error": f"size must be between 1 and {TRAIN_UPLOAD_MAX_BYTES} bytes"}
+
+        def handle():
+            try:
+                LORA_VOLUME.reload()
+            except Exception:
+                pass  # Files held open by this container; chunks already seen here are still visible
+            upload = TrainingUpload(sha256, size)
+            if data is not None and not upload.exists():
+                try:
+                    upload.write(offset, data)
+                    upload.complete()
+                finally:
+                    LORA_VOLUME.commit()
+            return upload.status()
+
+        try:
+            return await asyncio.to_thread(handle)
+        except ValueError as e:
+            return {"status": "failed", "error": str(e)}
+
+    @modal.fastapi_endpoint(method="GET", docs=True)
+    def api_train_status(self, job_id: str):
+        """Report a training job's status and latest epoch/step/loss progress."""
+        LORA_VOLUME.reload()
+        job = TrainingJob(job_id)
+        state = job.load()
+        if state is None:
+            return {"status": "failed", "error": f"Unknown training job: {job_id}"}
+        return {**state, "cancel_requested": job.cancel_requested()}
+
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    def api_train_cancel(self, request: dict):
+        """
+        Cancel a training job. Queued jobs are cancelled immediately; running
+        jobs stop at their next progress check. Pass force: true to kill a
+        running worker outright.
+        """
+        LORA_VOLUME.reload()
+        job = TrainingJob(request.get("job_id", ""))
+        state = job.load()
+        if state is None:
+            return {"status": "failed", "error": f"Unknown training job: {job.id}"}
+        if state["status"] in TRAIN_TERMINAL_STATES:
+            return {"job_id": job.id, "status": state["status"]}
+
+        with open(job.cancel_path, "w") as f:
+            f.write(str(time.time()))
+        LORA_VOLUME.commit()
+
+        if state["status"] == "queued" or request.get("force"):
+            try:
+                with open(job.call_id_path) as f:
+                    modal.FunctionCall.from_id(f.read().strip()).cancel()
+            except Exception as cancel_err:
+                print(f"[Modal] WARNING: Could not cancel training call: {cancel_err}")
+            state["status"] = "cancelled"
+            job.save(state)
+        return {"job_id": job.id, "status": state["status"]}
+
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    async def api_generate(self, request: "Request"):
+        """
+        Generate music from text prompt. Supports optional lora_name parameter.
+
+        The body may be JSON with base64 audio, multipart/form-data with a
+        "params" JSON field and src_audio / reference_audio file parts, or raw
+        audio with params in the "params" query parameter. Outputs are returned
+        as base64 JSON unless Accept asks for multipart/form-data (one part per
+        output) or audio/* (first output, streamed). Accept: text/event-stream
+        streams progress as Server-Sent Events (accepted, lm_load, cache, lora,
+        generate, progress, dit_step, transcode, postprocess, encode) ending with a
+        "result" event that carries the JSON response. Add ?measure_memory=1 to
+        report peak per-request memory and ?timings=1 for per-phase timings.
+        With "fan_out": true, a batch_size > 1 request runs as one single-seed
+        shard per output spread over warm shard workers (not with event
+        streams), up to FAN_OUT_MAX_SHARDS outputs; "fan_out" in the response
+        counts the shards sent out and run here.
+        With "lm_seed" set, the LM stage samples with that seed and its output
+        is reused across requests that differ only in DiT settings; "lm_cache"
+        reports hit or miss.
+        audio_format may be wav, mp3, flac or opus, tuned by "encoding":
+        {"bitrate_kbps"} or {"compression_level"}; "encoding" in the response
+        reports each output's size and encode time (kept mixes of isolated
+        stems under "mix").
+        An X-Request-ID header is echoed back and tags the request's log lines.
+        """
+        import asyncio
+
+        trace = self._start_trace(request, "generate")
+        probe = MemoryProbe().start() if request.query_params.get("measure_memory") else None
+        try:
+            with trace.span("parse"):
+                params, inputs, transport = await read_generate_request(request, self.inputs)
+        except Exception as e:
+            if probe:
+                probe.stop()
+            trace.finish("failed", "InvalidRequest")
+            return {"status": "failed", "error": f"Invalid request: {e}", "request_id": trace.id}
+        timings = bool(request.query_params.get("timings") or params.pop("timings", False))
+        mode = response_mode(request)
+        if probe:
+            probe.transport = f"{transport} -> {mode}"
+
+        if mode == "events":
+            return self._stream_generate(params, inputs, probe, trace, timings)
+        if params.pop("fan_out", False) and int(params.get("batch_size", 1)) > 1:
+            result = await asyncio.to_thread(self._fan_out, params, inputs, trace)
+        else:
+            result = await asyncio.to_thread(self._generate, params, inputs, trace=trace)
+        return render_generate_response(result, mode, probe, trace, timings)
+
+    @modal.method()
+    def generate_shard(self, request: dict, inputs: dict) -> dict:
+        """
+        Run one fan-out shard. `inputs` maps input names to audio bytes; the
+        result carries its outputs as bytes under "outputs" / "mix_outputs".
+        """
+        self.shard_executor.mark_busy(self.worker_id)
+        try:
+            return self._run_shard(request, inputs)
+        finally:
+            self.shard_executor.mark_idle(self.worker_id)
+
+    def _run_shard(self, request: dict, inputs: dict) -> dict:
+        # Logged under the id of the request that fanned out
+        request = dict(request)
+        _request_id.set(request.pop("request_id", None))
+        trace = RequestTrace(_request_id.get())
+        staged = {name: self.inputs.put_bytes(name, data) for name, data in inputs.items()}
+        result = self._generate(request, staged, trace=trace)
+        if result.get("status") == "succeeded":
+            result["outputs"] = read_outputs(result.pop("paths"))
+            result["mix_outputs"] = read_outputs(result.pop("mix_paths", []))
+        result["timings"] = trace.snapshot()
+        return result
+
+    def _fan_out(self, params: dict, inputs: dict, trace: RequestTrace) -> dict:
+        """
+        Split a multi-output request into single-seed shards, run them
+        concurrently through self.shard_executor and gather the outputs in
+        seed order. Failed shards are reported under "shards" and skipped, so
+        the result is partial rather than failed unless every shard failed.
+        Shards beyond the executor's warm capacity run in this container; with
+        none, the request runs as one ordinary batch here.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        count = int(params.get("batch_size", 1))
+        if count > FAN_OUT_MAX_SHARDS:
+            remove_files(inputs.values())
+            return {
+                "status": "failed",
+                "error": f"fan_out allows at most {FAN_OUT_MAX_SHARDS} outputs, got batch_size {count}",
+                "error_type": "InvalidRequest",
+            }
+        remote = self.shard_executor.capacity(count)
+        if remote == 0:
+            log(f"No warm shard workers; generating {count} seeds as one batch")
+            result = self._generate(params, inputs, trace=trace)
+            result["fan_out"] = {"remote_shards": 0, "local_shards": 0}
+            return result
+        seeds = fan_out_seeds(params, count)
+        try:
+            payload = {}
+            for name, path in inputs.items():
+                with open(path, "rb") as f:
+                    payload[name] = f.read()
+        finally:
+            remove_files(inputs.values())
+
+        shards = [
+            {**params, "batch_size": 1, "seed": seed, "use_random_seed": False, "request_id": trace.id}
+            for seed in seeds
+        ]
+        log(f"Fanning out {count} seeds, {remote} to shard workers")
+        with trace.span("fan_out"), ThreadPoolExecutor(max_workers=1) as local:
+            local_futures = [local.submit(self._run_shard, shard, payload) for shard in shards[remote:]]
+            results = self.shard_executor.map(shards[:remote], [payload] * remote)
+            for future in local_futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    results.append(e)
+
+        result = {"status": "succeeded", "paths": [], "mix_paths": [], "stems": [], "seeds": [], "shards": []}
+        try:
+            for seed, shard in zip(seeds, results):
+                if isinstance(shard, Exception):
+                    shard = {"status": "failed", "error": str(shard), "error_type": type(shard).__name__}
+                report = {"seed": seed, "status": shard.get("status", "failed")}
+                if report["status"] != "succeeded":
+                    report["error"] = shard.get("error")
+                    result["shards"].append(report)
+                    continue
+                report.update(cache=shard.get("cache"), encoding=shard.get("encoding"), timings=shard.get("timings"))
+                result["shards"].append(report)
+                result["seeds"].append(seed)
+                result["format"] = shard["format"]
+                for data in shard["outputs"]:
+                    result["paths"].append(new_temp_path(self.temp_dir, "shard", shard["format"]))
+                    with open(result["paths"][-1], "wb") as f:
+                        f.write(data)
+                for data in shard.get("mix_outputs", []):
+                    result["mix_format"] = shard["mix_format"]
+                    result["mix_paths"].append(new_temp_path(self.temp_dir, "shard_mix", shard["mix_format"]))
+                    with open(result["mix_paths"][-1], "wb") as f:
+                        f.write(data)
+                result["stems"].extend(shard.get("stems", []))
+        except Exception:
+            remove_files(result["paths"] + result["mix_paths"])
+            raise
+
+        failed = [report for report in result["shards"] if report["status"] != "succeeded"]
+        if len(failed) == len(seeds):
+            return {
+                "status": "failed",
+                "error": f"All {len(seeds)} fan-out shards failed: {failed[0]['error']}",
+                "error_type": "FanOutFailed",
+                "shards": result["shards"],
+            }
+        if failed:
+            log(f"Fan-out returned {len(seeds) - len(failed)}/{len(seeds)} outputs")
+        result["partial"] = bool(failed)
+        result["fan_out"] = {"remote_shards": remote, "local_shards": count - remote}
+        for key in ("mix_paths", "stems"):
+            if not result[key]:
+                del result[key]
+        return result
+
+    def _start_trace(self, request, endpoint: str) -> RequestTrace:
+        """Open the trace for an incoming request and tag this request's logs with its id."""
+        trace = RequestTrace((request.headers.get("x-request-id") or "")[:64] or None)
+        trace.attrs["bytes_in"] = int(request.headers.get("content-length") or 0)
+        trace.on_finish = lambda finished: self.metrics.record(finished, endpoint)
+        _request_id.set(trace.id)
+        return trace
+
+    def _stream_generate(self, params: dict, inputs: dict, probe: MemoryProbe = None,
+                         trace: RequestTrace = None, timings: bool = False):
+        """Run _generate on a worker thread and stream its progress as Server-Sent Events."""
+        import asyncio
+        from fastapi.responses import StreamingResponse
+
+        trace = trace or RequestTrace()
+        context = contextvars.copy_context()
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+        reporter = ProgressReporter(lambda event, data: loop.call_soon_threadsafe(events.put_nowait, (event, data)))
+        staged = {name: os.path.getsize(path) for name, path in inputs.items()}
+
+        handed_off = threading.Event()
+
+        def discard(result):
+            remove_files(result.get("paths", []) + result.get("mix_paths", []))
+
+        def abandon():
+            # Until run() hands them to _generate (which removes them), the
+            # staged inputs are this stream's to clean up
+            if not handed_off.is_set():
+                remove_files(inputs.values())
+                if probe:
+                    probe.stop()
+                trace.finish("aborted")
 
-# ---------------------------------------------------------------------------
-# Modal App & Image
-# ---------------------------------------------------------------------------
+        def run():
+            try:
+                result = self._generate(params, inputs, reporter, trace)
+            except Exception as e:
+                result = {"status": "failed", "error": str(e), "error_type": type(e).__name__}
+            if reporter.closed:
+                discard(result)
+            else:
+                loop.call_soon_threadsafe(events.put_nowait, (None, result))
 
-app = modal.App("acestep")
+        async def stream():
+            result = None
+            try:
+                handed_off.set()
+                loop.run_in_executor(None, context.run, run)
+                yield sse_event("accepted", {"inputs": staged, "request_id": trace.id, "t_ms": 0.0})
+                while result is None:
+                    try:
+                        event, data = await asyncio.wait_for(events.get(), SSE_KEEPALIVE_INTERVAL)
+                    except asyncio.TimeoutError:
+                        yield ": keepalive\n\n"
+                        continue
+                    if event is None:
+                        result = data
+                    else:
+                        yield sse_event(event, data)
 
-CHECKPOINT_DIR = "/opt/ACE-Step/checkpoints"
-LORA_VOLUME = modal.Volume.from_name("acestep-loras", create_if_missing=True)
-LORA_DIR = "/loras"
+                if result.get("status") == "succeeded":
+                    elapsed = round((time.perf_counter() - reporter.started) * 1000, 1)
+                    yield sse_event("encode", {"outputs": len(result["paths"]), "t_ms": elapsed})
+                payload = await asyncio.to_thread(render_generate_response, result, "json", probe, trace, timings)
+                yield sse_event("result", payload)
+            finally:
+                # On disconnect, whatever is still pending is dropped with its outputs
+                reporter.closed = True
+                while not events.empty():
+                    event, data = events.get_nowait()
+                    if event is None:
+                        discard(data)
+                if result is None:
+                    if probe:
+                        probe.stop()
+                    trace.finish("aborted")
 
-# Build the container image with all dependencies + pre-downloaded models
-acestep_image = (
-    modal.Image.debian_slim(python_version="3.11")
-    .apt_install("git", "ffmpeg", "libsndfile1")
-    .pip_install(
-        "torch>=2.1.0",
-        "torchaudio>=2.1.0",
-        "transformers>=4.51.0,<4.58.0",
-        "accelerate>=1.12.0",
-        "diffusers>=0.33.0",
-        "safetensors>=0.4.0",
-        "soundfile>=0.12.0",
-        "librosa>=0.10.0",
-        "numpy>=1.24.0",
-        "scipy>=1.11.0",
-        "huggingface_hub>=0.20.0",
-        "pydantic>=2.0.0",
-        "einops>=0.7.0",
-        "rotary-embedding-torch>=0.5.0",
-        "fastapi[standard]",
-        # ACE-Step runtime deps (installed with --no-deps to avoid torch conflicts)
-        "loguru>=0.7.3",
-        "matplotlib>=3.7.5",
-        "diskcache",
-        "numba>=0.63.1",
-        "vector-quantize-pytorch>=1.27.15",
-        "torchcodec>=0.9.1",
-        "peft>=0.18.0",
-        "lightning>=2.0.0",
-        "tensorboard>=2.0.0",
-        "toml",
-        "pypinyin",
-        "modelscope",
-    )
-    .run_commands(
-        # Clone ACE-Step 1.5 repo
-        "git clone --depth 1 https://github.com/ACE-Step/ACE-Step-1.5.git /opt/ACE-Step",
-        # Install nano-vllm (local third-party dependency)
-        "cd /opt/ACE-Step/acestep/third_parts/nano-vllm && pip install .",
-        # Install hatchling build backend + the package itself
-        "pip install hatchling",
-        "cd /opt/ACE-Step && pip install --no-deps .",
-    )
-    # Download model weights at IMAGE BUILD TIME (not at cold start)
-    .run_commands(
-        f"python -c \""
-        f"from huggingface_hub import snapshot_download; "
-        f"snapshot_download(repo_id='ACE-Step/Ace-Step1.5', local_dir='{CHECKPOINT_DIR}'); "
-        f"snapshot_download(repo_id='ACE-Step/acestep-5Hz-lm-4B', local_dir='{CHECKPOINT_DIR}/acestep-5Hz-lm-4B')"
-        f"\"",
-    )
-)
+        # A client that disconnects before the body is iterated never runs the
+        # generator, so its finally cannot clean up; dropping it still does
+        body = stream()
+        weakref.finalize(body, abandon)
+        return StreamingResponse(
+            body,
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
 
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    async def api_release_task(self, request: "Request"):
+        """
+        Queue a generation job and return its task id immediately.
+        Accepts the same bodies as api_generate; poll api_query_result for the outcome.
+        The job runs as a spawned generate_job call, queued by Modal until a
+        container has room for it.
+        """
+        import asyncio
 
-# ---------------------------------------------------------------------------
-# Inference Class
-# ---------------------------------------------------------------------------
+        try:
+            params, inputs, _ = await read_generate_request(request, self.inputs)
+        except Exception as e:
+            return api_envelope(None, code=400, error=f"Invalid request: {e}")
 
-@app.cls(
-    image=acestep_image,
-    gpu="A10G",  # 24GB VRAM
-    timeout=600,
-    scaledown_window=120,  # Keep warm for 2 min after last request
-    allow_concurrent_inputs=1,
-    volumes={LORA_DIR: LORA_VOLUME},
-)
-class AceStepInference:
-    """ACE-Step music generation inference endpoint."""
+        job = {
+            "id": uuid.uuid4().hex,
+            "status": "queued",
+            "result": None,
+            "created_at": time.time(),
+            "finished_at": None,
+            "progress_text": "",
+        }
+        payload = {
+            "params": params,
+            "created_at": job["created_at"],
+            "bytes_in": int(request.headers.get("content-length") or 0),
+        }
+        try:
+            # The job may run on another container, so its inputs travel as bytes
+            data = await asyncio.to_thread(read_outputs, list(inputs.values()))
+        finally:
+            remove_files(inputs.values())
+        self.shared_jobs.publish(job)
+        try:
+            call_id = await asyncio.to_thread(self.job_runner.spawn, job["id"], payload, dict(zip(inputs, data)))
+        except Exception as e:
+            job.update(status="failed", finished_at=time.time(), result={
+                "status": "failed",
+                "error": f"Could not start job: {e}",
+                "error_type": type(e).__name__,
+            })
+            self.shared_jobs.publish(job)
+            return api_envelope(None, code=503, error=job["result"]["error"])
+        self.shared_jobs.set_call(job["id"], call_id)
+        return api_envelope({"task_id": job["id"], "status": job["status"]})
 
-    @modal.enter()
-    def load_model(self):
-        """Load model into GPU on container startup (weights already in image)."""
-        import os
-        import sys
-        sys.path.insert(0, "/opt/ACE-Step")
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    async def api_cascade(self, request: "Request"):
+        """
+        Run an ordered list of lego steps back to back, feeding each step's
+        output mix to the next as src_audio without leaving the server.
 
-        from acestep.handler import AceStepHandler
-        self.handler = AceStepHandler()
-
-        status_msg, ok = self.handler.initialize_service(
-            project_root="/opt/ACE-Step",
-            config_path="acestep-v15-turbo",
-            device="cuda",
-            use_flash_attention=True,
-            compile_model=False,
-            offload_to_cpu=False,
-            offload_dit_to_cpu=False,
-        )
-        if not ok:
-            raise RuntimeError(f"Model init failed: {status_msg}")
-        print("[Modal] DiT loaded: acestep-v15-turbo")
+        Body: {"steps": [<api_generate params>, ...], ...shared params}, as JSON
+        or as multipart with the initial mix as the src_audio part. Steps may
+        carry a clip_id, which is echoed back. The response is NDJSON: one line
+        per step with the new cumulative mix as base64 "output" (or an "error",
+        in which case the next step reuses the previous mix), then
+        {"done": true}. With "postprocess", "output" is the step's isolated
+        stem, "stem" carries its peaks, and the mix is sent as "mix" only if
+        include_mix is set; the server keeps chaining on the full mix.
 
-        # Initialize 5Hz LM (4B) with vllm backend
-        from acestep.llm_inference import LLMHandler
-        self.llm_handler = LLMHandler()
-        lm_status, lm_ok = self.llm_handler.initialize(
-            checkpoint_dir=os.path.join("/opt/ACE-Step", "checkpoints"),
-            lm_model_path="acestep-5Hz-lm-4B",
-            backend="vllm",
-            device="cuda",
-        )
-        if not lm_ok:
-            print(f"[Modal] WARNING: LM init failed: {lm_status}. Continuing without LM.")
-            self.llm_handler = None
-        else:
-            print("[Modal] LM loaded: acestep-5Hz-lm-4B (vllm)")
+        The whole stream is one Modal input, so once CASCADE_BUDGET has passed
+        no further step is started: "count" in the final line says how many
+        steps ran and "remaining" how many the client still has to send, with
+        the last mix as src_audio.
+        """
+        import base64
+        from fastapi.responses import StreamingResponse
 
-        self.temp_dir = "/tmp/acestep_audio"
-        os.makedirs(self.temp_dir, exist_ok=True)
+        started = time.monotonic()
+        trace = self._start_trace(request, "cascade")
+        try:
+            with trace.span("parse"):
+                params, inputs, _ = await read_generate_request(request, self.inputs)
+        except Exception as e:
+            trace.finish("failed", "InvalidRequest")
+            return {"status": "failed", "error": f"Invalid request: {e}", "request_id": trace.id}
+        steps = params.pop("steps", [])
+        mix_path = inputs.pop("src_audio", None)
+        remove_files(inputs.values())
 
-    @modal.fastapi_endpoint(method="GET", docs=True)
-    def api_list_loras(self):
-        """List all trained LoRA adapters stored on the persistent volume."""
-        import os
+        def run_cascade():
+            nonlocal mix_path
+            failed = 0
+            count = 0
+            try:
+                for index, step in enumerate(steps):
+                    if index and time.monotonic() - started > CASCADE_BUDGET:
+                        log(f"Cascade budget of {CASCADE_BUDGET:.0f}s spent, leaving {len(steps) - index} steps to the client")
+                        break
+                    # Each chunk may be produced on a different threadpool thread
+                    _request_id.set(trace.id)
+                    step_inputs = {}
+                    if mix_path:
+                        # _generate consumes its inputs, so hand it its own link to the mix
+                        step_inputs["src_audio"] = new_temp_path(self.temp_dir, "src_audio")
+                        os.link(mix_path, step_inputs["src_audio"])
+
+                    step_params = {**params, **step}
+                    options = postprocess_options(step_params)
+                    if options:
+                        # The next step needs the full mix even if the client does not
+                        step_params["postprocess"] = {**options, "include_mix": True}
+
+                    result = self._generate(step_params, step_inputs, trace=trace)
+                    event = {"index": index, "clip_id": step.get("clip_id"), "status": result["status"]}
+                    if result["status"] == "succeeded" and result["paths"]:
+                        mixes = result.get("mix_paths", result["paths"])
+                        remove_files([mix_path] if mix_path else [])
+                        mix_path = mixes[0]
+                        if options:
+                            stem_outputs = read_outputs(result["paths"])
+                            event["output"] = base64.b64encode(stem_outputs[0]).decode("utf-8")
+                            event["stem"] = result["stems"][0]
+                            event["mix_format"] = result["mix_format"]
+                            if options["include_mix"]:
+                                with open(mix_path, "rb") as f:
+                                    event["mix"] = base64.b64encode(f.read()).decode("utf-8")
+                        else:
+                            with open(mix_path, "rb") as f:
+                                event["output"] = base64.b64encode(f.read()).decode("utf-8")
+                        remove_files(mixes[1:])
+                        event.update({k: result.get(k) for k in ("format", "cache", "lora")})
+                    else:
+                        failed += 1
+                        event["status"] = "failed"
+                        event["error"] = result.get("error", "No outputs produced")
+                    log(f"Cascade step {index + 1}/{len(steps)} {event['status']}")
+                    count += 1
+                    line = json.dumps(event) + "\n"
+                    trace.attrs["bytes_out"] += len(line)
+                    yield line
+                done = {"done": True, "count": count, "remaining": len(steps) - count, "request_id": trace.id}
+                if params.get("timings"):
+                    done["timings"] = trace.snapshot()
+                yield json.dumps(done) + "\n"
+                status = "succeeded" if not failed else "partial" if failed < count else "failed"
+                trace.finish(status, "CascadeStepFailed" if failed else None)
+            finally:
+                remove_files([mix_path] if mix_path else [])
+                trace.finish("aborted")
+
+        return StreamingResponse(
+            run_cascade(),
+            media_type="application/x-ndjson",
+            headers={"X-Request-ID": trace.id},
+        )
+
+    @modal.fastapi_endpoint(method="POST", docs=True)
+    def api_query_result(self, request: dict):
+        """
+        Report the status of queued jobs in the ACE-Step 1.5 query_result format.
+        Audio is fetched separately through api_task_audio.
+        """
         import json
 
-        LORA_VOLUME.reload()
-        loras = []
-        if os.path.isdir(LORA_DIR):
-            for name in sorted(os.listdir(LORA_DIR)):
-                lora_path = os.path.join(LORA_DIR, name)
-                if not os.path.isdir(lora_path):
-                    continue
-                # Read metadata if exists
-                meta_path = os.path.join(lora_path, "meta.json")
-                meta = {}
-                if os.path.exists(meta_path):
-                    with open(meta_path) as f:
-                        meta = json.load(f)
-                # Check for safetensors weights
-                has_weights = any(
-                    f.endswith(".safetensors") or f.endswith(".bin")
-                    for f in os.listdir(lora_path)
-                )
-                loras.append({
-                    "name": name,
-                    "has_weights": has_weights,
-                    "created_at": meta.get("created_at"),
-                    "epochs": meta.get("epochs"),
-                    "rank": meta.get("rank"),
-                    "num_files": meta.get("num_files"),
+        entries = []
+        for task_id in request.get("task_id_list", []):
+            record = self.shared_jobs.get(task_id)
+            if record is not None and record["status"] in ("queued", "running"):
+                record = self._check_job(task_id, record)
+            if record is None:
+                entries.append({
+                    "task_id": task_id,
+                    "status": TASK_FAILED,
+                    "result": "Unknown or expired task",
+                    "progress_text": "",
+                })
+                continue
+
+            if record["status"] in ("queued", "running"):
+                entries.append({
+                    "task_id": task_id,
+                    "status": TASK_PROCESSING,
+                    "result": "",
+                    "progress_text": "Queued" if record["status"] == "queued" else (record["progress_text"] or "Generating..."),
+                })
+            elif record["status"] == "succeeded":
+                result = record["result"]
+                items = []
+                for i in range(result["output_count"]):
+                    item = {
+                        "file": f"/v1/audio?task_id={task_id}&index={i}",
+                        "wave": "",
+                        "status": TASK_SUCCEEDED,
+                        "create_time": int(record["finished_at"]),
+                        "env": "modal",
+                        "prompt": "",
+                        "lyrics": "",
+                        "metas": {},
+                    }
+                    if result.get("stems"):
+                        item["stem"] = result["stems"][i]
+                    if result.get("timings"):
+                        item["timings"] = result["timings"]
+                    if result.get("lm_cache"):
+                        item["lm_cache"] = result["lm_cache"]
+                    if i < len(result.get("encoding", {}).get("outputs", [])):
+                        item["encoding"] = {"format": result["encoding"]["format"], **result["encoding"]["outputs"][i]}
+                    if i < result["mix_count"]:
+                        item["mix_file"] = f"/v1/audio?task_id={task_id}&index={i}&kind=mix"
+                    mix_encoding = result.get("encoding", {}).get("mix")
+                    if mix_encoding and i < len(mix_encoding["outputs"]):
+                        item["mix_encoding"] = {"format": mix_encoding["format"], **mix_encoding["outputs"][i]}
+                    items.append(item)
+                entries.append({
+                    "task_id": task_id,
+                    "status": TASK_SUCCEEDED,
+                    "result": json.dumps(items),
+                    "progress_text": "Done",
+                })
+            else:
+                entries.append({
+                    "task_id": task_id,
+                    "status": TASK_FAILED,
+                    "result": record["result"].get("error", record["status"]),
+                    "progress_text": record["status"],
                 })
-        return {"loras": loras}
+        return api_envelope(entries)
 
     @modal.fastapi_endpoint(method="POST", docs=True)
-    def api_train(self, request: dict):
+    def api_cancel_task(self, request: dict):
         """
-        Train a LoRA adapter from uploaded audio files.
-        Audio files are provided as base64-encoded data.
-        Training runs asynchronously and saves weights to the persistent volume.
+        Cancel a queued job: its generate_job call is cancelled, and a call
+        that starts anyway stops at once. Jobs that already started run to
+        completion.
         """
-        import os
-        import sys
-        import base64
-        import json
-        import traceback
-        import uuid
-        sys.path.insert(0, "/opt/ACE-Step")
+        task_id = request.get("task_id", "")
+        record = self.shared_jobs.get(task_id)
+        if record is None:
+            return api_envelope(None, code=404, error=f"Unknown task: {task_id}")
+        if record["status"] == "queued":
+            self.shared_jobs.request_cancel(task_id)
+            call_id = self.shared_jobs.call_id(task_id)
+            if call_id:
+                try:
+                    self.job_runner.cancel(call_id)
+                except Exception as e:
+                    log(f"WARNING: Could not cancel call of job {task_id}: {e}")
+            record = self.shared_jobs.publish({
+                "id": task_id,
+                "status": "cancelled",
+                "progress_text": "",
+                "created_at": record["created_at"],
+                "finished_at": time.time(),
+                "result": {"status": "cancelled", "error": "Cancelled before start"},
+            })
+        return api_envelope({"task_id": task_id, "status": record["status"]})
 
-        try:
-            lora_name = request.get("lora_name", "").strip()
-            if not lora_name:
-                return {"status": "failed", "error": "lora_name is required"}
+    @modal.fastapi_endpoint(method="GET", docs=True)
+    def api_task_audio(self, task_id: str, index: int = 0, kind: str = "output"):
+        """
+        Download one output of a finished job as raw audio bytes. kind=mix
+        fetches the full mix kept alongside a post-processed stem.
+        """
+        from fastapi.responses import JSONResponse, Response
 
-            audio_files = request.get("audio_files", [])
-            if not audio_files:
-                return {"status": "failed", "error": "No audio files provided"}
+        # Outputs are on the cache volume, written by whichever container ran the job
+        record = self.shared_jobs.get(task_id) or {}
+        result = record.get("result") or {}
+        count = result.get("mix_count" if kind == "mix" else "output_count", 0)
+        if result.get("status") != "succeeded":
+            return JSONResponse({"error": f"No audio for task: {task_id}"}, status_code=404)
+        if not 0 <= index < count:
+            return JSONResponse({"error": f"Output index out of range: {index}"}, status_code=404)
+        data = self.shared_jobs.read_output(task_id, kind, index)
+        if data is None:
+            return JSONResponse({"error": f"Output not available yet for task: {task_id}"}, status_code=503)
 
-            epochs = request.get("epochs", 100)
-            learning_rate = request.get("learning_rate", 0.0001)
-            lora_rank = request.get("lora_rank", 16)
-            batch_size = request.get("batch_size", 1)
-            save_every = request.get("save_every", 50)
+        audio_format = result.get("mix_format") if kind == "mix" else result.get("format")
+        media_type = AUDIO_MEDIA_TYPES.get(audio_format, "application/octet-stream")
+        self.metrics.inc("acestep_output_bytes_total", len(data), endpoint="task_audio")
+        return Response(content=data, media_type=media_type)
 
-            # Create temp training data directory
-            train_data_dir = f"/tmp/lora_train_{uuid.uuid4().hex}"
-            os.makedirs(train_data_dir, exist_ok=True)
+    @modal.fastapi_endpoint(method="GET", docs=True)
+    def api_health(self):
+        """Liveness probe with the container's startup report and LM state."""
+        return {"status": "ok", "lm": self.lm.state, "startup": self.startup.snapshot()}
 
-            # Decode audio files to disk
-            for i, af in enumerate(audio_files):
-                name = af.get("name", f"audio_{i}.wav")
-                data = af.get("data", "")
-                if not data:
-                    continue
-                out_path = os.path.join(train_data_dir, name)
-                with open(out_path, "wb") as f:
-                    f.write(base64.b64decode(data))
+    @modal.fastapi_endpoint(method="GET", docs=True)
+    def api_stats(self):
+        """Queue and result-cache statistics, in the ACE-Step 1.5 /v1/stats envelope."""
+        jobs = self.shared_jobs.counts()
+        return api_envelope({
+            "queue_size": jobs["queued"],
+            "running_tasks": jobs["running"],
+            "result_cache": self.result_cache.snapshot(),
+            "input_store": self.inputs.snapshot(),
+            "decoded_audio": self.decoded_audio.snapshot(),
+            "silent_latents": self.silent_latents.snapshot(),
+            "lm_cache": self.lm_cache.snapshot(),
+            "dit_passes": self.pass_stats.snapshot(),
+            "encoding": self.encoder.snapshot(),
+        })
 
-            # Create output directory on persistent volume
-            LORA_VOLUME.reload()
-            lora_output_dir = os.path.join(LORA_DIR, lora_name)
-            os.makedirs(lora_output_dir, exist_ok=True)
+    @modal.fastapi_endpoint(method="GET", docs=True)
+    def api_metrics(self):
+        """
+        Request counters and phase latency histograms in the Prometheus text
+        format. Each container reports its own series; scrape or sum per container.
+        """
+        from fastapi.responses import Response
 
-            # Try to run training using ACE-Step's built-in training
-            try:
-                from acestep.training.lora_trainer import LoraTrainer
+        gauges = {
+            "acestep_running_tasks": len(self.running_jobs),
+            "acestep_lm_loaded": 1 if self.lm.state == "loaded" else 0,
+            "acestep_result_cache_hot_bytes": self.result_cache.snapshot()["hot_bytes"],
+            "acestep_input_store_bytes": self.inputs.snapshot()["bytes"],
+        }
+        return Response(content=self.metrics.render(gauges), media_type="text/plain; version=0.0.4")
 
-                trainer = LoraTrainer(
-                    dit_handler=self.handler,
-                    data_dir=train_data_dir,
-                    output_dir=lora_output_dir,
-                    lora_rank=lora_rank,
-                    epochs=epochs,
-                    learning_rate=learning_rate,
-                    batch_size=batch_size,
-                    save_every=save_every,
-                )
-                trainer.train()
-                training_method = "native"
-            except ImportError:
-                # Fallback: use subprocess to call ACE-Step training CLI
-                import subprocess
-                # Create a training config
-                config = {
-                    "data_dir": train_data_dir,
-                    "output_dir": lora_output_dir,
-                    "lora_rank": lora_rank,
-                    "epochs": epochs,
-                    "learning_rate": learning_rate,
-                    "batch_size": batch_size,
-                    "save_every": save_every,
-                }
-                config_path = os.path.join(train_data_dir, "train_config.json")
-                with open(config_path, "w") as f:
-                    json.dump(config, f)
-
-                # Try the CLI training command
-                result = subprocess.run(
-                    ["python", "-m", "acestep.training.train_lora",
-                     "--config", config_path,
-                     "--checkpoint_dir", CHECKPOINT_DIR],
-                    capture_output=True, text=True, cwd="/opt/ACE-Step",
-                    timeout=3600,  # 1 hour max
-                )
-                if result.returncode != 0:
-                    # Training CLI may not exist yet; save audio files for manual training
-                    print(f"[Modal] Training CLI not available: {result.stderr[:500]}")
-                    training_method = "manual_setup"
-                else:
-                    training_method = "cli"
-
-            # Save metadata
-            meta = {
-                "name": lora_name,
-                "epochs": epochs,
-                "learning_rate": learning_rate,
-                "rank": lora_rank,
-                "batch_size": batch_size,
-                "num_files": len(audio_files),
-                "created_at": __import__("datetime").datetime.now().isoformat(),
-                "training_method": training_method,
-            }
-            with open(os.path.join(lora_output_dir, "meta.json"), "w") as f:
-                json.dump(meta, f, indent=2)
+    def _run_batch(self, items: list) -> list:
+        """
+        Run compatible requests as one generate_music call and split the outputs.
 
-            # Copy audio files to volume for potential retraining
-            audio_backup_dir = os.path.join(lora_output_dir, "training_data")
-            os.makedirs(audio_backup_dir, exist_ok=True)
-            for fname in os.listdir(train_data_dir):
-                if fname.endswith((".wav", ".mp3", ".flac", ".ogg")):
-                    import shutil
-                    shutil.copy2(os.path.join(train_data_dir, fname), audio_backup_dir)
+        Items share everything but their output count, so the first item's
+        params are used with the summed batch size.
+        """
+        import dataclasses
+        import inspect
+        import torch
+        from acestep.inference import generate_music
 
-            LORA_VOLUME.commit()
+        first = items[0]
+        sizes = [item["config"].batch_size for item in items]
+        config = dataclasses.replace(first["config"], batch_size=sum(sizes))
+        reporters = [item["progress"] for item in items if item.get("progress")]
+        traces = [item["trace"] for item in items if item.get("trace")]
+        total_steps = first["params"].inference_steps
+        lm_seed = first.get("lm_seed")
+        lm_key = LMOutputCache.key(first["params"], config.batch_size, lm_seed) if lm_seed is not None else None
 
-            # Cleanup temp dir
-            import shutil
-            shutil.rmtree(train_data_dir, ignore_errors=True)
+        def add_span(name, seconds):
+            for trace in traces:
+                trace.add(name, seconds)
 
-            return {
-                "status": "completed",
-                "lora_name": lora_name,
-                "message": f"LoRA '{lora_name}' training completed via {training_method}. {len(audio_files)} files processed.",
-                "training_method": training_method,
-            }
+        extra = {}
+        if reporters and "progress" in inspect.signature(generate_music).parameters:
+            extra["progress"] = PipelineProgress(reporters)
 
-        except Exception as e:
-            return {
+        # Times of the first and latest DiT passes, and the last step reported
+        pass_marks = []
+        passes_per_step = self.dit_steps.passes_per_step(first["params"])
+        steps = {"passes": 0, "reported": 0}
+
+        def on_pass(n):
+            if len(pass_marks) < 2:
+                pass_marks.append(time.perf_counter())
+            else:
+                pass_marks[1] = time.perf_counter()
+            steps["passes"] = n
+            step = min(math.ceil(n / passes_per_step - 1e-6), total_steps)
+            if step > steps["reported"]:
+                steps["reported"] = step
+                emit_all(reporters, "dit_step", step=step, total=total_steps)
+
+        # Generate (use LM if available for best quality)
+        # LoRA load and generation share the lock so a concurrent request
+        # cannot swap the adapter between the two
+        waited = time.perf_counter()
+        with self._gpu_lock:
+            started = time.perf_counter()
+            add_span("gpu_wait", started - waited)
+            lora_info = self.loras.apply(first["lora_name"], first["lora_weight_path"])
+            add_span("lora_apply", lora_info["swap_ms"] / 1000)
+            if lora_info["action"] != "none":
+                emit_all(reporters, "lora", **lora_info)
+            emit_all(reporters, "generate", batch_requests=len(items))
+            # Peak GPU memory of this pass alone, e.g. to compare windowed runs
+            cuda = torch.cuda.is_available()
+            if cuda:
+                torch.cuda.reset_peak_memory_stats()
+            generate_started = time.perf_counter()
+            with watch_dit_steps(self.handler, on_pass), self.lm_cache.scope(lm_key, lm_seed) as lm_record:
+                result = generate_music(
+                    dit_handler=self.handler,
+                    llm_handler=first["llm_handler"],
+                    params=first["params"],
+                    config=config,
+                    save_dir=self.temp_dir,
+                    **extra,
+                )
+            finished = time.perf_counter()
+            gpu_seconds = finished - started
+            gpu_peak_bytes = torch.cuda.max_memory_allocated() if cuda else None
+
+        add_span("generate", finished - generate_started)
+        if pass_marks:
+            # Split generate_music at the DiT decoder passes: before the first is
+            # the LM and conditioning, after the last is VAE decode and saving
+            add_span("lm", pass_marks[0] - generate_started)
+            add_span("dit", pass_marks[-1] - pass_marks[0])
+            add_span("vae_decode", finished - pass_marks[-1])
+        if steps["passes"] and result.success:
+            self.dit_steps.record(first["params"], steps["passes"])
+            if steps["reported"] < total_steps:
+                emit_all(reporters, "dit_step", step=total_steps, total=total_steps)
+
+        if not result.success:
+            failure = {
                 "status": "failed",
-                "error": str(e),
-                "traceback": traceback.format_exc(),
+                "error": result.error or result.status_message,
+                "error_type": "GenerationFailed",
             }
+            return [dict(failure) for _ in items]
 
-    @modal.fastapi_endpoint(method="POST", docs=True)
-    def api_generate(self, request: dict):
+        self.pass_stats.record(len(items), len(result.audios), gpu_seconds)
+        batch_info = {
+            "requests": len(items),
+            "outputs": sum(sizes),
+            "gpu_ms": round(gpu_seconds * 1000, 1),
+            "gpu_peak_bytes": gpu_peak_bytes,
+        }
+        if len(items) > 1:
+            log(f"Batched {len(items)} requests ({sum(sizes)} outputs) in {batch_info['gpu_ms']} ms")
+
+        outcomes = []
+        offset = 0
+        for size in sizes:
+            audios = result.audios[offset:offset + size]
+            offset += size
+            outcomes.append({
+                "status": "succeeded",
+                "paths": [a["path"] for a in audios if a.get("path") and os.path.exists(a["path"])],
+                "lora": lora_info,
+                "batch": dict(batch_info),
+                "lm_cache": lm_record["status"],
+                "lm_stored": lm_record["stored"],
+            })
+        return outcomes
+
+    def _generate(self, request: dict, inputs: dict, progress: ProgressReporter = None,
+                  trace: RequestTrace = None) -> dict:
         """
-        Generate music from text prompt.
-        Returns base64-encoded audio. Supports optional lora_name parameter.
+        Run one generation request end to end.
+
+        `inputs` maps staged audio input names to temp files, which are removed
+        here. On success the result holds output file paths under "paths"; the
+        caller encodes and removes them. `progress` receives phase events and
+        `trace` the phase timings; the caller finishes the trace.
         """
-        import os
         import sys
-        import base64
         import traceback
         sys.path.insert(0, "/opt/ACE-Step")
 
+        trace = trace or RequestTrace()
+        window_src_path = None
         try:
-            import uuid
-            import tempfile
-            from acestep.inference import (
-                GenerationParams,
-                GenerationConfig,
-                generate_music,
-            )
+            from acestep.inference import GenerationParams, GenerationConfig
             from acestep.constants import DEFAULT_DIT_INSTRUCTION, TASK_INSTRUCTIONS
 
-            # Decode base64 audio inputs to temp files
-            src_audio_path = None
-            reference_audio_path = None
-            temp_files = []
-
-            if request.get("src_audio_base64"):
-                src_audio_path = os.path.join(self.temp_dir, f"src_{uuid.uuid4().hex}.wav")
-                with open(src_audio_path, "wb") as f:
-                    f.write(base64.b64decode(request["src_audio_base64"]))
-                temp_files.append(src_audio_path)
-                print(f"[Modal] Decoded src_audio to {src_audio_path} ({os.path.getsize(src_audio_path)} bytes)")
-
-            if request.get("reference_audio_base64"):
-                reference_audio_path = os.path.join(self.temp_dir, f"ref_{uuid.uuid4().hex}.wav")
-                with open(reference_audio_path, "wb") as f:
-                    f.write(base64.b64decode(request["reference_audio_base64"]))
-                temp_files.append(reference_audio_path)
-                print(f"[Modal] Decoded reference_audio to {reference_audio_path} ({os.path.getsize(reference_audio_path)} bytes)")
+            src_audio_path = inputs.get("src_audio")
+            reference_audio_path = inputs.get("reference_audio")
 
             # Parse request parameters with defaults
             task_type = request.get("task_type", "text2music")
@@ -358,7 +4185,7 @@ class AceStepInference:
             seed = request.get("seed", -1)
             use_random_seed = request.get("use_random_seed", True)
             batch_size = request.get("batch_size", 1)
-            audio_format = request.get("audio_format", "mp3")
+            encoding = encoding_options(request)
             bpm = request.get("bpm", None)
             key_scale = request.get("key_scale", "")
             time_signature = request.get("time_signature", "")
@@ -368,26 +4195,49 @@ class AceStepInference:
             repainting_start = request.get("repainting_start", 0.0)
             repainting_end = request.get("repainting_end", None)
 
-            # Load LoRA adapter if specified
+            # Windowed lego / repaint: the DiT only sees the edited region plus
+            # context margins, cropped from the source, and the output is
+            # spliced back into the full-length source afterwards
+            window = None
+            generation_src_path = src_audio_path
+            options = window_options(request)
+            if options and src_audio_path:
+                window = plan_window(src_audio_path, audio_duration, repainting_start, repainting_end, options)
+            if window:
+                window_src_path = new_temp_path(self.temp_dir, "window")
+                with trace.span("window_crop"):
+                    crop_audio(src_audio_path, window["start"], window["end"], window_src_path)
+                log(f"Generating window {window['start']:.1f}-{window['end']:.1f}s of {window['full_duration']:.1f}s")
+                if progress:
+                    progress.emit("window", **window)
+                generation_src_path = window_src_path
+                audio_duration = window["end"] - window["start"]
+                repainting_start = (repainting_start or 0.0) - window["start"]
+                if repainting_end is not None and repainting_end > 0:
+                    repainting_end = repainting_end - window["start"]
+
             lora_name = request.get("lora_name", "")
-            if lora_name:
-                LORA_VOLUME.reload()
-                lora_path = os.path.join(LORA_DIR, lora_name)
-                if os.path.isdir(lora_path):
-                    # Find the safetensors or bin file
-                    lora_files = [f for f in os.listdir(lora_path) if f.endswith(".safetensors") or f.endswith(".bin")]
-                    if lora_files:
-                        lora_weight_path = os.path.join(lora_path, lora_files[0])
-                        print(f"[Modal] Loading LoRA: {lora_name} from {lora_weight_path}")
-                        try:
-                            self.handler.load_lora(lora_weight_path)
-                            print(f"[Modal] LoRA loaded successfully: {lora_name}")
-                        except Exception as lora_err:
-                            print(f"[Modal] WARNING: LoRA load failed: {lora_err}. Continuing without LoRA.")
-                    else:
-                        print(f"[Modal] WARNING: No weight files found in LoRA dir: {lora_path}")
-                else:
-                    print(f"[Modal] WARNING: LoRA not found: {lora_name}")
+            # An explicit LM seed lets re-rolls reuse the LM stage's output
+            lm_seed = request.get("lm_seed")
+            if lm_seed is not None and int(lm_seed) < 0:
+                lm_seed = None
+
+            # Only thinking / CoT requests wait for the LM; others use it if it
+            # happens to be loaded already. CoT is on unless a request turns it
+            # off, so this checks the same defaults GenerationParams gets below
+            thinking = request.get("thinking", False)
+            use_cot_metas = request.get("use_cot_metas", True)
+            use_cot_caption = request.get("use_cot_caption", True)
+            use_cot_language = request.get("use_cot_language", True)
+            needs_lm = bool(thinking or use_cot_metas or use_cot_caption or use_cot_language)
+            if needs_lm and self.lm.state in ("deferred", "loading"):
+                if progress:
+                    progress.emit("lm_load", state=self.lm.state)
+                # Lazy loading allocates the LM's weights and KV cache, so no
+                # DiT pass may run meanwhile and take the memory it sized for
+                with trace.span("lm_load"), self._gpu_lock:
+                    self.lm.load()
+            llm_handler = self.lm.load() if needs_lm else self.lm.handler
 
             # Determine if instrumental
             is_instrumental = not lyrics or lyrics.strip().lower() in ("", "[inst]", "[instrumental]")
@@ -402,7 +4252,7 @@ class AceStepInference:
                 task_type=task_type,
                 instruction=instruction,
                 reference_audio=reference_audio_path,
-                src_audio=src_audio_path,
+                src_audio=generation_src_path,
                 audio_codes="",
                 caption=prompt,
                 lyrics=lyrics,
@@ -424,15 +4274,15 @@ class AceStepInference:
                 repainting_start=repainting_start,
                 repainting_end=repainting_end if repainting_end else -1,
                 audio_cover_strength=audio_cover_strength,
-                thinking=request.get("thinking", False),
+                thinking=thinking,
                 lm_temperature=request.get("lm_temperature", 0.85),
                 lm_cfg_scale=request.get("lm_cfg_scale", 2.5),
                 lm_top_k=request.get("lm_top_k", 0),
                 lm_top_p=request.get("lm_top_p", 0.9),
                 lm_negative_prompt=request.get("lm_negative_prompt", "NO USER INPUT"),
-                use_cot_metas=request.get("use_cot_metas", True),
-                use_cot_caption=request.get("use_cot_caption", True),
-                use_cot_language=request.get("use_cot_language", True),
+                use_cot_metas=use_cot_metas,
+                use_cot_caption=use_cot_caption,
+                use_cot_language=use_cot_language,
                 use_constrained_decoding=request.get("use_constrained_decoding", True),
             )
 
@@ -441,61 +4291,435 @@ class AceStepInference:
                 allow_lm_batch=False,
                 use_random_seed=use_random_seed,
                 seeds=None,
-                audio_format=audio_format,
+                # Outputs are encoded by self.encoder once the GPU is released
+                # (and windows spliced and stems isolated), so the pass writes WAV
+                audio_format="wav",
                 constrained_decoding_debug=False,
             )
 
-            # Generate (use LM if available for best quality)
-            result = generate_music(
-                dit_handler=self.handler,
-                llm_handler=self.llm_handler,
-                params=params,
-                config=config,
-                save_dir=self.temp_dir,
-            )
+            with trace.span("lora_resolve"):
+                lora_weight_path = self.loras.resolve(lora_name) if lora_name else None
 
-            if not result.success:
-                return {
-                    "status": "failed",
-                    "error": result.error or result.status_message,
-                }
+            # Explicitly seeded requests are deterministic, so identical inputs
+            # can be served from the result cache instead of a GPU pass.
+            # Randomly seeded requests can instead share a batched DiT pass.
+            cacheable = not (use_random_seed or seed in (None, -1)) and request.get("use_cache", True)
+            batchable = self.batcher is not None and use_random_seed and request.get("allow_batching", True)
+            fingerprint = None
+            if cacheable or batchable:
+                with trace.span("fingerprint"):
+                    fingerprint = {
+                        "model": "acestep-v15-turbo",
+                        "lm": llm_handler is not None,
+                        "params": {
+                            **vars(params),
+                            "src_audio": file_sha256(src_audio_path) if src_audio_path else None,
+                            "reference_audio": file_sha256(reference_audio_path) if reference_audio_path else None,
+                        },
+                        "config": vars(config),
+                        "lora": [lora_name, file_sha256(lora_weight_path)] if lora_weight_path else None,
+                        # The cached output is the spliced full-length file,
+                        # post-processed and encoded as this request asked
+                        "window": window,
+                        "postprocess": postprocess_options(request),
+                        "encoding": encoding,
+                    }
+                    if lm_seed is not None:
+                        fingerprint["lm_seed"] = lm_seed
 
-            # Encode audio files as base64
-            outputs = []
-            for audio in result.audios:
-                path = audio.get("path", "")
-                if path and os.path.exists(path):
-                    with open(path, "rb") as f:
-                        audio_b64 = base64.b64encode(f.read()).decode("utf-8")
-                    outputs.append(audio_b64)
-                    try:
-                        os.remove(path)
-                    except Exception:
-                        pass
+            cache_key = None
+            if cacheable:
+                cache_key = canonical_hash(fingerprint)
+                with trace.span("cache_lookup"):
+                    cached = self.result_cache.get(cache_key, self.temp_dir)
+                if cached is not None:
+                    log(f"Result cache hit: {cache_key[:12]}")
+                    trace.attrs["cache"] = "hit"
+                    if progress:
+                        progress.emit("cache", status="hit")
+                    result = {"status": "succeeded", **cached, "cache": "hit"}
+                    if window:
+                        result["window"] = window
+                    return result
+                cache_status = "miss"
+            else:
+                self.result_cache.bypass()
+                cache_status = "bypass"
+            trace.attrs["cache"] = cache_status
 
-            # Clean up temp input files
-            for tf in temp_files:
-                try:
-                    os.remove(tf)
-                except Exception:
-                    pass
+            item = {
+                "params": params,
+                "config": config,
+                "llm_handler": llm_handler,
+                "lora_name": lora_name,
+                "lora_weight_path": lora_weight_path,
+                "progress": progress,
+                "trace": trace,
+                "lm_seed": lm_seed,
+            }
+            if batchable:
+                # Requests batch together only if everything but the random
+                # seed, output count, post-processing and encoding matches
+                group_key = canonical_hash({
+                    **fingerprint,
+                    "params": {**fingerprint["params"], "seed": None},
+                    "config": {**fingerprint["config"], "batch_size": None},
+                    "postprocess": None,
+                    "encoding": None,
+                })
+                outcome = self.batcher.submit(group_key, item, size=batch_size)
+            else:
+                outcome = self._run_batch([item])[0]
 
-            return {
+            if outcome["status"] != "succeeded":
+                return outcome
+
+            paths = outcome["paths"]
+            if window:
+                paths = self._splice(paths, window, src_audio_path, trace)
+            result = {
                 "status": "succeeded",
-                "outputs": outputs,
-                "format": audio_format,
-                "count": len(outputs),
+                "paths": paths,
+                "format": "wav",
+                "cache": cache_status,
+                "lora": outcome["lora"],
+                "batch": outcome["batch"],
             }
+            # Stems are subtracted from the WAV mixes: a lossy encoder's delay
+            # and padding would shift the mix against src_audio
+            result = self._postprocess(result, request, src_audio_path, progress, trace)
+            self._encode(result, encoding, progress, trace)
+            if outcome["lm_cache"]:
+                trace.attrs["lm_cache"] = outcome["lm_cache"]
+                result["lm_cache"] = outcome["lm_cache"]
+            if (cache_key and result["paths"]) or outcome["lm_stored"]:
+                try:
+                    with trace.span("cache_store"):
+                        if cache_key and result["paths"]:
+                            self.result_cache.put(cache_key, result)
+                        CACHE_VOLUME.commit()
+                        if cache_key and result["paths"] and self.result_cache.evict():
+                            CACHE_VOLUME.commit()
+                except Exception as cache_err:
+                    log(f"WARNING: Result cache store failed: {cache_err}")
+            if window:
+                result["window"] = window
+            return result
 
         except Exception as e:
-            # Clean up temp files on error too
-            for tf in temp_files if 'temp_files' in dir() else []:
-                try:
-                    os.remove(tf)
-                except Exception:
-                    pass
             return {
                 "status": "failed",
                 "error": str(e),
+                "error_type": type(e).__name__,
                 "traceback": traceback.format_exc(),
             }
+        finally:
+            remove_files(inputs.values())
+            if window_src_path:
+                remove_files([window_src_path])
+
+    def _splice(self, paths: list, window: dict, src_audio_path: str, trace: RequestTrace) -> list:
+        """Splice generated windows into full-length WAV copies of the source; removes the windows."""
+        spliced = []
+        try:
+            with trace.span("splice"):
+                for path in paths:
+                    spliced.append(new_temp_path(self.temp_dir, "spliced"))
+                    splice_window(src_audio_path, path, window, spliced[-1])
+        except Exception:
+            remove_files(spliced)
+            raise
+        finally:
+            remove_files(paths)
+        return spliced
+
+    def _encode(self, result: dict, encoding: dict, progress: ProgressReporter = None, trace: RequestTrace = None):
+        """
+        Encode the mixes a result returns into the requested format, once any
+        post-processing is done; isolated stems stay WAV. Sets "encoding" to a
+        report of the returned outputs, with the kept mixes under "mix".
+        """
+        wavs = result.get("mix_paths", []) if "stems" in result else result["paths"]
+        if progress and encoding["format"] != "wav" and wavs:
+            progress.emit("transcode", format=encoding["format"], outputs=len(wavs))
+        try:
+            with (trace or RequestTrace()).span("transcode"):
+                encoded, report = self.encoder.encode(wavs, encoding, self.temp_dir)
+        except Exception:
+            remove_files(result["paths"] + result.get("mix_paths", []))
+            raise
+        if "stems" not in result:
+            result["paths"], result["format"] = encoded, encoding["format"]
+        else:
+            mix_report = report
+            _, report = self.encoder.encode(result["paths"], {"format": result["format"]}, self.temp_dir)
+            if "mix_paths" in result:
+                result["mix_paths"], result["mix_format"] = encoded, encoding["format"]
+                report["mix"] = mix_report
+        result["encoding"] = report
+        if trace:
+            trace.attrs["encoding"] = report
+
+    def _postprocess(self, result: dict, request: dict, src_audio_path, progress: ProgressReporter = None,
+                     trace: RequestTrace = None) -> dict:
+        """
+        Replace each output mix with its isolated, trimmed stem when the request
+        asks for "postprocess". The mixes move to "mix_paths" if include_mix is
+        set and are removed otherwise; per-output stem info goes to "stems".
+        """
+        options = postprocess_options(request)
+        if options is None:
+            return result
+        if progress:
+            progress.emit("postprocess", outputs=len(result["paths"]))
+
+        start = request.get("repainting_start", 0.0) if options["trim"] else 0.0
+        end = request.get("repainting_end", None) if options["trim"] else None
+        mixes = result["paths"]
+        stems, stem_paths = [], []
+        try:
+            with (trace or RequestTrace()).span("postprocess"):
+                for mix_path in mixes:
+                    stem_paths.append(new_temp_path(self.temp_dir, "stem"))
+                    stems.append(isolate_stem(
+                        mix_path,
+                        src_audio_path if options["isolate"] else None,
+                        start or 0.0,
+                        end,
+                        options["peaks"],
+                        stem_paths[-1],
+                    ))
+        except Exception:
+            remove_files(mixes + stem_paths)
+            raise
+
+        if options["include_mix"]:
+            result["mix_paths"] = mixes
+            result["mix_format"] = result["format"]
+        else:
+            remove_files(mixes)
+        result.update({"paths": stem_paths, "format": "wav", "stems": stems})
+        return result
+
+
+# ---------------------------------------------------------------------------
+# Training Worker
+# ---------------------------------------------------------------------------
+
+@app.cls(
+    image=acestep_image,
+    gpu="A10G",
+    timeout=4 * 60 * 60,
+    # Preempted or crashed runs are retried and resume from the last checkpoint
+    retries=modal.Retries(max_retries=3, initial_delay=30.0),
+    volumes={LORA_DIR: LORA_VOLUME},
+)
+class AceStepTrainer:
+    """LoRA training worker, scheduled separately from AceStepInference."""
+
+    @modal.enter()
+    def load_model(self):
+        self.handler = load_dit_handler()
+        self.latents = TrainingLatentCache(train_data_path("latents"))
+        self.latents.wrap(self.handler)
+
+    @modal.method()
+    def train(self, job_id: str):
+        """Run (or resume) a queued training job, writing progress to the volume."""
+        import sys
+        import traceback
+        sys.path.insert(0, "/opt/ACE-Step")
+
+        LORA_VOLUME.reload()
+        job = TrainingJob(job_id)
+        state = job.load()
+        if state is None:
+            print(f"[Modal] Training job not found: {job_id}")
+            return None
+        if state["status"] in TRAIN_TERMINAL_STATES:
+            return state
+        if job.cancel_requested():
+            state["status"] = "cancelled"
+            job.save(state)
+            return state
+
+        lora_output_dir = os.path.join(LORA_DIR, state["lora_name"])
+        os.makedirs(lora_output_dir, exist_ok=True)
+        # Only a retry resumes, and only from checkpoints this job wrote: a
+        # LoRA retrained under the same name (e.g. at another rank) still
+        # holds the previous run's checkpoints
+        if state["attempts"] == 0:
+            state["prior_checkpoints"] = checkpoint_marks(lora_output_dir)
+            checkpoint = None
+        else:
+            checkpoint = latest_checkpoint(lora_output_dir, ignore=state.get("prior_checkpoints"))
+
+        state["status"] = "running"
+        state["attempts"] += 1
+        state["started_at"] = state.get("started_at") or time.time()
+        state["resumed_from"] = checkpoint
+        job.save(state)
+        if checkpoint:
+            print(f"[Modal] Resuming training job {job_id} from {checkpoint}")
+
+        # Jobs queued before datasets existed carry their files in job.data_dir
+        manifest = load_training_dataset(state.get("dataset_id"))
+        data_dir = os.path.join("/tmp", "acestep_train", job_id) if manifest else job.data_dir
+
+        last_write = time.monotonic()
+
+        def report(epoch=None, step=None, loss=None, **_):
+            """Record progress; persist it and check for cancellation periodically."""
+            nonlocal last_write
+            for key, value in (("epoch", epoch), ("step", step), ("loss", loss)):
+                if value is not None:
+                    state["progress"][key] = value
+            if time.monotonic() - last_write < TRAIN_PROGRESS_INTERVAL:
+                return
+            last_write = time.monotonic()
+            if job.cancel_requested(reload=True):
+                raise TrainingCancelled()
+            try:
+                job.save(state)
+            except Exception as save_err:
+                print(f"[Modal] WARNING: Could not write training progress: {save_err}")
+
+        try:
+            if manifest:
+                staged = stage_training_dataset(manifest, data_dir)
+                if staged["preprocessed"]:
+                    LORA_VOLUME.commit()
+                state["preprocessed"] = staged
+            self.latents.register(manifest)
+            latents_before = self.latents.snapshot()
+            training_method = self._run_training(job, state, data_dir, lora_output_dir, checkpoint, report)
+            state["latent_cache"] = {
+                key: value - latents_before[key] for key, value in self.latents.snapshot().items()
+            }
+        except TrainingCancelled:
+            print(f"[Modal] Training job {job_id} cancelled")
+            state["status"] = "cancelled"
+            job.save(state)
+            return state
+        except Exception as e:
+            state["status"] = "failed"
+            state["error"] = str(e)
+            state["traceback"] = traceback.format_exc()
+            job.save(state)
+            return state
+
+        # Save metadata
+        config = state["config"]
+        meta = {
+            "name": state["lora_name"],
+            "epochs": config["epochs"],
+            "learning_rate": config["learning_rate"],
+            "rank": config["lora_rank"],
+            "batch_size": config["batch_size"],
+            "num_files": state["num_files"],
+            "created_at": __import__("datetime").datetime.now().isoformat(),
+            "training_method": training_method,
+        }
+        with open(os.path.join(lora_output_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+        # Keep the training set for potential retraining: the dataset manifest
+        # refers to shared blobs, older jobs' files are copied
+        if manifest:
+            with open(os.path.join(lora_output_dir, "training_data.json"), "w") as f:
+                json.dump(manifest, f, indent=2)
+        else:
+            audio_backup_dir = os.path.join(lora_output_dir, "training_data")
+            os.makedirs(audio_backup_dir, exist_ok=True)
+            for fname in os.listdir(job.data_dir):
+                if fname.endswith((".wav", ".mp3", ".flac", ".ogg")):
+                    shutil.copy2(os.path.join(job.data_dir, fname), audio_backup_dir)
+        shutil.rmtree(data_dir, ignore_errors=True)
+        update_lora_catalog(state["lora_name"])
+
+        state["status"] = "completed"
+        state["training_method"] = training_method
+        state["finished_at"] = time.time()
+        job.save(state)
+        print(f"[Modal] LoRA '{state['lora_name']}' training completed via {training_method}")
+        return state
+
+    def _run_training(self, job: TrainingJob, state: dict, data_dir: str, lora_output_dir: str, checkpoint, report) -> str:
+        """Train with ACE-Step's native trainer, falling back to its CLI. Returns the method used."""
+        import inspect
+        import re
+        import subprocess
+
+        config = state["config"]
+        try:
+            from acestep.training.lora_trainer import LoraTrainer
+
+            kwargs = {
+                "dit_handler": self.handler,
+                "data_dir": data_dir,
+                "output_dir": lora_output_dir,
+                "lora_rank": config["lora_rank"],
+                "epochs": config["epochs"],
+                "learning_rate": config["learning_rate"],
+                "batch_size": config["batch_size"],
+                "save_every": config["save_every"],
+            }
+            # Progress and resume hooks are passed only if this trainer supports them
+            accepted = inspect.signature(LoraTrainer).parameters
+            if "progress_callback" in accepted:
+                kwargs["progress_callback"] = report
+            if checkpoint and "resume_from" in accepted:
+                kwargs["resume_from"] = checkpoint
+            LoraTrainer(**kwargs).train()
+            return "native"
+        except ImportError:
+            pass
+
+        # Fallback: use subprocess to call ACE-Step training CLI
+        train_config = {
+            "data_dir": data_dir,
+            "output_dir": lora_output_dir,
+            "lora_rank": config["lora_rank"],
+            "epochs": config["epochs"],
+            "learning_rate": config["learning_rate"],
+            "batch_size": config["batch_size"],
+            "save_every": config["save_every"],
+        }
+        if checkpoint:
+            train_config["resume_from"] = checkpoint
+        config_path = f"/tmp/train_config_{job.id}.json"
+        with open(config_path, "w") as f:
+            json.dump(train_config, f)
+
+        proc = subprocess.Popen(
+            ["python", "-m", "acestep.training.train_lora",
+             "--config", config_path,
+             "--checkpoint_dir", CHECKPOINT_DIR],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, cwd="/opt/ACE-Step",
+        )
+        tail = collections.deque(maxlen=20)
+        patterns = {
+            key: re.compile(rf"{key}[\s:=]+([0-9.eE+-]+)", re.IGNORECASE)
+            for key in ("epoch", "step", "loss")
+        }
+        try:
+            for line in proc.stdout:
+                tail.append(line)
+                values = {}
+                for key, pattern in patterns.items():
+                    match = pattern.search(line)
+                    try:
+                        values[key] = float(match.group(1)) if match else None
+                    except ValueError:
+                        pass
+                if any(v is not None for v in values.values()):
+                    report(**values)
+        except TrainingCancelled:
+            proc.kill()
+            raise
+
+        if proc.wait() != 0:
+            # Training CLI may not exist yet; audio files are kept for manual training
+            print(f"[Modal] Training CLI not available: {''.join(tail)[-500:]}")
+            return "manual_setup"
+        return "cli"
@@ -0,0 +1,295 @@
+"""
+Tests for deploy_acestep.py's helpers, run against bench_acestep.py's
+stand-ins for the Modal SDK, torch and the ACE-Step handlers.
+
+Run:
+    pip install "fastapi[standard]" pytest numpy soundfile
+    python -m pytest modal
+"""
+
+import hashlib
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_acestep  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def deploy(tmp_path_factory):
+    module, _ = bench_acestep.load_deployment(str(tmp_path_factory.mktemp("deploy")), 0)
+    return module
+
+
+def write_wav(path, audio, sample_rate=48000):
+    import soundfile as sf
+
+    sf.write(str(path), audio, sample_rate, subtype="PCM_16")
+    return str(path)
+
+
+# ---------------------------------------------------------------------------
+# Request helpers
+# ---------------------------------------------------------------------------
+
+def test_query_int_reads_defaults_and_values(deploy):
+    assert deploy.query_int({}, "limit", 20) == 20
+    assert deploy.query_int({"limit": ""}, "limit", 20) == 20
+    assert deploy.query_int({"limit": "5"}, "limit", 20) == 5
+    assert deploy.query_int({"offset": "0"}, "offset") == 0
+
+
+@pytest.mark.parametrize("value, message", [("abc", "limit must be an integer"), ("-1", "limit must be at least 0")])
+def test_query_int_rejects_malformed_values(deploy, value, message):
+    with pytest.raises(ValueError, match=message):
+        deploy.query_int({"limit": value}, "limit", 20)
+
+
+def test_canonical_hash_ignores_key_order(deploy):
+    assert deploy.canonical_hash({"a": 1, "b": {"x": [1, 2], "y": None}}) == \
+        deploy.canonical_hash({"b": {"y": None, "x": [1, 2]}, "a": 1})
+    assert deploy.canonical_hash({"a": 1}) != deploy.canonical_hash({"a": 2})
+    assert deploy.canonical_hash({"a": 1}) != deploy.canonical_hash({"a": "1"})
+    assert len(deploy.canonical_hash({"path": object.__new__(object)})) == 64
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+def test_metrics_render_escapes_label_values(deploy):
+    metrics = deploy.Metrics(buckets=(0.1, 1.0))
+    metrics.inc("acestep_request_failures_total", error_type='Bad "quote" \\ path\nline')
+    metrics.observe("acestep_request_seconds", 0.5, endpoint="generate")
+    text = metrics.render({"acestep_lm_loaded": 1})
+
+    assert 'error_type="Bad \\"quote\\" \\\\ path\\nline"' in text
+    assert "# TYPE acestep_request_failures_total counter" in text
+    assert 'acestep_request_seconds_bucket{endpoint="generate",le="0.1"} 0' in text
+    assert 'acestep_request_seconds_bucket{endpoint="generate",le="1"} 1' in text
+    assert 'acestep_request_seconds_bucket{endpoint="generate",le="+Inf"} 1' in text
+    assert 'acestep_request_seconds_count{endpoint="generate"} 1' in text
+    assert "acestep_lm_loaded 1" in text
+    assert all(line.count('"') % 2 == 0 for line in text.splitlines())
+    assert text.endswith("\n")
+
+
+# ---------------------------------------------------------------------------
+# Lego post-processing and windows
+# ---------------------------------------------------------------------------
+
+def test_isolate_stem_subtracts_src_and_cuts_region(deploy, tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("soundfile")
+    import soundfile as sf
+
+    rate = 1000
+    src = np.full((3 * rate, 2), 0.25, dtype=np.float32)
+    added = np.zeros_like(src)
+    added[rate:2 * rate] = 0.5
+    mix_path = write_wav(tmp_path / "mix.wav", src + added, rate)
+    src_path = write_wav(tmp_path / "src.wav", src, rate)
+
+    info = deploy.isolate_stem(mix_path, src_path, 1.0, 2.0, 4, str(tmp_path / "stem.wav"))
+
+    stem, stem_rate = sf.read(str(tmp_path / "stem.wav"), dtype="float32", always_2d=True)
+    assert stem_rate == rate
+    assert stem.shape == (rate, 2)
+    assert np.allclose(stem, 0.5, atol=1e-3)
+    assert (info["start"], info["end"], info["frames"]) == (1.0, 2.0, rate)
+    assert len(info["peaks"]["min"]) == len(info["peaks"]["max"]) == 4
+    assert info["peaks"]["max"] == pytest.approx([0.5] * 4, abs=1e-3)
+
+
+def test_isolate_stem_handles_short_src_and_open_end(deploy, tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("soundfile")
+    import soundfile as sf
+
+    rate = 1000
+    mix_path = write_wav(tmp_path / "mix.wav", np.full((2 * rate, 2), 0.5, dtype=np.float32), rate)
+    # Mono and half as long: missing channels and samples count as silence
+    src_path = write_wav(tmp_path / "src.wav", np.full((rate, 1), 0.5, dtype=np.float32), rate)
+
+    info = deploy.isolate_stem(mix_path, src_path, 0.0, -1, 0, str(tmp_path / "stem.wav"))
+
+    stem, _ = sf.read(str(tmp_path / "stem.wav"), dtype="float32", always_2d=True)
+    assert info["end"] == 2.0
+    assert np.allclose(stem[:rate, 0], 0.0, atol=1e-3)
+    assert np.allclose(stem[:rate, 1], 0.5, atol=1e-3)
+    assert np.allclose(stem[rate:], 0.5, atol=1e-3)
+    assert info["peaks"] == {"min": [], "max": []}
+
+
+def test_plan_window_adds_margins_and_widens_to_minimum(deploy):
+    pytest.importorskip("soundfile")
+    options = {"margin": 2.0, "crossfade": 0.5}
+    full = 120.0
+
+    window = deploy.plan_window(None, full, 50.0, 90.0, options)
+    assert window == {"start": 48.0, "end": 92.0, "crossfade": 0.5, "full_duration": full}
+
+    short = deploy.plan_window(None, full, 60.0, 61.0, options)
+    assert short["end"] - short["start"] == pytest.approx(deploy.WINDOW_MIN_SECONDS)
+    assert short["start"] <= 58.0 and short["end"] >= 63.0
+
+    edge = deploy.plan_window(None, full, 118.0, -1, options)
+    assert edge["end"] == full
+    assert edge["end"] - edge["start"] == pytest.approx(deploy.WINDOW_MIN_SECONDS)
+
+
+def test_plan_window_skips_windows_covering_the_song(deploy):
+    pytest.importorskip("soundfile")
+    options = {"margin": 2.0, "crossfade": 0.5}
+    assert deploy.plan_window(None, 120.0, 1.0, 119.0, options) is None
+    assert deploy.plan_window(None, deploy.WINDOW_MIN_SECONDS, 5.0, 6.0, options) is None
+
+
+def test_plan_window_reads_duration_from_src(deploy, tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("soundfile")
+
+    src_path = write_wav(tmp_path / "src.wav", np.zeros((120 * 100, 2), dtype=np.float32), 100)
+    window = deploy.plan_window(src_path, None, 50.0, 90.0, {"margin": 2.0, "crossfade": 0.5})
+    assert window["full_duration"] == pytest.approx(120.0)
+
+
+def test_splice_window_crossfades_inner_edges(deploy, tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("soundfile")
+    import soundfile as sf
+
+    rate = 1000
+    src_path = write_wav(tmp_path / "src.wav", np.full((10 * rate, 2), 0.5, dtype=np.float32), rate)
+    window_path = write_wav(tmp_path / "window.wav", np.full((4 * rate, 2), -0.5, dtype=np.float32), rate)
+    window = {"start": 3.0, "end": 7.0, "crossfade": 1.0, "full_duration": 10.0}
+
+    deploy.splice_window(src_path, window_path, window, str(tmp_path / "out.wav"))
+
+    out, out_rate = sf.read(str(tmp_path / "out.wav"), dtype="float32", always_2d=True)
+    assert out_rate == rate
+    assert out.shape == (10 * rate, 2)
+    assert np.allclose(out[:3 * rate], 0.5, atol=1e-3)
+    assert np.allclose(out[7 * rate:], 0.5, atol=1e-3)
+    assert np.allclose(out[4 * rate:6 * rate], -0.5, atol=1e-3)
+    fade_in = out[3 * rate:4 * rate, 0]
+    assert fade_in[0] == pytest.approx(0.5, abs=1e-3)
+    assert np.all(np.diff(fade_in) <= 1e-4)
+    assert out[int(6.5 * rate), 0] == pytest.approx(0.0, abs=0.01)
+
+
+def test_splice_window_keeps_song_edges_unfaded(deploy, tmp_path):
+    np = pytest.importorskip("numpy")
+    pytest.importorskip("soundfile")
+    import soundfile as sf
+
+    rate = 1000
+    src_path = write_wav(tmp_path / "src.wav", np.full((5 * rate, 1), 0.5, dtype=np.float32), rate)
+    window_path = write_wav(tmp_path / "window.wav", np.full((2 * rate, 2), -0.5, dtype=np.float32), rate)
+    window = {"start": 0.0, "end": 2.0, "crossfade": 0.5, "full_duration": 5.0}
+
+    deploy.splice_window(src_path, window_path, window, str(tmp_path / "out.wav"))
+
+    out, _ = sf.read(str(tmp_path / "out.wav"), dtype="float32", always_2d=True)
+    # A mono source is widened to the window's channels
+    assert out.shape == (5 * rate, 2)
+    assert np.allclose(out[:int(1.5 * rate)], -0.5, atol=1e-3)
+    assert np.allclose(out[2 * rate:], 0.5, atol=1e-3)
+
+
+# ---------------------------------------------------------------------------
+# Training
+# ---------------------------------------------------------------------------
+
+def touch(path, mtime=None):
+    with open(path, "w") as f:
+        f.write("x")
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_latest_checkpoint_picks_highest_step(deploy, tmp_path):
+    for name in ("checkpoint-10", "epoch_2", "step-25.safetensors", "adapter_model.safetensors", "meta.json"):
+        touch(tmp_path / name)
+    os.mkdir(tmp_path / "checkpoint_3")
+
+    marks = deploy.checkpoint_marks(str(tmp_path))
+
+    assert set(marks) == {"checkpoint-10", "epoch_2", "step-25.safetensors", "checkpoint_3"}
+    assert deploy.latest_checkpoint(str(tmp_path)) == str(tmp_path / "step-25.safetensors")
+    assert deploy.checkpoint_marks(str(tmp_path / "missing")) == {}
+    assert deploy.latest_checkpoint(str(tmp_path / "missing")) is None
+
+
+def test_latest_checkpoint_ignores_an_earlier_runs_files(deploy, tmp_path):
+    touch(tmp_path / "checkpoint-50", mtime=time.time() - 3600)
+    touch(tmp_path / "checkpoint-20", mtime=time.time() - 3600)
+    prior = deploy.checkpoint_marks(str(tmp_path))
+    touch(tmp_path / "checkpoint-5")
+
+    assert deploy.latest_checkpoint(str(tmp_path), ignore=prior) == str(tmp_path / "checkpoint-5")
+
+    # Rewritten by this run under the same name: no longer the earlier run's
+    touch(tmp_path / "checkpoint-20", mtime=time.time())
+    assert deploy.latest_checkpoint(str(tmp_path), ignore=prior) == str(tmp_path / "checkpoint-20")
+    assert deploy.latest_checkpoint(str(tmp_path), ignore=deploy.checkpoint_marks(str(tmp_path))) is None
+
+
+@pytest.fixture
+def train_data(deploy, tmp_path, monkeypatch):
+    monkeypatch.setattr(deploy, "TRAIN_DATA_DIR", str(tmp_path / "data"))
+    return tmp_path / "data"
+
+
+def test_training_upload_resumes_from_contiguous_prefix(deploy, train_data):
+    data = os.urandom(10_000)
+    upload = deploy.TrainingUpload(hashlib.sha256(data).hexdigest(), len(data))
+
+    upload.write(0, data[:3000])
+    upload.write(6000, data[6000:])
+    assert upload.received() == 3000
+    assert not upload.complete()
+    assert upload.status() == {"status": "partial", "sha256": upload.sha256, "size": len(data), "received": 3000}
+
+    # A retried, overlapping chunk is fine
+    upload.write(2000, data[2000:6500])
+    assert upload.received() == len(data)
+    assert upload.complete()
+    with open(upload.blob_path, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(upload.dir)
+    assert upload.status()["status"] == "complete"
+
+    # Any later upload of the same bytes is complete before sending anything
+    again = deploy.TrainingUpload(upload.sha256, len(data))
+    assert again.exists() and again.received() == len(data) and again.complete()
+
+
+def test_training_upload_rejects_bad_chunks_and_hashes(deploy, train_data):
+    data = os.urandom(4096)
+    upload = deploy.TrainingUpload("0" * 64, len(data))
+
+    with pytest.raises(ValueError, match="outside"):
+        upload.write(4000, data[:200])
+    with pytest.raises(ValueError, match="outside"):
+        upload.write(-1, data[:10])
+
+    upload.write(0, data)
+    with pytest.raises(ValueError, match="do not match sha256"):
+        upload.complete()
+    assert not upload.exists()
+    assert upload.received() == 0
+
+
+def test_put_training_blob_stores_by_hash(deploy, train_data):
+    data = b"training audio"
+    sha256 = deploy.put_training_blob(data)
+
+    assert sha256 == hashlib.sha256(data).hexdigest()
+    with open(deploy.train_data_path("blobs", sha256), "rb") as f:
+        assert f.read() == data
+    assert deploy.put_training_blob(data) == sha256
@@ -6,7 +6,7 @@ import { useLoraStore } from '../../store/loraStore';
 import { useComposerStore, loadOutputBlob } from '../../store/composerStore';
 import type { OutputMeta } from '../../store/composerStore';
 import { LoraTrainingPanel } from './LoraTrainingPanel';
-import type { AnyTaskParams, BaseTaskParams } from '../../types/api';
+import type { AnyTaskParams, AudioFormat, BaseTaskParams } from '../../types/api';
 
 type ComposerMode =
     | 'text2music'
@@ -576,10 +576,12 @@ export function ComposerView() {
                                     </div>
                                     <div>
                                         <label className="text-[9px] uppercase text-slate-600 font-bold block mb-1 tracking-wider">Format</label>
-                                        <select value={audioFormat} onChange={(e) => setAudioFormat(e.target.value as 'wav' | 'mp3')}
+                                        <select value={audioFormat} onChange={(e) => setAudioFormat(e.target.value as AudioFormat)}
                                             className="w-full bg-daw-panel border border-daw-border rounded px-2 py-1 text-xs text-white focus:border-daw-accent/50 outline-none">
                                             <option value="mp3">MP3</option>
                                             <option value="wav">WAV</option>
+                                            <option value="flac">FLAC</option>
+                                            <option value="opus">Opus</option>
                                         </select>
                                     </div>
                                 </div>
@@ -1,7 +1,10 @@
 import { useState, useRef, useCallback } from 'react';
 import { useLoraStore } from '../../store/loraStore';
+import { getTrainingStatus, uploadTrainingFile } from '../../services/modalApi';
+import type { TrainingStatus } from '../../services/modalApi';
 
 const MODAL_PROXY = '/api/modal';
+const TRAINING_POLL_INTERVAL_MS = 5000;
 
 interface TrainingFile {
     id: string;
@@ -19,17 +22,27 @@ interface TrainingJob {
     error?: string;
 }
 
-async function blobToBase64(blob: Blob): Promise<string> {
-    return new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onloadend = () => {
-            const dataUrl = reader.result as string;
-            const base64 = dataUrl.split(',')[1];
-            resolve(base64);
-        };
-        reader.onerror = reject;
-        reader.readAsDataURL(blob);
-    });
+function formatTrainingProgress(status: TrainingStatus): string {
+    const { epoch, step, loss } = status.progress ?? {};
+    const parts = [`Training (${status.status})`];
+    if (epoch !== undefined) parts.push(`epoch ${epoch}`);
+    if (step !== undefined) parts.push(`step ${step}`);
+    if (loss !== undefined) parts.push(`loss ${loss.toFixed(4)}`);
+    return parts.join(' · ');
+}
+
+async function waitForTraining(
+    jobId: string,
+    onProgress: (status: TrainingStatus) => void,
+): Promise<TrainingStatus> {
+    for (;;) {
+        await new Promise((resolve) => setTimeout(resolve, TRAINING_POLL_INTERVAL_MS));
+        const status = await getTrainingStatus(jobId);
+        if (status.status === 'completed' || status.status === 'failed' || status.status === 'cancelled') {
+            return status;
+        }
+        onProgress(status);
+    }
 }
 
 function formatFileSize(bytes: number): string {
@@ -115,14 +128,15 @@ export function LoraTrainingPanel() {
         });
 
         try {
-            // Encode all audio files as base64
-            setTrainingProgress('Encoding audio files...');
-            updateJobStatus(jobId, 'annotating', 'Encoding audio files...');
-
-            const audioFiles: { name: string; data: string }[] = [];
-            for (const tf of files) {
-                const base64 = await blobToBase64(tf.file);
-                audioFiles.push({ name: tf.name, data: base64 });
+            // Upload files the server doesn't already hold, resuming interrupted ones
+            const trainingFiles: { name: string; sha256: string }[] = [];
+            for (const [i, tf] of files.entries()) {
+                const sha256 = await uploadTrainingFile(tf.file, (sent, total) => {
+                    const message = `Uploading ${tf.name} (${i + 1}/${files.length}): ${Math.round((sent / total) * 100)}%`;
+                    setTrainingProgress(message);
+                    updateJobStatus(jobId, 'annotating', message);
+                });
+                trainingFiles.push({ name: tf.name, sha256 });
             }
 
             setTrainingProgress('Submitting training job...');
@@ -135,7 +149,7 @@ export function LoraTrainingPanel() {
                 body: JSON.stringify({
                     task_type: 'lora_training',
                     lora_name: loraName.trim(),
-                    audio_files: audioFiles,
+                    files: trainingFiles,
                     epochs,
                     learning_rate: learningRate,
                     lora_rank: loraRank,
@@ -155,11 +169,23 @@ export function LoraTrainingPanel() {
                 updateJobStatus(jobId, 'done', 'Training complete!');
                 setTrainingProgress('Training complete!');
                 updateLora(loraName.trim(), { status: 'done' });
-            } else if (result.status === 'accepted' || result.status === 'queued') {
+            } else if ((result.status === 'accepted' || result.status === 'queued') && result.job_id) {
                 updateJobStatus(jobId, 'training', `Job accepted: ${result.message || 'Training in progress...'}`);
                 setTrainingProgress(`Job submitted: ${result.message || 'Training in background...'}`);
-                // Mark as done since the backend accepted it (training happens async on Modal)
+
+                // Training runs in a background worker on Modal; poll until it finishes
+                const final = await waitForTraining(result.job_id, (status) => {
+                    updateJobStatus(jobId, 'training', formatTrainingProgress(status));
+                    setTrainingProgress(formatTrainingProgress(status));
+                });
+                if (final.status !== 'completed') {
+                    throw new Error(final.error || `Training ${final.status}`);
+                }
+                updateJobStatus(jobId, 'done', 'Training complete!');
+                setTrainingProgress('Training complete!');
                 updateLora(loraName.trim(), { status: 'done' });
+            } else if (result.status === 'failed') {
+                throw new Error(result.error || 'Training failed');
             } else {
                 updateJobStatus(jobId, 'done', `Status: ${result.status}`);
                 setTrainingProgress(`Done: ${result.status}`);
@@ -1,10 +1,18 @@
 import { v4 as uuidv4 } from 'uuid';
 import { useProjectStore } from '../store/projectStore';
 import { useGenerationStore } from '../store/generationStore';
-import type { LegoTaskParams, TaskResultItem } from '../types/api';
-import type { InferredMetas } from '../types/project';
+import type {
+  LegoTaskParams,
+  PostprocessOptions,
+  ReleaseTaskResponse,
+  StemInfo,
+  TaskResultEntry,
+  TaskResultItem,
+} from '../types/api';
+import type { Clip, InferredMetas, Project, Track } from '../types/project';
 import * as api from './aceStepApi';
-import { generateViaModal } from './modalApi';
+import { releaseTaskViaModal, queryResultViaModal, downloadAudioViaModal, cascadeViaModal } from './modalApi';
+import type { CascadeStepResult } from './modalApi';
 import { TRACK_CATALOG } from '../constants/tracks';
 import { generateSilenceWav } from './silenceGenerator';
 import { saveAudioBlob, loadAudioBlobByKey } from './audioFileManager';
@@ -14,11 +22,64 @@ import { audioBufferToWavBlob } from '../utils/wav';
 import { computeWaveformPeaks } from '../utils/waveformPeaks';
 import { POLL_INTERVAL_MS, MAX_POLL_DURATION_MS } from '../constants/defaults';
 
+/**
+ * A backend exposing the ACE-Step release_task / query_result contract.
+ */
+interface TaskBackend {
+  name: string;
+  /** A null src_audio means the first track, generated against silence */
+  releaseTask: (srcAudioBlob: Blob | null, params: LegoTaskParams) => Promise<ReleaseTaskResponse>;
+  queryResult: (taskIds: string[]) => Promise<TaskResultEntry[]>;
+  downloadAudio: (audioPath: string) => Promise<Blob>;
+}
+
+const STANDARD_BACKEND: TaskBackend = {
+  name: 'ACE-Step',
+  releaseTask: (srcAudioBlob, params) =>
+    api.releaseLegoTask(srcAudioBlob ?? generateSilenceWav(params.audio_duration), params),
+  queryResult: api.queryResult,
+  downloadAudio: api.downloadAudio,
+};
+
+const MODAL_BACKEND: TaskBackend = {
+  name: 'Modal',
+  // Modal synthesizes the silent context instead of receiving it as an upload
+  releaseTask: (srcAudioBlob, params) =>
+    releaseTaskViaModal(srcAudioBlob, srcAudioBlob ? params : { ...params, src_audio_silence: params.audio_duration }),
+  queryResult: queryResultViaModal,
+  downloadAudio: downloadAudioViaModal,
+};
+
+const WAVEFORM_PEAK_COUNT = 200;
+
+/**
+ * Modal isolates and trims the clip's stem and computes its peaks server-side.
+ * The full mix is still returned: it is stored as the clip's cumulative mix.
+ */
+const MODAL_POSTPROCESS: PostprocessOptions = {
+  isolate: true,
+  trim: true,
+  peaks: WAVEFORM_PEAK_COUNT,
+  include_mix: true,
+};
+
+/**
+ * A stem isolated and trimmed by the server, with the clip region it was cut to.
+ */
+interface ServerStem {
+  blob: Blob;
+  info: StemInfo;
+  start: number;
+  end: number;
+}
+
 /**
  * Generate all tracks sequentially (bottom → top in generation order).
+ * On Modal, each run of consecutive pending clips is sent as one server-side
+ * cascade so intermediate cumulative mixes never leave the server.
  */
 export async function generateAllTracks(): Promise<void> {
-  const { project, getTracksInGenerationOrder, updateClipStatus } = useProjectStore.getState();
+  const { project, getTracksInGenerationOrder } = useProjectStore.getState();
   const genStore = useGenerationStore.getState();
 
   if (!project || genStore.isGenerating) return;
@@ -26,11 +87,20 @@ export async function generateAllTracks(): Promise<void> {
 
   try {
     const tracks = getTracksInGenerationOrder();
+    const useModal = project.generationDefaults.useModal ?? true;
     let previousCumulativeBlob: Blob | null = null;
+    let pendingClipIds: string[] = [];
+
+    const flushPending = async () => {
+      if (pendingClipIds.length === 0) return;
+      previousCumulativeBlob = await generateClipsCascade(pendingClipIds, previousCumulativeBlob);
+      pendingClipIds = [];
+    };
 
     for (const track of tracks) {
       for (const clip of track.clips) {
         if (clip.generationStatus === 'ready') {
+          await flushPending();
           // Already generated — use its cumulative mix as input for next track
           if (clip.cumulativeMixKey) {
             const blob = await loadAudioBlobByKey(clip.cumulativeMixKey);
@@ -39,12 +109,18 @@ export async function generateAllTracks(): Promise<void> {
           continue;
         }
 
+        if (useModal) {
+          pendingClipIds.push(clip.id);
+          continue;
+        }
+
         previousCumulativeBlob = await generateClipInternal(
           clip.id,
           previousCumulativeBlob,
         );
       }
     }
+    await flushPending();
   } finally {
     useGenerationStore.getState().setIsGenerating(false);
   }
@@ -91,228 +167,352 @@ async function getPreviousCumulativeBlob(clipId: string): Promise<Blob | null> {
   return null;
 }
 
-async function generateClipInternal(
-  clipId: string,
-  previousCumulativeBlob: Blob | null,
-): Promise<Blob | null> {
-  const store = useProjectStore.getState();
-  const genStore = useGenerationStore.getState();
-  const project = store.project;
-  if (!project) return null;
+/**
+ * Build the lego task params for a clip from its prompt and the project settings.
+ */
+function buildLegoParams(clip: Clip, track: Track, project: Project): LegoTaskParams {
+  // Build instruction
+  const instruction = `Generate the ${track.trackName.toUpperCase().replace('_', ' ')} track based on the audio context:`;
+
+  // Prepend track-type default prompt to user prompt
+  const trackInfo = TRACK_CATALOG[track.trackName];
+  const defaultPrompt = trackInfo?.defaultPrompt || '';
+  const combinedPrompt = defaultPrompt && clip.prompt
+    ? `${defaultPrompt}, ${clip.prompt}`
+    : defaultPrompt || clip.prompt;
+
+  // Build params — 'auto' = ACE-Step infers, null/undefined = project defaults, value = manual
+  const resolvedBpm = clip.bpm === 'auto' ? null : (clip.bpm ?? project.bpm);
+  const resolvedKey = clip.keyScale === 'auto' ? '' : (clip.keyScale ?? project.keyScale);
+  const resolvedTimeSig = clip.timeSignature === 'auto' ? '' : String(clip.timeSignature ?? project.timeSignature);
+
+  const params: LegoTaskParams = {
+    task_type: 'lego',
+    track_name: track.trackName,
+    prompt: combinedPrompt,
+    lyrics: clip.lyrics || '',
+    instruction,
+    repainting_start: clip.startTime,
+    repainting_end: clip.startTime + clip.duration,
+    audio_duration: project.totalDuration,
+    bpm: resolvedBpm,
+    key_scale: resolvedKey,
+    time_signature: resolvedTimeSig,
+    inference_steps: project.generationDefaults.inferenceSteps,
+    guidance_scale: project.generationDefaults.guidanceScale,
+    shift: project.generationDefaults.shift,
+    batch_size: 1,
+    audio_format: 'wav',
+    thinking: project.generationDefaults.thinking,
+    model: project.generationDefaults.model || undefined,
+  } as LegoTaskParams;
+
+  // Sample mode: send prompt as sample_query
+  if (clip.sampleMode) {
+    params.sample_mode = true;
+    params.sample_query = clip.prompt;
+  }
 
-  const clip = store.getClipById(clipId);
-  const track = store.getTrackForClip(clipId);
-  if (!clip || !track) return null;
+  // Auto-expand prompt: controls whether LM rewrites the caption via CoT
+  if (clip.autoExpandPrompt === false) {
+    params.use_cot_caption = false;
+  }
 
-  // Create generation job
+  return params;
+}
+
+/**
+ * Register a generation job for a clip and mark the clip queued. Returns the job id.
+ */
+function createClipJob(clipId: string, track: Track): string {
   const jobId = uuidv4();
-  genStore.addJob({
+  useGenerationStore.getState().addJob({
     id: jobId,
     clipId,
     trackName: track.trackName,
     status: 'queued',
     progress: 'Queued',
   });
+  useProjectStore.getState().updateClipStatus(clipId, 'queued', { generationJobId: jobId });
+  return jobId;
+}
+
+function markClipError(clipId: string, jobId: string, error: unknown): void {
+  const message = error instanceof Error ? error.message : typeof error === 'string' ? error : 'Unknown error';
+  useProjectStore.getState().updateClipStatus(clipId, 'error', { errorMessage: message });
+  useGenerationStore.getState().updateJob(jobId, { status: 'error', progress: message, error: message });
+}
+
+/**
+ * Generate a run of consecutive clips as server-side cascades on Modal,
+ * continuing from the last mix whenever the server stops at its time budget.
+ * Returns the cumulative mix after the last successful step.
+ */
+async function generateClipsCascade(
+  clipIds: string[],
+  previousCumulativeBlob: Blob | null,
+): Promise<Blob | null> {
+  const store = useProjectStore.getState();
+  const project = store.project;
+  if (!project) return previousCumulativeBlob;
+
+  const jobs = new Map<string, string>();
+  const steps: Array<LegoTaskParams & { clip_id: string }> = [];
+  for (const clipId of clipIds) {
+    const clip = store.getClipById(clipId);
+    const track = store.getTrackForClip(clipId);
+    if (!clip || !track) continue;
+    jobs.set(clipId, createClipJob(clipId, track));
+    steps.push({ ...buildLegoParams(clip, track, project), postprocess: MODAL_POSTPROCESS, clip_id: clipId });
+  }
+
+  for (const [clipId, jobId] of jobs) {
+    useGenerationStore.getState().updateJob(jobId, { status: 'generating', progress: 'Generating via Modal cascade...' });
+    useProjectStore.getState().updateClipStatus(clipId, 'generating');
+  }
 
-  store.updateClipStatus(clipId, 'queued', { generationJobId: jobId });
+  let cumulativeBlob = previousCumulativeBlob;
+  const onStep = async (step: CascadeStepResult) => {
+    const jobId = step.clip_id ? jobs.get(step.clip_id) : undefined;
+    if (!step.clip_id || !jobId) return;
+    jobs.delete(step.clip_id);
+
+    if (!step.audioBlob) {
+      markClipError(step.clip_id, jobId, step.error ?? 'Generation failed');
+      return;
+    }
+    // The server already fed this mix to the next step, so it is the new baseline
+    const stepPrevious = cumulativeBlob;
+    cumulativeBlob = step.audioBlob;
+    const params = steps.find((s) => s.clip_id === step.clip_id);
+    const serverStem = step.stemBlob && step.stem && params
+      ? { blob: step.stemBlob, info: step.stem, start: params.repainting_start, end: params.repainting_end }
+      : null;
+    try {
+      await finalizeClip(step.clip_id, jobId, step.audioBlob, stepPrevious, null, serverStem);
+    } catch (error) {
+      markClipError(step.clip_id, jobId, error);
+    }
+  };
 
   try {
-    // Determine src_audio
-    const srcAudioBlob = previousCumulativeBlob ?? generateSilenceWav(project.totalDuration);
-
-    // Build instruction
-    const instruction = `Generate the ${track.trackName.toUpperCase().replace('_', ' ')} track based on the audio context:`;
-
-    // Prepend track-type default prompt to user prompt
-    const trackInfo = TRACK_CATALOG[track.trackName];
-    const defaultPrompt = trackInfo?.defaultPrompt || '';
-    const combinedPrompt = defaultPrompt && clip.prompt
-      ? `${defaultPrompt}, ${clip.prompt}`
-      : defaultPrompt || clip.prompt;
-
-    // Build params — 'auto' = ACE-Step infers, null/undefined = project defaults, value = manual
-    const resolvedBpm = clip.bpm === 'auto' ? null : (clip.bpm ?? project.bpm);
-    const resolvedKey = clip.keyScale === 'auto' ? '' : (clip.keyScale ?? project.keyScale);
-    const resolvedTimeSig = clip.timeSignature === 'auto' ? '' : String(clip.timeSignature ?? project.timeSignature);
-
-    const params: LegoTaskParams = {
-      task_type: 'lego',
-      track_name: track.trackName,
-      prompt: combinedPrompt,
-      lyrics: clip.lyrics || '',
-      instruction,
-      repainting_start: clip.startTime,
-      repainting_end: clip.startTime + clip.duration,
-      audio_duration: project.totalDuration,
-      bpm: resolvedBpm,
-      key_scale: resolvedKey,
-      time_signature: resolvedTimeSig,
-      inference_steps: project.generationDefaults.inferenceSteps,
-      guidance_scale: project.generationDefaults.guidanceScale,
-      shift: project.generationDefaults.shift,
-      batch_size: 1,
-      audio_format: 'wav',
-      thinking: project.generationDefaults.thinking,
-      model: project.generationDefaults.model || undefined,
-    } as LegoTaskParams;
-
-    // Sample mode: send prompt as sample_query
-    if (clip.sampleMode) {
-      params.sample_mode = true;
-      params.sample_query = clip.prompt;
+    let pending = steps;
+    while (pending.length > 0) {
+      const ran = await cascadeViaModal(cumulativeBlob, pending, onStep, project.totalDuration);
+      if (ran <= 0) break;
+      pending = pending.slice(ran);
+    }
+  } catch (error) {
+    for (const [clipId, jobId] of jobs) markClipError(clipId, jobId, error);
+    jobs.clear();
+  }
+
+  // Clips the stream never reported on (e.g. the connection dropped)
+  for (const [clipId, jobId] of jobs) {
+    markClipError(clipId, jobId, 'Cascade ended before this clip was generated');
+  }
+  return cumulativeBlob;
+}
+
+/**
+ * Store a clip's generated cumulative mix, isolate its track by wave
+ * subtraction, trim it to the clip region and mark the clip ready.
+ * A server-side stem is used as-is if the clip has not moved since it was requested.
+ */
+async function finalizeClip(
+  clipId: string,
+  jobId: string,
+  cumulativeBlob: Blob,
+  previousCumulativeBlob: Blob | null,
+  firstResult: TaskResultItem | null,
+  serverStem: ServerStem | null = null,
+): Promise<void> {
+  const project = useProjectStore.getState().project;
+  const clip = useProjectStore.getState().getClipById(clipId);
+  if (!project || !clip) {
+    // Clip was deleted while generating
+    useGenerationStore.getState().updateJob(jobId, { status: 'done', progress: 'Clip removed' });
+    return;
+  }
+
+  // Store cumulative mix
+  const cumulativeKey = await saveAudioBlob(project.id, clipId, 'cumulative', cumulativeBlob);
+
+  // Clip start/duration are read now, in case the user moved/resized it during generation
+  const clipStart = clip.startTime;
+  const clipDuration = clip.duration;
+
+  const { isolatedBlob, peaks } = serverStem
+    && Math.abs(serverStem.start - clipStart) < 1e-6
+    && Math.abs(serverStem.end - (clipStart + clipDuration)) < 1e-6
+    ? { isolatedBlob: serverStem.blob, peaks: absolutePeaks(serverStem.info) }
+    : await isolateClipLocally(cumulativeBlob, previousCumulativeBlob, clipStart, clipDuration);
+  const isolatedKey = await saveAudioBlob(project.id, clipId, 'isolated', isolatedBlob);
+
+  // Build inferred metadata from result
+  const inferredMetas: InferredMetas | undefined = firstResult
+    ? {
+      bpm: firstResult.metas?.bpm,
+      keyScale: firstResult.metas?.keyscale,
+      timeSignature: firstResult.metas?.timesignature,
+      genres: firstResult.metas?.genres,
+      seed: firstResult.seed_value,
+      ditModel: firstResult.dit_model,
     }
+    : undefined;
+
+  // Update clip as ready
+  useProjectStore.getState().updateClipStatus(clipId, 'ready', {
+    cumulativeMixKey: cumulativeKey,
+    isolatedAudioKey: isolatedKey,
+    waveformPeaks: peaks,
+    inferredMetas,
+    audioDuration: clipDuration,
+    audioOffset: 0,
+  });
+
+  useGenerationStore.getState().updateJob(jobId, { status: 'done', progress: 'Done' });
+}
 
-    // Auto-expand prompt: controls whether LM rewrites the caption via CoT
-    if (clip.autoExpandPrompt === false) {
-      params.use_cot_caption = false;
+/**
+ * Isolate a clip's track in the browser: wave-subtract the previous mix, trim
+ * to the clip region and compute its waveform peaks.
+ */
+async function isolateClipLocally(
+  cumulativeBlob: Blob,
+  previousCumulativeBlob: Blob | null,
+  clipStart: number,
+  clipDuration: number,
+): Promise<{ isolatedBlob: Blob; peaks: number[] }> {
+  // Wave subtraction: isolate this track
+  const engine = getAudioEngine();
+  const cumulativeBuffer = await engine.decodeAudioData(cumulativeBlob);
+
+  let previousBuffer: AudioBuffer | null = null;
+  if (previousCumulativeBlob) {
+    previousBuffer = await engine.decodeAudioData(previousCumulativeBlob);
+  }
+
+  const fullIsolatedBuffer = isolateTrackAudio(engine.ctx, cumulativeBuffer, previousBuffer);
+
+  // Trim isolated audio to just the clip's time region so the buffer
+  // represents only the clip's audio (not the full project duration).
+  const sampleRate = fullIsolatedBuffer.sampleRate;
+  const startSample = Math.floor(clipStart * sampleRate);
+  const endSample = Math.min(
+    Math.floor((clipStart + clipDuration) * sampleRate),
+    fullIsolatedBuffer.length,
+  );
+  const trimmedLength = Math.max(1, endSample - startSample);
+  const trimmedBuffer = engine.ctx.createBuffer(
+    fullIsolatedBuffer.numberOfChannels,
+    trimmedLength,
+    sampleRate,
+  );
+  for (let ch = 0; ch < fullIsolatedBuffer.numberOfChannels; ch++) {
+    const src = fullIsolatedBuffer.getChannelData(ch);
+    const dst = trimmedBuffer.getChannelData(ch);
+    for (let i = 0; i < trimmedLength; i++) {
+      dst[i] = src[startSample + i];
     }
+  }
+
+  // Compute waveform peaks from the trimmed buffer (full buffer = clip region)
+  return {
+    isolatedBlob: audioBufferToWavBlob(trimmedBuffer),
+    peaks: computeWaveformPeaks(trimmedBuffer, WAVEFORM_PEAK_COUNT),
+  };
+}
+
+/**
+ * Collapse server min/max peaks to the absolute peaks computeWaveformPeaks produces.
+ */
+function absolutePeaks(stem: StemInfo): number[] {
+  return stem.peaks.max.map((max, i) => Math.max(Math.abs(max), Math.abs(stem.peaks.min[i] ?? 0)));
+}
+
+async function generateClipInternal(
+  clipId: string,
+  previousCumulativeBlob: Blob | null,
+): Promise<Blob | null> {
+  const store = useProjectStore.getState();
+  const project = store.project;
+  if (!project) return null;
+
+  const clip = store.getClipById(clipId);
+  const track = store.getTrackForClip(clipId);
+  if (!clip || !track) return null;
+
+  // Create generation job
+  const jobId = createClipJob(clipId, track);
+
+  try {
+    const backend = (project.generationDefaults.useModal ?? true) ? MODAL_BACKEND : STANDARD_BACKEND;
+    const params = buildLegoParams(clip, track, project);
+    if (backend === MODAL_BACKEND) params.postprocess = MODAL_POSTPROCESS;
 
     // Submit task
     useGenerationStore.getState().updateJob(jobId, { status: 'generating', progress: 'Submitting...' });
     useProjectStore.getState().updateClipStatus(clipId, 'generating');
 
-    let cumulativeBlob: Blob;
     let firstResult: TaskResultItem | null = null;
 
-    if (project.generationDefaults.useModal ?? true) {
-      // ── Modal path: synchronous generation ──
-      useGenerationStore.getState().updateJob(jobId, { progress: 'Generating via Modal (this may take a minute)...' });
-
-      const modalResult = await generateViaModal(srcAudioBlob, params);
-      cumulativeBlob = modalResult.audioBlob;
-
-      // Build a pseudo TaskResultItem from Modal response
-      if (modalResult.metas && Object.keys(modalResult.metas).length > 0) {
-        firstResult = {
-          file: '',
-          wave: '',
-          status: 1,
-          create_time: Date.now(),
-          env: 'modal',
-          prompt: clip.prompt,
-          lyrics: clip.lyrics,
-          metas: modalResult.metas,
-          seed_value: modalResult.seed_value,
-          dit_model: modalResult.dit_model,
-        };
-      }
-    } else {
-      // ── Standard API path: async queue ──
-      const releaseResp = await api.releaseLegoTask(srcAudioBlob, params);
-      const taskId = releaseResp.task_id;
-
-      // Poll for completion
-      const startTime = Date.now();
-      let resultAudioPath: string | null = null;
-
-      while (Date.now() - startTime < MAX_POLL_DURATION_MS) {
-        await sleep(POLL_INTERVAL_MS);
-
-        const entries = await api.queryResult([taskId]);
-        const entry = entries?.[0];
-        if (!entry) continue;
-
-        useGenerationStore.getState().updateJob(jobId, {
-          progress: entry.progress_text || 'Generating...',
-        });
-
-        if (entry.status === 1) {
-          const resultItems: TaskResultItem[] = JSON.parse(entry.result);
-          firstResult = resultItems?.[0] ?? null;
-          resultAudioPath = firstResult?.file ?? null;
-          break;
-        } else if (entry.status === 2) {
-          throw new Error(`Generation failed: ${entry.result}`);
-        }
-      }
-
-      if (!resultAudioPath) {
-        throw new Error('Generation timed out');
-      }
+    // Both backends queue the job and are polled until it finishes
+    const releaseResp = await backend.releaseTask(previousCumulativeBlob, params);
+    const taskId = releaseResp.task_id;
 
-      // Download audio
-      useGenerationStore.getState().updateJob(jobId, { status: 'processing', progress: 'Downloading audio...' });
-      useProjectStore.getState().updateClipStatus(clipId, 'processing');
+    // Poll for completion
+    const startTime = Date.now();
+    let resultAudioPath: string | null = null;
 
-      cumulativeBlob = await api.downloadAudio(resultAudioPath);
-    }
+    while (Date.now() - startTime < MAX_POLL_DURATION_MS) {
+      await sleep(POLL_INTERVAL_MS);
 
-    // Store cumulative mix
-    const cumulativeKey = await saveAudioBlob(project.id, clipId, 'cumulative', cumulativeBlob);
+      const entries = await backend.queryResult([taskId]);
+      const entry = entries?.[0];
+      if (!entry) continue;
 
-    // Wave subtraction: isolate this track
-    const engine = getAudioEngine();
-    const cumulativeBuffer = await engine.decodeAudioData(cumulativeBlob);
+      useGenerationStore.getState().updateJob(jobId, {
+        progress: entry.progress_text || `Generating via ${backend.name}...`,
+      });
 
-    let previousBuffer: AudioBuffer | null = null;
-    if (previousCumulativeBlob) {
-      previousBuffer = await engine.decodeAudioData(previousCumulativeBlob);
+      if (entry.status === 1) {
+        const resultItems: TaskResultItem[] = JSON.parse(entry.result);
+        firstResult = resultItems?.[0] ?? null;
+        resultAudioPath = firstResult?.file ?? null;
+        break;
+      } else if (entry.status === 2) {
+        throw new Error(`Generation failed: ${entry.result}`);
+      }
     }
 
-    const fullIsolatedBuffer = isolateTrackAudio(engine.ctx, cumulativeBuffer, previousBuffer);
-
-    // Re-read clip from store in case the user moved/resized it during generation
-    const currentClip = useProjectStore.getState().getClipById(clipId);
-    const clipStart = currentClip?.startTime ?? clip.startTime;
-    const clipDuration = currentClip?.duration ?? clip.duration;
-
-    // Trim isolated audio to just the clip's time region so the buffer
-    // represents only the clip's audio (not the full project duration).
-    const sampleRate = fullIsolatedBuffer.sampleRate;
-    const startSample = Math.floor(clipStart * sampleRate);
-    const endSample = Math.min(
-      Math.floor((clipStart + clipDuration) * sampleRate),
-      fullIsolatedBuffer.length,
-    );
-    const trimmedLength = Math.max(1, endSample - startSample);
-    const trimmedBuffer = engine.ctx.createBuffer(
-      fullIsolatedBuffer.numberOfChannels,
-      trimmedLength,
-      sampleRate,
-    );
-    for (let ch = 0; ch < fullIsolatedBuffer.numberOfChannels; ch++) {
-      const src = fullIsolatedBuffer.getChannelData(ch);
-      const dst = trimmedBuffer.getChannelData(ch);
-      for (let i = 0; i < trimmedLength; i++) {
-        dst[i] = src[startSample + i];
-      }
+    if (!resultAudioPath) {
+      throw new Error('Generation timed out');
     }
 
-    const isolatedBlob = audioBufferToWavBlob(trimmedBuffer);
-    const isolatedKey = await saveAudioBlob(project.id, clipId, 'isolated', isolatedBlob);
-
-    // Compute waveform peaks from the trimmed buffer (full buffer = clip region)
-    const peaks = computeWaveformPeaks(trimmedBuffer, 200);
-
-    // Build inferred metadata from result
-    const inferredMetas: InferredMetas | undefined = firstResult
-      ? {
-        bpm: firstResult.metas?.bpm,
-        keyScale: firstResult.metas?.keyscale,
-        timeSignature: firstResult.metas?.timesignature,
-        genres: firstResult.metas?.genres,
-        seed: firstResult.seed_value,
-        ditModel: firstResult.dit_model,
-      }
-      : undefined;
+    // Download audio
+    useGenerationStore.getState().updateJob(jobId, { status: 'processing', progress: 'Downloading audio...' });
+    useProjectStore.getState().updateClipStatus(clipId, 'processing');
 
-    // Update clip as ready
-    useProjectStore.getState().updateClipStatus(clipId, 'ready', {
-      cumulativeMixKey: cumulativeKey,
-      isolatedAudioKey: isolatedKey,
-      waveformPeaks: peaks,
-      inferredMetas,
-      audioDuration: clipDuration,
-      audioOffset: 0,
-    });
+    // Post-processed Modal results return the stem as `file` and the mix as `mix_file`
+    let serverStem: ServerStem | null = null;
+    let cumulativeBlob: Blob;
+    if (firstResult?.mix_file && firstResult.stem) {
+      const [mixBlob, stemBlob] = await Promise.all([
+        backend.downloadAudio(firstResult.mix_file),
+        backend.downloadAudio(resultAudioPath),
+      ]);
+      cumulativeBlob = mixBlob;
+      serverStem = { blob: stemBlob, info: firstResult.stem, start: params.repainting_start, end: params.repainting_end };
+    } else {
+      cumulativeBlob = await backend.downloadAudio(resultAudioPath);
+    }
 
-    useGenerationStore.getState().updateJob(jobId, { status: 'done', progress: 'Done' });
+    await finalizeClip(clipId, jobId, cumulativeBlob, previousCumulativeBlob, firstResult, serverStem);
 
     return cumulativeBlob;
   } catch (error) {
-    const message = error instanceof Error ? error.message : 'Unknown error';
-    useProjectStore.getState().updateClipStatus(clipId, 'error', { errorMessage: message });
-    useGenerationStore.getState().updateJob(jobId, { status: 'error', progress: message, error: message });
+    markClipError(clipId, jobId, error);
     return previousCumulativeBlob;
   }
 }
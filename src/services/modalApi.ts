@@ -1,21 +1,28 @@
-import type { AnyTaskParams, LegoTaskParams, TaskResultItem } from '../types/api';
+import type {
+    AnyTaskParams,
+    ApiEnvelope,
+    LegoTaskParams,
+    ReleaseTaskResponse,
+    StemInfo,
+    TaskResultEntry,
+    TaskResultItem,
+} from '../types/api';
 
 const MODAL_PROXY = '/api/modal';
 
-/**
- * Convert a Blob to a base64 string.
- */
-async function blobToBase64(blob: Blob): Promise<string> {
-    return new Promise((resolve, reject) => {
-        const reader = new FileReader();
-        reader.onloadend = () => {
-            const dataUrl = reader.result as string;
-            const base64 = dataUrl.split(',')[1];
-            resolve(base64);
-        };
-        reader.onerror = reject;
-        reader.readAsDataURL(blob);
-    });
+// Media types of the output formats the Modal backend can return
+const AUDIO_MIME_TYPES: Record<string, string> = {
+    wav: 'audio/wav',
+    mp3: 'audio/mpeg',
+    flac: 'audio/flac',
+    opus: 'audio/ogg',
+};
+
+export interface ModalGenerationResult {
+    audioBlob: Blob;
+    metas: TaskResultItem['metas'];
+    seed_value?: string;
+    dit_model?: string;
 }
 
 /**
@@ -31,53 +38,49 @@ function base64ToBlob(base64: string, mimeType: string): Blob {
 }
 
 /**
- * Modal API response format.
- */
-interface ModalResponse {
-    status: string;
-    outputs: string[];
-    format: string;
-    count: number;
-}
-
-export interface ModalGenerationResult {
-    audioBlob: Blob;
-    metas: TaskResultItem['metas'];
-    seed_value?: string;
-    dit_model?: string;
-}
-
-/**
- * Generic Modal generation call for any task type.
- * Accepts optional source audio blob for tasks that need it (lego, cover, repaint, etc.)
+ * Build a multipart request body for a Modal generation call.
+ * Params travel as a JSON field and audio as binary file parts, avoiding the
+ * ~33% base64 overhead of the JSON body.
  */
-export async function generateViaModal(
+function buildModalForm(
     srcAudioBlob: Blob | null,
     params: AnyTaskParams | LegoTaskParams,
-): Promise<ModalGenerationResult> {
+): FormData {
     const body: Record<string, unknown> = {};
     for (const [key, value] of Object.entries(params)) {
         if (value === null || value === undefined) continue;
         body[key] = value;
     }
 
-    // Include source audio as base64 for tasks that need audio context
+    const form = new FormData();
+    form.append('params', JSON.stringify(body));
+
+    // Include source audio for tasks that need audio context
     if (srcAudioBlob && srcAudioBlob.size > 0) {
-        const srcBase64 = await blobToBase64(srcAudioBlob);
-        body.src_audio_base64 = srcBase64;
+        form.append('src_audio', srcAudioBlob, 'src_audio.wav');
 
         // For Cover mode: also send as reference_audio for timbre/style matching
         // src_audio → melody/rhythm/chord structure
         // reference_audio → timbre/mixing/performance style
         if (body.task_type === 'cover') {
-            body.reference_audio_base64 = srcBase64;
+            form.append('reference_audio', srcAudioBlob, 'reference_audio.wav');
         }
     }
+    return form;
+}
 
+/**
+ * Run a synchronous Modal generation and return every output as a Blob.
+ * Outputs come back as multipart parts; failures come back as JSON.
+ */
+async function generateOutputsViaModal(
+    srcAudioBlob: Blob | null,
+    params: AnyTaskParams | LegoTaskParams,
+): Promise<Blob[]> {
     const res = await fetch(MODAL_PROXY, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(body),
+        headers: { Accept: 'multipart/form-data' },
+        body: buildModalForm(srcAudioBlob, params),
     });
 
     if (!res.ok) {
@@ -85,21 +88,34 @@ export async function generateViaModal(
         throw new Error(`Modal generation failed: ${res.status} - ${text}`);
     }
 
-    const json: ModalResponse = await res.json();
+    if (!res.headers.get('Content-Type')?.startsWith('multipart/')) {
+        const json: { status: string; error?: string } = await res.json();
+        throw new Error(`Modal generation status: ${json.status}${json.error ? ` - ${json.error}` : ''}`);
+    }
 
-    if (json.status !== 'succeeded') {
-        throw new Error(`Modal generation status: ${json.status}`);
+    const form = await res.formData();
+    const outputs: Blob[] = [];
+    for (const [name, value] of form.entries()) {
+        if (name.startsWith('output_') && value instanceof Blob) outputs.push(value);
     }
+    return outputs;
+}
 
-    if (!json.outputs || json.outputs.length === 0) {
+/**
+ * Generic Modal generation call for any task type.
+ * Accepts optional source audio blob for tasks that need it (lego, cover, repaint, etc.)
+ */
+export async function generateViaModal(
+    srcAudioBlob: Blob | null,
+    params: AnyTaskParams | LegoTaskParams,
+): Promise<ModalGenerationResult> {
+    const outputs = await generateOutputsViaModal(srcAudioBlob, params);
+    if (outputs.length === 0) {
         throw new Error('Modal returned no outputs');
     }
 
-    const mimeType = json.format === 'wav' ? 'audio/wav' : 'audio/mpeg';
-    const audioBlob = base64ToBlob(json.outputs[0], mimeType);
-
     return {
-        audioBlob,
+        audioBlob: outputs[0],
         metas: {},
     };
 }
@@ -112,44 +128,155 @@ export async function generateBatchViaModal(
     srcAudioBlob: Blob | null,
     params: AnyTaskParams,
 ): Promise<ModalGenerationResult[]> {
-    const body: Record<string, unknown> = {};
-    for (const [key, value] of Object.entries(params)) {
-        if (value === null || value === undefined) continue;
-        body[key] = value;
-    }
+    const outputs = await generateOutputsViaModal(srcAudioBlob, params);
+    return outputs.map((audioBlob) => ({
+        audioBlob,
+        metas: {},
+    }));
+}
+
+/**
+ * One streamed step of a server-side lego cascade.
+ */
+export interface CascadeStepResult {
+    index: number;
+    clip_id?: string;
+    status: string;
+    format?: string;
+    error?: string;
+    /** New cumulative mix after this step, if it succeeded */
+    audioBlob?: Blob;
+    /** Isolated, trimmed stem when the step asked for postprocess */
+    stemBlob?: Blob;
+    stem?: StemInfo;
+}
 
+/**
+ * Run consecutive lego steps as one server-side cascade. The server feeds each
+ * step's mix into the next itself; `onStep` is called as each step finishes.
+ * Without a source mix, `silenceSeconds` has the server synthesize a silent one.
+ *
+ * Returns how many steps the server ran. It stops early once its time budget
+ * is spent, so the caller has to send the rest again on top of the last mix;
+ * 0 means the stream ended without reporting.
+ */
+export async function cascadeViaModal(
+    srcAudioBlob: Blob | null,
+    steps: Array<LegoTaskParams & { clip_id: string }>,
+    onStep: (step: CascadeStepResult) => Promise<void>,
+    silenceSeconds?: number,
+): Promise<number> {
+    const form = new FormData();
+    form.append('params', JSON.stringify({ steps, src_audio_silence: srcAudioBlob ? undefined : silenceSeconds }));
     if (srcAudioBlob && srcAudioBlob.size > 0) {
-        const srcBase64 = await blobToBase64(srcAudioBlob);
-        body.src_audio_base64 = srcBase64;
+        form.append('src_audio', srcAudioBlob, 'src_audio.wav');
+    }
 
-        // For Cover mode: also send as reference_audio for timbre/style matching
-        if (body.task_type === 'cover') {
-            body.reference_audio_base64 = srcBase64;
-        }
+    const res = await fetch(`${MODAL_PROXY}/cascade`, { method: 'POST', body: form });
+    if (!res.ok || !res.body) {
+        const text = await res.text();
+        throw new Error(`Modal cascade failed: ${res.status} - ${text}`);
+    }
+    if (!res.headers.get('Content-Type')?.includes('ndjson')) {
+        const json: { status: string; error?: string } = await res.json();
+        throw new Error(`Modal cascade status: ${json.status}${json.error ? ` - ${json.error}` : ''}`);
     }
 
-    const res = await fetch(MODAL_PROXY, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(body),
-    });
+    // NDJSON: one event per line, streamed as each step finishes
+    const reader = res.body.getReader();
+    const decoder = new TextDecoder();
+    let buffered = '';
+    for (;;) {
+        const { done, value } = await reader.read();
+        if (value) buffered += decoder.decode(value, { stream: true });
+        let newline: number;
+        while ((newline = buffered.indexOf('\n')) >= 0) {
+            const line = buffered.slice(0, newline).trim();
+            buffered = buffered.slice(newline + 1);
+            if (!line) continue;
+            const event = JSON.parse(line);
+            if (event.done) return event.count ?? steps.length;
+            const { output, mix, ...rest } = event;
+            if (event.stem) {
+                // Post-processed step: "output" is the stem, "mix" the cumulative mix
+                const mixType = AUDIO_MIME_TYPES[event.mix_format] ?? 'audio/mpeg';
+                await onStep({
+                    ...rest,
+                    audioBlob: mix ? base64ToBlob(mix, mixType) : undefined,
+                    stemBlob: output ? base64ToBlob(output, 'audio/wav') : undefined,
+                });
+                continue;
+            }
+            const mimeType = AUDIO_MIME_TYPES[event.format] ?? 'audio/mpeg';
+            await onStep({ ...rest, audioBlob: output ? base64ToBlob(output, mimeType) : undefined });
+        }
+        if (done) return 0;
+    }
+}
 
+/**
+ * Unwrap an ACE-Step style response envelope, throwing on API-level errors.
+ */
+async function unwrapEnvelope<T>(res: Response, what: string): Promise<T> {
     if (!res.ok) {
         const text = await res.text();
-        throw new Error(`Modal generation failed: ${res.status} - ${text}`);
+        throw new Error(`${what} failed: ${res.status} - ${text}`);
+    }
+    const envelope: ApiEnvelope<T> = await res.json();
+    if (envelope.code !== 200) {
+        throw new Error(`${what} failed: ${envelope.code} - ${envelope.error}`);
     }
+    return envelope.data;
+}
 
-    const json: ModalResponse = await res.json();
+/**
+ * Queue a generation job on Modal. Mirrors aceStepApi.releaseLegoTask so the
+ * pipeline can poll both backends the same way.
+ */
+export async function releaseTaskViaModal(
+    srcAudioBlob: Blob | null,
+    params: AnyTaskParams | LegoTaskParams,
+): Promise<ReleaseTaskResponse> {
+    const res = await fetch(`${MODAL_PROXY}/release_task`, {
+        method: 'POST',
+        body: buildModalForm(srcAudioBlob, params),
+    });
+    return unwrapEnvelope<ReleaseTaskResponse>(res, 'Modal release_task');
+}
 
-    if (json.status !== 'succeeded') {
-        throw new Error(`Modal generation status: ${json.status}`);
-    }
+/**
+ * Poll queued Modal jobs. Mirrors aceStepApi.queryResult.
+ */
+export async function queryResultViaModal(taskIds: string[]): Promise<TaskResultEntry[]> {
+    const res = await fetch(`${MODAL_PROXY}/query_result`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ task_id_list: taskIds }),
+    });
+    return unwrapEnvelope<TaskResultEntry[]>(res, 'Modal query_result');
+}
 
-    const mimeType = json.format === 'wav' ? 'audio/wav' : 'audio/mpeg';
-    return json.outputs.map((output) => ({
-        audioBlob: base64ToBlob(output, mimeType),
-        metas: {},
-    }));
+/**
+ * Cancel a Modal job that has not started yet.
+ */
+export async function cancelTaskViaModal(taskId: string): Promise<void> {
+    const res = await fetch(`${MODAL_PROXY}/cancel_task`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ task_id: taskId }),
+    });
+    await unwrapEnvelope<unknown>(res, 'Modal cancel_task');
+}
+
+/**
+ * Download a finished job's audio. `audioPath` is the `file` field from
+ * query_result, e.g. "/v1/audio?task_id=...&index=0".
+ */
+export async function downloadAudioViaModal(audioPath: string): Promise<Blob> {
+    const url = `${MODAL_PROXY}${audioPath.replace(/^\/v1/, '')}`;
+    const res = await fetch(url);
+    if (!res.ok) throw new Error(`Modal audio download failed: ${res.status} ${res.statusText}`);
+    return res.blob();
 }
 
 /**
@@ -157,9 +284,8 @@ export async function generateBatchViaModal(
  */
 export async function modalHealthCheck(): Promise<boolean> {
     try {
-        // Use a lightweight GET to the loras endpoint as a health probe
-        // (Modal doesn't support OPTIONS on the generate endpoint)
-        const res = await fetch('/api/modal/loras', { method: 'GET' });
+        // Dedicated GET health endpoint (Modal doesn't support OPTIONS on the generate endpoint)
+        const res = await fetch('/api/modal/health', { method: 'GET' });
         return res.ok;
     } catch {
         return false;
@@ -178,16 +304,116 @@ export interface LoraInfo {
     num_files?: number;
 }
 
+// Last catalog response, revalidated with If-None-Match
+let cachedLoras: { etag: string; loras: LoraInfo[] } | null = null;
+
 /**
  * Fetch the list of available trained LoRA adapters from Modal.
  */
 export async function listLoras(): Promise<LoraInfo[]> {
     try {
-        const res = await fetch('/api/modal/loras', { method: 'GET' });
+        const headers: Record<string, string> = {};
+        if (cachedLoras) headers['If-None-Match'] = cachedLoras.etag;
+        const res = await fetch('/api/modal/loras', { method: 'GET', headers });
+        if (res.status === 304 && cachedLoras) return cachedLoras.loras;
         if (!res.ok) return [];
         const json = await res.json();
-        return (json.loras || []) as LoraInfo[];
+        const loras = (json.loras || []) as LoraInfo[];
+        const etag = res.headers.get('ETag');
+        cachedLoras = etag ? { etag, loras } : null;
+        return loras;
     } catch {
         return [];
     }
 }
+
+/**
+ * Status of a background LoRA training job.
+ */
+export interface TrainingStatus {
+    job_id: string;
+    lora_name: string;
+    status: 'queued' | 'running' | 'completed' | 'failed' | 'cancelled';
+    progress: { epoch?: number; step?: number; loss?: number };
+    attempts: number;
+    error?: string;
+    cancel_requested?: boolean;
+}
+
+/**
+ * Fetch the status of a training job queued through /api/modal/train.
+ */
+export async function getTrainingStatus(jobId: string): Promise<TrainingStatus> {
+    const res = await fetch(`${MODAL_PROXY}/train_status?job_id=${encodeURIComponent(jobId)}`);
+    if (!res.ok) throw new Error(`Training status failed: ${res.status}`);
+    return res.json();
+}
+
+/**
+ * Ask a training job to stop. Running jobs stop at their next progress check.
+ */
+export async function cancelTraining(jobId: string): Promise<void> {
+    const res = await fetch(`${MODAL_PROXY}/train_cancel`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ job_id: jobId }),
+    });
+    if (!res.ok) throw new Error(`Training cancel failed: ${res.status}`);
+}
+
+// Bytes per training upload request; the server accepts up to 16 MB
+const TRAINING_CHUNK_BYTES = 4 * 1024 * 1024;
+const TRAINING_CHUNK_RETRIES = 3;
+
+interface TrainingUploadStatus {
+    status: 'complete' | 'partial' | 'failed';
+    sha256: string;
+    size: number;
+    received: number;
+    error?: string;
+}
+
+async function postTrainingUpload(query: string, init: RequestInit): Promise<TrainingUploadStatus> {
+    const res = await fetch(`${MODAL_PROXY}/train_upload${query}`, { method: 'POST', ...init });
+    if (!res.ok) throw new Error(`Training upload failed: ${res.status} - ${await res.text()}`);
+    const status = (await res.json()) as TrainingUploadStatus;
+    if (status.status === 'failed') throw new Error(status.error || 'Training upload failed');
+    return status;
+}
+
+/**
+ * Upload one training file in resumable chunks and return its SHA-256.
+ * Files the server already holds (e.g. from another LoRA) are not re-sent,
+ * and an interrupted upload continues from the last chunk the server has.
+ */
+export async function uploadTrainingFile(
+    file: Blob,
+    onProgress?: (sentBytes: number, totalBytes: number) => void,
+): Promise<string> {
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    const sha256 = Array.from(new Uint8Array(digest), (b) => b.toString(16).padStart(2, '0')).join('');
+    const resume = () => postTrainingUpload('', {
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ sha256, size: file.size }),
+    });
+
+    let status = await resume();
+    let failures = 0;
+    while (status.status !== 'complete') {
+        onProgress?.(status.received, file.size);
+        const offset = status.received;
+        const params = new URLSearchParams({ sha256, size: String(file.size), offset: String(offset) });
+        try {
+            status = await postTrainingUpload(`?${params}`, {
+                headers: { 'Content-Type': 'application/octet-stream' },
+                body: file.slice(offset, offset + TRAINING_CHUNK_BYTES),
+            });
+            failures = 0;
+        } catch (err) {
+            if (++failures > TRAINING_CHUNK_RETRIES) throw err;
+            status = await resume();
+        }
+    }
+    onProgress?.(file.size, file.size);
+    return sha256;
+}
@@ -1,6 +1,7 @@
 import { create } from 'zustand';
 import { persist } from 'zustand/middleware';
 import { get as idbGet, set as idbSet, del as idbDel } from 'idb-keyval';
+import type { AudioFormat } from '../types/api';
 
 /** Serializable output metadata (audio blob stored separately in IDB) */
 export interface OutputMeta {
@@ -39,7 +40,7 @@ interface ComposerState {
     thinking: boolean;
     batchSize: number;
     sampleMode: boolean;
-    audioFormat: 'wav' | 'mp3';
+    audioFormat: AudioFormat;
     repaintStart: number;
     repaintEnd: number;
     extractTrack: string;
@@ -69,7 +70,7 @@ interface ComposerState {
     setThinking: (v: boolean) => void;
     setBatchSize: (v: number) => void;
     setSampleMode: (v: boolean) => void;
-    setAudioFormat: (v: 'wav' | 'mp3') => void;
+    setAudioFormat: (v: AudioFormat) => void;
     setRepaintStart: (v: number) => void;
     setRepaintEnd: (v: number) => void;
     setExtractTrack: (v: string) => void;
@@ -9,6 +9,15 @@ export type TaskType =
   | 'complete'
   | 'audio_understanding';
 
+/** Output formats; flac and opus are encoded by the Modal backend */
+export type AudioFormat = 'wav' | 'mp3' | 'flac' | 'opus';
+
+/** Output encoding settings (Modal only) */
+export interface EncodingOptions {
+  bitrate_kbps?: number;       // mp3 (32-320, default 192) and opus (6-510, default 96)
+  compression_level?: number;  // flac, 0-12, default 5
+}
+
 /** Base generation params shared by all task types */
 export interface BaseTaskParams {
   task_type: TaskType;
@@ -22,7 +31,9 @@ export interface BaseTaskParams {
   guidance_scale: number;
   shift: number;
   batch_size: number;
-  audio_format: 'wav' | 'mp3';
+  fan_out?: boolean;            // Modal only: one seed per warm worker instead of one batched pass
+  audio_format: AudioFormat;
+  encoding?: EncodingOptions;   // Modal only: bitrate / compression for audio_format
   thinking: boolean;
   model: string;                // DiT model: turbo (default), sft, base, turbo-shift1, turbo-shift3
   sample_mode?: boolean;
@@ -41,6 +52,7 @@ export interface BaseTaskParams {
   lm_top_p?: number;            // nucleus sampling, default 0.9
   lm_cfg_scale?: number;        // LM CFG strength, default 2.0
   lm_negative_prompt?: string;  // tells LM what NOT to generate
+  lm_seed?: number;             // Modal only: reuse the LM output for DiT-only re-rolls
 
   // Audio control
   audio_cover_strength?: number; // 0.0-1.0, controls how closely to follow source audio (Cover mode)
@@ -58,6 +70,32 @@ export interface LegoTaskParams extends BaseTaskParams {
   instruction: string;
   repainting_start: number;
   repainting_end: number;
+  postprocess?: PostprocessOptions; // Modal only: return the isolated, trimmed stem
+  src_audio_silence?: number; // Modal only: seconds of silence the server uses as src_audio
+  window?: boolean | WindowOptions; // Modal only: generate just the repaint region plus margins
+}
+
+/** Windowed lego / repaint generation (Modal only) */
+export interface WindowOptions {
+  margin?: number;     // seconds of context either side of the repaint region
+  crossfade?: number;  // seconds blended at each splice, at most the margin
+}
+
+/** Server-side stem post-processing (Modal only) */
+export interface PostprocessOptions {
+  isolate?: boolean;      // subtract src_audio from the output mix
+  trim?: boolean;         // cut to [repainting_start, repainting_end]
+  peaks?: number;         // waveform peak windows to compute
+  include_mix?: boolean;  // also return the full output mix
+}
+
+/** Isolated stem details returned alongside a post-processed output */
+export interface StemInfo {
+  start: number;
+  end: number;
+  sample_rate: number;
+  frames: number;
+  peaks: { min: number[]; max: number[] };
 }
 
 /** Text2Music - generate from text prompt + lyrics */
@@ -152,6 +190,11 @@ export interface TaskResultItem {
   generation_info?: string;
   lm_model?: string;
   dit_model?: string;
+  mix_file?: string;  // Modal post-processing: full mix when `file` is the stem
+  stem?: StemInfo;
+  lm_cache?: 'hit' | 'miss' | 'bypass';  // Modal: whether the LM stage came from cache
+  encoding?: { format: AudioFormat; bytes: number; encode_ms: number };  // Modal: size and encode time of this output
+  mix_encoding?: { format: AudioFormat; bytes: number; encode_ms: number };  // Modal: same for `mix_file`
 }
 
 export interface HealthResponse {
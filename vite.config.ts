@@ -13,6 +13,69 @@ export default defineConfig({
         rewrite: () => '/',
         secure: true,
       },
+      '/api/modal/health': {
+        target: 'https://marcf--acestep-acestepinference-api-health.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/train_status': {
+        target: 'https://marcf--acestep-acestepinference-api-train-status.modal.run',
+        changeOrigin: true,
+        // Keep the ?job_id=... query string
+        rewrite: (path) => path.replace(/^\/api\/modal\/train_status/, '/'),
+        secure: true,
+      },
+      '/api/modal/train_upload': {
+        target: 'https://marcf--acestep-acestepinference-api-train-upload.modal.run',
+        changeOrigin: true,
+        // Keep the ?sha256=...&offset=... query string of chunk uploads
+        rewrite: (path) => path.replace(/^\/api\/modal\/train_upload/, '/'),
+        secure: true,
+      },
+      '/api/modal/train_cancel': {
+        target: 'https://marcf--acestep-acestepinference-api-train-cancel.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/train': {
+        target: 'https://marcf--acestep-acestepinference-api-train.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/cascade': {
+        target: 'https://marcf--acestep-acestepinference-api-cascade.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/release_task': {
+        target: 'https://marcf--acestep-acestepinference-api-release-task.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/query_result': {
+        target: 'https://marcf--acestep-acestepinference-api-query-result.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/cancel_task': {
+        target: 'https://marcf--acestep-acestepinference-api-cancel-task.modal.run',
+        changeOrigin: true,
+        rewrite: () => '/',
+        secure: true,
+      },
+      '/api/modal/audio': {
+        target: 'https://marcf--acestep-acestepinference-api-task-audio.modal.run',
+        changeOrigin: true,
+        // Keep the ?task_id=...&index=... query string
+        rewrite: (path) => path.replace(/^\/api\/modal\/audio/, '/'),
+        secure: true,
+      },
       '/api/modal': {
         target: 'https://marcf--acestep-acestepinference-api-generate.modal.run',
         changeOrigin: true,